@@ -0,0 +1,318 @@
+#!/usr/bin/python2.5
+""" Measure how long the steps of a fit take on the test fixtures
+
+For each fixture in tests/ and each type of model (an empirical prior
+fit of a single rate type with neg_binom_model, and a posterior fit
+of one region/year/sex with gbd_disease_model) this times
+
+  load : parsing the fixture json into a DiseaseJson
+  setup : making the PyMC nodes of the model
+  logp : one evaluation of the logp (or value) function of every node
+  map : a fixed number of iterations of the MAP optimizer
+  mcmc : a fixed number of MCMC iterations
+  summarize : summarizing the traces (storing the estimates, for a posterior)
+  save : writing the fitted model back to json
+  xls : the xls table of the estimates (posterior only)
+
+with the random seeds fixed, so that two runs on the same machine do
+the same work.  The quick steps are repeated and the fastest is
+reported.  Each run is appended to a json history file, with the time,
+host and git revision, and compared with a saved baseline run: a step
+that takes more than THRESHOLD times as long as in the baseline (and
+more than MIN_SECS longer) is reported as a regression, and the
+script exits with status 1.
+
+Example
+-------
+
+$ python benchmark.py                        # all fixtures and models, compared with the baseline
+$ python benchmark.py --save-baseline        # make this run the baseline
+$ python benchmark.py -f dismoditis -m emp_prior --mcmc-iter 200
+"""
+
+import optparse
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+import numpy as np
+import simplejson as json
+
+default_fixtures = ['dismoditis', 'ihd', 'opi', 'hep_c_europe_western', 'single_low_noise', 'test_disease_1']
+default_models = ['emp_prior', 'posterior']
+
+FIXTURE_PATH = 'tests/%s.json'
+HISTORY_FILE = 'tests/benchmark_history.json'
+BASELINE_FILE = 'tests/benchmark_baseline.json'
+
+# a step regresses if it takes THRESHOLD times as long as in the
+# baseline, and MIN_SECS longer (so the timer noise in quick steps is
+# not a regression)
+THRESHOLD = 1.25
+MIN_SECS = .05
+
+SEED = 12345
+MAP_ITER = 20
+MCMC_ITER = 500
+
+rate_types = ['prevalence', 'incidence', 'remission', 'excess-mortality']
+
+def best_of(repeat, f, *args):
+    """ Call f repeat times, and return the fastest time it took and what it returned the last time"""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = f(*args)
+        secs = time.time() - start
+        if best is None or secs < best:
+            best = secs
+    return best, result
+
+def timed(f, *args):
+    return best_of(1, f, *args)
+
+def seed(s=SEED):
+    random.seed(s)
+    np.random.seed(s)
+
+def revision():
+    """ Return the git revision of the working tree, or '' if it is not known"""
+    try:
+        out = subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE).communicate()[0]
+    except OSError:
+        return ''
+    return out.strip()
+
+def most_common(values, default):
+    counts = {}
+    for v in values:
+        counts[v] = counts.get(v, 0) + 1
+    if not counts:
+        return default
+    return sorted(counts.items(), key=lambda (v, n): (-n, v))[0][0]
+
+def emp_prior_type(dm):
+    """ Return the rate type with the most data in dm"""
+    from dismod3.utils import clean
+    return most_common([t for d in dm.data for t in rate_types
+                        if clean(d['data_type']).find(t) != -1 and d.get('ignore') != -1],
+                       'prevalence')
+
+def posterior_keys(dm):
+    """ Return the gbd keys of the region with the most data in dm, for 1990, male"""
+    import dismod3.utils
+    from dismod3.utils import clean
+    from dismod3.settings import gbd_regions
+    regions = [clean(r) for r in gbd_regions]
+    region = most_common([clean(d.get('gbd_region', '')) for d in dm.data
+                          if clean(d.get('gbd_region', '')) in regions],
+                         'north_america_high_income')
+    return dismod3.utils.gbd_keys(region_list=[region], year_list=[1990], sex_list=['male'])
+
+def logp_all(vars):
+    """ Evaluate every node of the model once"""
+    import dismod3.profiling as profiling
+    for key, name, node in profiling.labelled_nodes(vars):
+        profiling.node_function(node)()
+
+def bench_emp_prior(dm, options, record):
+    """ Time the steps of an empirical prior fit, as in neg_binom_model.fit_emp_prior"""
+    import pymc as mc
+    from dismod3 import neg_binom_model
+    from dismod3.utils import clean
+
+    param_type = emp_prior_type(dm)
+    data = [d for d in dm.data if clean(d['data_type']).find(param_type) != -1 and d.get('ignore') != -1]
+    dm.calc_effective_sample_size(data)
+
+    def setup():
+        dm.clear_empirical_prior()
+        dm.fit_initial_estimate(param_type, data)
+        return neg_binom_model.setup(dm, param_type, data)
+    record('setup', *best_of(options.repeat, setup))
+    dm.vars = setup()
+    if len(dm.vars['data']) == 0:
+        return
+
+    record('logp', *best_of(options.repeat, logp_all, dm.vars))
+
+    log_dispersion = dm.vars.pop('log_dispersion')
+    dm.map = mc.MAP(dm.vars)
+    dm.vars.update(log_dispersion=log_dispersion)
+    record('map', *timed(lambda: dm.map.fit(method='fmin_powell', iterlim=options.map_iter, tol=.001, verbose=0)))
+
+    dm.mcmc = mc.MCMC(dm.vars, db='ram')
+    dm.mcmc.use_step_method(mc.Metropolis, dm.vars['log_dispersion'],
+                            proposal_sd=dm.vars['dispersion_step_sd'])
+    dm.mcmc.use_step_method(mc.AdaptiveMetropolis, dm.vars['age_coeffs_mesh'],
+                            cov=dm.vars['age_coeffs_mesh_step_cov'], verbose=0)
+    record('mcmc', *timed(lambda: dm.mcmc.sample(iter=options.mcmc_iter, verbose=0)))
+
+    def summarize():
+        for name in ['region_coeffs', 'study_coeffs', 'age_coeffs_mesh', 'log_dispersion']:
+            dm.vars[name].value = dm.vars[name].stats()['mean']
+    record('summarize', *timed(summarize))
+
+def bench_posterior(dm, options, record):
+    """ Time the steps of a posterior fit of one region/year/sex, as in gbd_disease_model.fit"""
+    import pymc as mc
+    from dismod3 import gbd_disease_model, neg_binom_model, normal_model
+    from dismod3.utils import type_region_year_sex_from_key
+    import dismod3.table
+
+    keys = posterior_keys(dm)
+    dm.calc_effective_sample_size(dm.data)
+    record('setup', *best_of(options.repeat, gbd_disease_model.setup, dm, keys))
+    dm.vars = gbd_disease_model.setup(dm, keys)
+
+    record('logp', *best_of(options.repeat, logp_all, dm.vars))
+
+    dm.map = mc.MAP(dm.vars)
+    record('map', *timed(lambda: dm.map.fit(method='fmin_powell', iterlim=options.map_iter, tol=.001, verbose=0)))
+
+    dm.mcmc = mc.MCMC(dm.vars, db='ram')
+    record('mcmc', *timed(lambda: dm.mcmc.sample(iter=options.mcmc_iter, verbose=0)))
+
+    def summarize():
+        for k in keys:
+            t,r,y,s = type_region_year_sex_from_key(k)
+            if t in ['incidence', 'prevalence', 'remission', 'excess-mortality', 'mortality']:
+                neg_binom_model.store_mcmc_fit(dm, k, dm.vars[k])
+            elif t in ['relative-risk', 'duration', 'incidence_x_duration']:
+                normal_model.store_mcmc_fit(dm, k, dm.vars[k])
+    record('summarize', *timed(summarize))
+
+    record('xls', *best_of(options.repeat, dismod3.table.table_by_region, dm, keys, 'benchmark', 10))
+
+def run(fixtures, models, options):
+    """ Time every step of every model of every fixture
+
+    Results
+    -------
+    Returns a dict of the seconds each step took, keyed by
+    ``<fixture>/<model>/<step>``
+    """
+    from dismod3.disease_json import DiseaseJson
+
+    results = {}
+    for fixture in fixtures:
+        dm_json = open(FIXTURE_PATH % fixture).read()
+        for model in models:
+            def record(step, secs, result=None):
+                results['%s/%s/%s' % (fixture, model, step)] = secs
+                print '%-45s %10.3f' % ('%s/%s/%s' % (fixture, model, step), secs)
+                sys.stdout.flush()
+
+            seed(options.seed)
+            secs, dm = best_of(options.repeat, DiseaseJson, dm_json)
+            record('load', secs)
+            if model == 'emp_prior':
+                bench_emp_prior(dm, options, record)
+            else:
+                bench_posterior(dm, options, record)
+            record('save', *best_of(options.repeat, dm.to_json))
+    return results
+
+def compare(results, baseline, threshold=THRESHOLD, min_secs=MIN_SECS):
+    """ Compare the results of a run with those of a baseline run
+
+    Results
+    -------
+    Returns a list of (name, baseline secs, secs, ratio) for the steps
+    that take more than threshold times as long as in the baseline,
+    and more than min_secs longer, slowest first; steps that are not
+    in the baseline are not compared
+    """
+    regressions = []
+    for name, secs in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if secs > threshold * base and secs - base > min_secs:
+            regressions.append((name, base, secs, secs / max(base, 1.e-9)))
+    regressions.sort(key=lambda r: -r[3])
+    return regressions
+
+def load_json(fname, default):
+    if not os.path.exists(fname):
+        return default
+    f = open(fname)
+    try:
+        return json.loads(f.read())
+    finally:
+        f.close()
+
+def save_json(fname, obj):
+    f = open(fname, 'w')
+    f.write(json.dumps(obj, indent=1, sort_keys=True))
+    f.close()
+
+def main():
+    usage = 'usage: %prog [options]'
+    parser = optparse.OptionParser(usage)
+    parser.add_option('-f', '--fixture', dest='fixtures', action='append',
+                      help='fixture to benchmark (may be given more than once; default all)')
+    parser.add_option('-m', '--model', dest='models', action='append',
+                      help='type of model to benchmark, emp_prior or posterior (default both)')
+    parser.add_option('-n', '--repeat', dest='repeat', type='int', default=3,
+                      help='number of times to time the quick steps (the fastest is reported)')
+    parser.add_option('--map-iter', dest='map_iter', type='int', default=MAP_ITER,
+                      help='number of MAP iterations to time')
+    parser.add_option('--mcmc-iter', dest='mcmc_iter', type='int', default=MCMC_ITER,
+                      help='number of MCMC iterations to time')
+    parser.add_option('--seed', dest='seed', type='int', default=SEED,
+                      help='random seed')
+    parser.add_option('--history', dest='history', default=HISTORY_FILE,
+                      help='json file to append the results of this run to')
+    parser.add_option('--baseline', dest='baseline', default=BASELINE_FILE,
+                      help='json file of the run to compare this one with')
+    parser.add_option('--save-baseline', dest='save_baseline', action='store_true', default=False,
+                      help='make this run the baseline')
+    parser.add_option('--threshold', dest='threshold', type='float', default=THRESHOLD,
+                      help='ratio to the baseline time above which a step is a regression')
+    (options, args) = parser.parse_args()
+
+    fixtures = options.fixtures or default_fixtures
+    models = options.models or default_models
+    for m in models:
+        if m not in default_models:
+            parser.error('unknown model type %s' % m)
+
+    results = run(fixtures, models, options)
+    this_run = {'time': time.time(), 'host': socket.gethostname(), 'revision': revision(),
+                'seed': options.seed, 'map_iter': options.map_iter, 'mcmc_iter': options.mcmc_iter,
+                'results': results}
+
+    history = load_json(options.history, [])
+    history.append(this_run)
+    save_json(options.history, history)
+
+    if options.save_baseline:
+        save_json(options.baseline, this_run)
+        print 'saved baseline to %s' % options.baseline
+        return
+
+    baseline = load_json(options.baseline, None)
+    if not baseline:
+        print 'no baseline in %s to compare with (use --save-baseline)' % options.baseline
+        return
+    if (baseline.get('map_iter'), baseline.get('mcmc_iter')) != (options.map_iter, options.mcmc_iter):
+        print 'WARNING: baseline was run with %s MAP and %s MCMC iterations' % (baseline.get('map_iter'), baseline.get('mcmc_iter'))
+
+    regressions = compare(results, baseline['results'], options.threshold)
+    print
+    print 'compared with %s (revision %s)' % (options.baseline, baseline.get('revision'))
+    if not regressions:
+        print 'no regressions'
+        return
+    print '%-45s %10s %10s %7s' % ('regression', 'baseline', 'secs', 'ratio')
+    for name, base, secs, ratio in regressions:
+        print '%-45s %10.3f %10.3f %7.2f' % (name, base, secs, ratio)
+    sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -17,6 +17,8 @@ import signal
 import dismod3
 from dismod3.utils import clean, gbd_keys, type_region_year_sex_from_key
 from dismod3.plotting import GBDDataHash
+from dismod3.executor import LocalExecutor
+from dismod3.job_lease import LeaseTracker
 
 import sys
 from os import popen
@@ -42,6 +44,10 @@ def main():
                       action='store_true', dest='log',
                       help='log the job running status')
 
+    parser.add_option('-w', '--warm',
+                      action='store_true', dest='warm',
+                      help='(daemon mode) run local fits in warm workers, which keep dismod3 loaded between fits')
+
     (options, args) = parser.parse_args()
 
     f = open(dismod3.settings.GBD_FIT_LOCK_FILE, 'w')
@@ -51,24 +57,55 @@ def main():
     try:
         #tweet('starting dismod3 daemon...')
         log('starting dismod3 daemon...')
-        daemon_loop()
+        daemon_loop(options.warm)
     finally:
         #tweet('...dismod3 daemon shutting down')
         log('dismod3 daemon shutting down')
 
-def daemon_loop():
+def submit_fit(executor, warm, name, fit_args, id, o, e):
+    """ Queue a local gbd_fit.py run of model id with options fit_args"""
+    if warm:
+        executor.submit_script(name, 'gbd_fit.py %s %d' % (fit_args, id), o, e)
+    else:
+        executor.submit(name, dismod3.settings.GBD_FIT_STR % (fit_args, id, o, e))
+
+def daemon_loop(warm=False):
     on_sge = dismod3.settings.ON_SGE
+    if warm and not on_sge:
+        from dismod3.worker_pool import WorkerPool
+        executor = WorkerPool()
+    else:
+        executor = LocalExecutor()
+    leases = LeaseTracker(executor)
     while True:
+        # report fits that finished since the last pass, start queued
+        # ones, and keep the leases on the jobs whose fits are running
+        for name, returncode in leases.poll():
+            log('finished %s (return code %d)' % (name, returncode))
+        executor.save_status('%s/computational_engine.json' % dismod3.settings.LOCAL_EXECUTOR_STATUS_DIR)
+
+        # wait on the server for a job, but only briefly while there
+        # are fits running locally, so that they are reaped promptly
+        if executor.busy():
+            timeout = dismod3.settings.SLEEP_SECS
+        else:
+            timeout = dismod3.settings.JOB_QUEUE_POLL_TIMEOUT
         try:
-            job_queue = dismod3.get_job_queue()
+            job_queue = [dismod3.claim_job(timeout)]
         except:
             job_queue = []
+            time.sleep(dismod3.settings.SLEEP_SECS)
         
-        for param_id in job_queue:
+        for job_params in job_queue:
+            if not job_params:  # no job was queued before the timeout
+                continue
+            param_id = job_params['param_id']
             #tweet('processing job %d' % id)
             log('processing job %d' % param_id)
-            job_params = dismod3.remove_from_job_queue(param_id)
             id = int(job_params['dm_id'])
+            # the job is finished when none of the fits named for this model are left
+            # (at once on SGE, where they are not run by the executor)
+            leases.hold(job_params['job_id'], '%d ' % id, timed=not on_sge)
             dm = dismod3.get_disease_model(id)
 
             # make a working directory for the id
@@ -90,9 +127,17 @@ def daemon_loop():
                 os.mkdir('%s/stdout' % d)
                 os.mkdir('%s/stderr' % d)
                 dismod3.init_job_log(id, 'posterior', param_id)
+
+                # only re-fit the region/year/sexes whose inputs have changed
+                import dismod3.fingerprint
+                changed = dismod3.fingerprint.changed_posteriors(dm, regions_to_fit)
                 for r in regions_to_fit:
                     for s in dismod3.gbd_sexes:
                         for y in dismod3.gbd_years:
+                            if not (clean(r), y, s) in changed:
+                                log('carrying forward posterior for %s+%s+%s' % (clean(r), s, y))
+                                dismod3.log_job_status(id, 'posterior', '%s--%s--%s' % (clean(r), s, y), 'Completed')
+                                continue
                             # fit only one region, for the time being...
                             # TODO: make region selection a user-settable option from the gui
                             #if clean(r) != 'asia_southeast':
@@ -104,8 +149,7 @@ def daemon_loop():
                                 call_str = dismod3.settings.GBD_FIT_STR % (o, e, '-l -r %s -s %s -y %s' % (clean(r), s, y), id)
                                 subprocess.call(call_str, shell=True)
                             else:
-                                call_str = dismod3.settings.GBD_FIT_STR % ('-l -r %s -s %s -y %s' % (clean(r), s, y), id, o, e)
-                                subprocess.call(call_str, shell=True)
+                                submit_fit(executor, warm, '%d %s' % (id, k), '-l -r %s -s %s -y %s' % (clean(r), s, y), id, o, e)
                             time.sleep(1.)
 
             elif estimate_type.find('empirical priors') != -1:
@@ -123,13 +167,11 @@ def daemon_loop():
                     if on_sge:
                         subprocess.call(dismod3.settings.GBD_FIT_STR % (o, e, '-l -t %s' % t, id), shell=True)
                     else:
-                        subprocess.call(dismod3.settings.GBD_FIT_STR % ('-l -t %s' % t, id, o, e), shell=True)
+                        submit_fit(executor, warm, '%d %s' % (id, t), '-l -t %s' % t, id, o, e)
 
             else:
                 #tweet('unrecognized estimate type: %s' % estimate_type)
                 log('unrecognized estimate type: %s' % estimate_type)
-            
-        time.sleep(dismod3.settings.SLEEP_SECS)
 
 if __name__ == '__main__':
     main()
@@ -4,22 +4,71 @@ modeling system, as well as all of the parameters and functions
 specific to the statistical modeling and plotting of generic disease.
 
 see ``../docs/tutorial.rst`` for more details on the interface.
+
+Only the settings and utilities are loaded by ``import dismod3``;
+the plotting, table, and disease_json functions listed below, and
+the submodules, are imported the first time they are used, so that
+scripts and views which do not need matplotlib, xlwt, or PyMC do not
+pay for loading them.
 """
 
+import imp
+import sys
+from types import ModuleType
+
 from utils import gbd_regions, gbd_years, gbd_sexes, \
     data_types, gbd_key_for, type_region_year_sex_from_key
 
 from utils import NEARLY_ZERO, MAX_AGE, MISSING, PRIOR_SEP_STR
 
-from plotting import tile_plot_disease_model, sparkplot_disease_model, \
-    sparkplot_boxes, overlay_plot_disease_model, plot_prior_preview, bar_plot_disease_model
+# public names, and the submodules they are imported from on first use
+lazy_names = {}
+for module, names in [
+    ['plotting', ['tile_plot_disease_model', 'sparkplot_disease_model', 'sparkplot_boxes',
+                  'overlay_plot_disease_model', 'plot_prior_preview', 'bar_plot_disease_model']],
+    ['table', ['table_by_region_year_sex', 'table_by_region', 'population_by_region_year_sex']],
+    ['disease_json', ['get_job_queue', 'remove_from_job_queue', 'claim_job', 'renew_job_lease',
+                      'finish_job', 'try_posting_disease_model', 'post_disease_model', 'init_job_log',
+                      'log_job_status', 'fetch_disease_model', 'load_disease_model', 'get_disease_model',
+                      'add_covariates_to_disease_model', 'get_posterior_slice', 'get_job_timings']],
+    ['gbd_disease_model', ['relevant_to']],
+    ]:
+    for name in names:
+        lazy_names[name] = module
+del module, names, name
+
+class LazyModule(ModuleType):
+    """ The dismod3 package, which imports its public functions and
+    submodules when they are first used"""
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError, name
 
-from table import table_by_region_year_sex, table_by_region, table
+        if lazy_names.has_key(name):
+            module = __import__('%s.%s' % (self.__name__, lazy_names[name]), {}, {}, [name])
+            val = getattr(module, name)
+        else:
+            try:
+                imp.find_module(name, self.__path__)
+            except ImportError:
+                raise AttributeError, name
+            __import__('%s.%s' % (self.__name__, name))
+            val = sys.modules['%s.%s' % (self.__name__, name)]
 
-from disease_json import get_job_queue, remove_from_job_queue, \
-     try_posting_disease_model, post_disease_model, init_job_log, log_job_status, \
-     fetch_disease_model, load_disease_model, get_disease_model, add_covariates_to_disease_model
+        ModuleType.__setattr__(self, name, val)
+        return val
 
-from gbd_disease_model import relevant_to
+    def _table(self):
+        module = __import__('%s.table' % self.__name__, {}, {}, ['table'])
+        return module.table
+    # a property, since importing the table submodule sets the package
+    # attribute of the same name to the module, not the function
+    table = property(_table)
 
-from table import population_by_region_year_sex
+# replace this module with a LazyModule holding the same names,
+# keeping a reference to the original so that its globals stay alive
+_module = sys.modules[__name__]
+_lazy_module = LazyModule(__name__, __doc__)
+_lazy_module.__dict__.update(_module.__dict__)
+_lazy_module._module = _module
+sys.modules[__name__] = _lazy_module
@@ -0,0 +1,161 @@
+""" Checkpoint and resume support for long MCMC runs
+
+A checkpoint holds everything needed to continue sampling where a
+previous run stopped: the values of all stochastics, the adaptive
+state of the step methods (e.g. the proposal covariance of
+AdaptiveMetropolis), the number of iterations completed, and the
+state of the random number generators.
+
+Sampling is broken into blocks of ``CHECKPOINT_ITERS`` iterations,
+and the checkpoint is rewritten (atomically) after each block, along
+with the pickle database holding the trace so far, and a progress
+event goes to the event log of the fit (see event_log.py).  Each
+block is stored by PyMC as a separate chain, so traces of a
+checkpointed run must be read with ``trace(chain=None)``.
+
+Example
+-------
+>>> import dismod3.checkpoint as checkpoint
+>>> state = checkpoint.load('dm-1-posterior.pickle.checkpoint')
+>>> mcmc = mc.MCMC(vars, db=checkpoint.database('dm-1-posterior.pickle', state))
+>>> checkpoint.restore(mcmc, state)
+>>> checkpoint.sample(mcmc, 10000, 5000, 5, 'dm-1-posterior.pickle.checkpoint', state)
+"""
+
+import os
+import random
+import cPickle
+
+import numpy as np
+import pymc as mc
+
+from dismod3.settings import CHECKPOINT_ITERS
+from dismod3.utils import debug, write_atomically
+import dismod3.event_log as event_log
+import dismod3.memory as memory
+
+# step method attributes that carry adaptive state between iterations
+STEP_METHOD_STATE = ['accepted', 'rejected', 'adaptive_scale_factor', 'proposal_sd',
+                     'C', 'chain_mean', '_trace', '_trace_count', '_current_iter']
+
+def checkpoint_name(dbname):
+    """ Return the name of the checkpoint file that goes with the
+    pickle database dbname"""
+    return '%s.checkpoint' % dbname
+
+def step_method_key(sm):
+    """ Identify a step method by the names of the stochastics it updates"""
+    return tuple(sorted([s.__name__ for s in sm.stochastics]))
+
+def get_state(mcmc, iters_done, extra={}):
+    """ Collect the complete sampler state of mcmc in a picklable dict
+
+    Parameters
+    ----------
+    mcmc : pymc.MCMC
+    iters_done : int
+      the number of iterations (including burn-in) completed so far
+    extra : dict, optional
+      additional values to carry along with the checkpoint, for
+      example goodness-of-fit statistics from the MAP stage
+    """
+    state = {'iters_done': iters_done,
+             'values': {},
+             'step_methods': {},
+             'np_random': np.random.get_state(),
+             'random': random.getstate(),
+             'extra': extra}
+
+    for s in mcmc.stochastics:
+        state['values'][s.__name__] = s.value
+
+    for sm in mcmc.step_methods:
+        sm_state = {}
+        for attr in STEP_METHOD_STATE:
+            if hasattr(sm, attr):
+                sm_state[attr] = getattr(sm, attr)
+        state['step_methods'][step_method_key(sm)] = sm_state
+
+    return state
+
+def restore(mcmc, state):
+    """ Put mcmc back into the sampler state saved in state"""
+    for s in mcmc.stochastics:
+        if state['values'].has_key(s.__name__):
+            s.value = state['values'][s.__name__]
+
+    # a new sampler has no step methods until it first samples, and
+    # assigning them does not replace any already assigned
+    mcmc.assign_step_methods()
+    for sm in mcmc.step_methods:
+        for attr, val in state['step_methods'].get(step_method_key(sm), {}).items():
+            setattr(sm, attr, val)
+
+    np.random.set_state(state['np_random'])
+    random.setstate(state['random'])
+
+def save(fname, state):
+    """ Write state to fname, by writing to a temporary file and
+    renaming, so that an interrupted save never leaves a partial
+    checkpoint behind"""
+    write_atomically(fname, cPickle.dumps(state, cPickle.HIGHEST_PROTOCOL))
+
+def load(fname):
+    """ Return the state saved in fname, or None if there is no usable
+    checkpoint"""
+    try:
+        f = open(fname, 'rb')
+        state = cPickle.load(f)
+        f.close()
+        return state
+    except (IOError, EOFError, cPickle.UnpicklingError):
+        return None
+
+def clear(fname):
+    """ Remove the checkpoint fname, so that the next fit starts fresh"""
+    if os.path.exists(fname):
+        os.remove(fname)
+
+def database(dbname, state):
+    """ Return the db argument for pymc.MCMC; this reopens the pickle
+    database of a checkpointed run, so that the trace so far is kept"""
+    if state and os.path.exists(dbname):
+        return mc.database.pickle.load(dbname)
+    return 'pickle'
+
+def sample(mcmc, iter, burn, thin, fname, state=None, verbose=0,
+           every=CHECKPOINT_ITERS, extra={}):
+    """ Sample from mcmc in blocks, saving a checkpoint after each one
+
+    Parameters
+    ----------
+    mcmc : pymc.MCMC
+    iter, burn, thin : int
+      the same as for pymc.MCMC.sample; these count the whole run,
+      not just the part that is left to do
+    fname : str
+      the checkpoint file
+    state : dict, optional
+      a state returned by load(fname); sampling continues after the
+      iterations it records as done (restore() should already have
+      been called with it)
+    every : int, optional
+      the number of iterations between checkpoints, rounded to a
+      multiple of thin
+    """
+    every = max(thin, every - every % thin)
+    iters_done = 0
+    if state:
+        iters_done = state['iters_done']
+        debug('resuming from checkpoint after %d of %d iterations' % (iters_done, iter))
+
+    while iters_done < iter:
+        n = min(every, iter - iters_done)
+        block_burn = min(n, max(0, burn - iters_done))
+        mcmc.sample(iter=n, burn=block_burn, thin=thin, verbose=verbose)
+        iters_done += n
+
+        mcmc.db.commit()
+        save(fname, get_state(mcmc, iters_done, extra))
+        event_log.progress(iters_done, iter)
+        memory.check('mcmc iteration %d' % iters_done)
@@ -2,10 +2,12 @@ import numpy as np
 import pymc as mc
 from pymc import gp
 
-import twill.commands as twc
 import simplejson as json
 
 from dismod3.settings import *
+from dismod3.http_client import session, DismodServerError
+import dismod3.event_log as event_log
+import dismod3.array_encoding as array_encoding
 from dismod3.utils import debug, clean, trim, uninformative_prior_gp, prior_dict_to_str, NEARLY_ZERO, MAX_AGE, MISSING
 
 class DiseaseJson:
@@ -16,40 +18,45 @@ class DiseaseJson:
         self.id = dm.get('id',-1)
         self.extract_params_from_global_priors()
 
+        # a ResultsStore to read the estimates that are not in params
+        # from (see get_estimate and dismod3/results_store.py)
+        self.results = None
+
     def to_json(self):
         return json.dumps({'params': self.params, 'data': self.data, 'id': self.id})
 
     def merge(self, more_dm):
         """ merge all params from more_dm into self"""
-        for key,val in more_dm.params.items():
-            if isinstance(val, dict):
-                if not key in self.params:
-                    self.params[key] = {}
-                self.params[key].update(val)
-            else:
-                self.params[key] = val
+        import dismod3.merge
+        dismod3.merge.merge_params(self.params, more_dm.params)
 
     def merge_posteriors(self, region='*'):
-        """ merge model fit data into a DiseaseJson object
+        """ merge model fit data into a DiseaseJson object, parsing
+        the files in parallel (see dismod3/merge.py), and return a
+        report of the files that were merged, and of those that were
+        missing or corrupt and could not be merged
+
         region : str
           a regex string for which region posteriors to merge
         """
         dir = JOB_WORKING_DIR % self.id
 
-        #fname = '%s/json/dm-%d-posterior-%s-%s-%s.json' % (dir, id, r,s,y)   # TODO: refactor naming into its own function
         import glob
-        for fname in glob.glob('%s/json/*posterior*%s*.json' % (dir, region)):
-            try:
-                debug('merging %s' % fname)
-                f = open(fname)
-                self.merge(DiseaseJson(f.read()))
-                f.close()
-            except (ValueError, IOError):
-                debug('failed to merge in %s' % fname)
-
-    def save(self, fname='', keys_to_save=None):
+        import dismod3.merge
+        report = dismod3.merge.merge_shards(self, sorted(glob.glob('%s/json/*posterior*%s*.json' % (dir, region))))
+        if report['corrupt']:
+            debug(dismod3.merge.report_str(report))
+        return report
+
+    def save(self, fname='', keys_to_save=None, params_to_save=None):
         """ save results to json file
-        remove extraneous keys (and all data) if requested"""
+        remove extraneous keys (and all data) if requested, and, if
+        params_to_save is given, all params that are not dicts except
+        those in it
+
+        the file is written atomically, and recorded in the manifest
+        that merges check it against, and is not rewritten if it is
+        unchanged (see dismod3/merge.py)"""
 
         if keys_to_save:
             # remove all keys that have not been changed by running this model
@@ -60,6 +67,8 @@ class DiseaseJson:
                     for j in self.params[k].keys():
                         if not j in keys_to_save:
                             self.params[k].pop(j)
+                elif params_to_save != None and not k in params_to_save:
+                    self.params.pop(k)
 
             # also remove data
             self.data = []
@@ -71,9 +80,31 @@ class DiseaseJson:
             fname = 'dm-%s.json' % self.id
 
         
-        f = open('%s/json/%s' % (dir, fname), 'w')
-        f.write(self.to_json())
-        f.close()
+        import dismod3.merge
+        written = dismod3.merge.write_shard('%s/json/%s' % (dir, fname), self.to_json(), keys_to_save or [])
+        event_log.saved(keys_to_save or [], fname=fname, unchanged=not written)
+
+    def params_patch(self, keys_to_save, params_to_save=[]):
+        """ Return the part of self.params that a fit of keys_to_save
+        changed, for uploading as a patch
+
+        Parameters
+        ----------
+        keys_to_save : list of str
+          the gbd keys to keep, from each dict-valued param
+        params_to_save : list of str, optional
+          the names of other params to include whole, e.g.
+          'empirical_prior_incidence'
+        """
+        patch = {}
+        for k, val in self.params.items():
+            if k in params_to_save:
+                patch[k] = val
+            elif type(val) == dict:
+                sub_val = dict([[j, val[j]] for j in keys_to_save if val.has_key(j)])
+                if sub_val:
+                    patch[k] = sub_val
+        return patch
 
     def savefig(self, fname):
         """ save figure in png subdir"""
@@ -125,50 +156,62 @@ class DiseaseJson:
         if self.params.has_key(key):
             self.params.pop(key)
 
+    def get_estimate(self, key, type, default=[]):
+        """ Return the estimate vector key (e.g. 'map' or 'mcmc_mean')
+        for type as an array, from params, or else from the results
+        store, or else default"""
+        val = self.get_key_by_type(key, type)
+        if val is None and self.results:
+            val = self.results.get(key, type)
+        if val is None:
+            val = default
+        return array_encoding.decode(val)
+    def has_estimate(self, key, type):
+        return self.params.get(key, {}).has_key(type) \
+               or bool(self.results and self.results.has(key, type))
+
     def get_initial_value(self, type, default_val=None):
         """ Return the initial value for estimate of a particular
         type, default to NEARLY_ZERO"""
         if default_val == None:
             default_val = NEARLY_ZERO * np.ones(len(self.get_estimate_age_mesh()))
-        return np.array(
-            self.get_key_by_type('initial_value', type, default=default_val)
-            )
+        return self.get_estimate('initial_value', type, default=default_val)
     def set_initial_value(self, type, val):
-        self.set_key_by_type('initial_value', type, list(val))
+        self.set_key_by_type('initial_value', type, array_encoding.encode(val))
     def has_initial_value(self, type):
-        return self.params.get('initial_value', {}).has_key(type)
+        return self.has_estimate('initial_value', type)
 
     def get_map(self, type):
-        return np.array(self.get_key_by_type('map', type, default=[]))
+        return self.get_estimate('map', type)
     def set_map(self, type, val):
-        self.set_key_by_type('map', type, list(val))
+        self.set_key_by_type('map', type, array_encoding.encode(val))
     def has_map(self, type):
-        return self.params.get('map', {}).has_key(type)
+        return self.has_estimate('map', type)
 
     def get_truth(self, type):
-        return np.array(self.get_key_by_type('truth', type, default=[]))
+        return self.get_estimate('truth', type)
     def set_truth(self, type, val):
-        self.set_key_by_type('truth', type, list(val))
+        self.set_key_by_type('truth', type, array_encoding.encode(val))
     def has_truth(self, type):
-        return self.params.get('truth', {}).has_key(type)
+        return self.has_estimate('truth', type)
 
     def get_mcmc(self, est_type, data_type):
-        val = self.get_key_by_type('mcmc_%s' % est_type, data_type, default=[])
+        val = self.get_estimate('mcmc_%s' % est_type, data_type)
 
         # TODO: sometimes an mcmc_upper_ui key is set to {}, which is wrong and needs debugged
-        if val == {}:
-            val = []
-        return np.array(val)
+        if val.shape == ():
+            val = np.array([])
+        return val
     def set_mcmc(self, est_type, data_type, val):
-        self.set_key_by_type('mcmc_%s' % est_type, data_type, list(val))
+        self.set_key_by_type('mcmc_%s' % est_type, data_type, array_encoding.encode(val))
     def has_mcmc(self, type):
-        return self.params.get('mcmc_mean', {}).has_key(type)
+        return self.has_estimate('mcmc_mean', type)
 
     def get_population(self, region):
-        return np.array(self.get_key_by_type('population', region, default=np.ones(MAX_AGE)))
+        return array_encoding.decode(self.get_key_by_type('population', region, default=np.ones(MAX_AGE)))
         #return np.array(self.get_key_by_type('population', region, default=None))
     def set_population(self, region, val):
-        self.set_key_by_type('population', region, list(val))
+        self.set_key_by_type('population', region, array_encoding.encode(val))
 
     def clear_fit(self):
         """ Clear all estimates, fits, and stochastic vars
@@ -198,6 +241,9 @@ class DiseaseJson:
         if hasattr(self, 'mcmc'):
             delattr(self, 'mcmc')
 
+        # the stored estimates are those of the fit being cleared
+        self.results = None
+
     def get_units(self, type):
         return self.get_key_by_type('units', type)
     def set_units(self, type, units):
@@ -288,7 +334,7 @@ class DiseaseJson:
     def set_empirical_prior(self, type, prior_dict):
         """ The empirical prior hash contains model-specific data for
         keyed by model parameter types"""
-        self.params['empirical_prior_%s' % type] = json.dumps(prior_dict)
+        self.params['empirical_prior_%s' % type] = json.dumps(array_encoding.encode_dict(prior_dict))
     def clear_empirical_prior(self):
         """ Remove empirical priors for all keys"""
         self.clear_key('empirical_prior')
@@ -308,7 +354,7 @@ class DiseaseJson:
 
             ['sigma_gamma', 'sigma_alpha', 'sigma_beta', 'beta', 'sigma_delta', 'delta', 'alpha', 'gamma']
         """
-        return json.loads(self.params.get('empirical_prior_%s' % type, '{}'))
+        return array_encoding.decode_dict(json.loads(self.params.get('empirical_prior_%s' % type, '{}')))
 
     def get_estimate_age_mesh(self):
         return self.params.get('estimate_age_mesh', range(MAX_AGE))
@@ -414,7 +460,7 @@ class DiseaseJson:
         data: list, optional
           the data list to extract all-cause mortality from
         """
-        if self.params.get('initial_value',{}).has_key(key):
+        if self.has_initial_value(key):
             return self.get_initial_value(key)
 
         if not data:
@@ -575,9 +621,8 @@ class DiseaseJson:
         
 # to run a bunch of empirical prior fits programatically:
 #for i in range(4091, 4108):
-#    dismod3.disease_json.twc.go('http://winthrop.ihme.washington.edu/dismod/run/%d'%i)
-#    dismod3.disease_json.twc.formvalue(2,2, 'run_page')
-#    dismod3.disease_json.twc.submit()
+#    dismod3.disease_json.session().post_form('http://winthrop.ihme.washington.edu/dismod/job_queue/add/%d'%i,
+#                                             {'estimate_type': 'Estimate empirical priors', 'requested_by': 'run_page'})
 
 import os
 import random
@@ -595,7 +640,7 @@ def create_disease_model_dir(id):
 
     for phase in ['empirical_priors', 'posterior']:
         os.mkdir('%s/%s' % (dir, phase))
-        for f_type in ['stdout', 'stderr', 'pickle']:
+        for f_type in ['stdout', 'stderr', 'pickle', 'events', 'timing']:
             os.mkdir('%s/%s/%s' % (dir, phase, f_type))
     os.mkdir('%s/json' % dir)
     os.mkdir('%s/image' % dir)
@@ -626,79 +671,108 @@ def load_disease_model(id):
 
 
     if the JOB_WORKING_DIR contains .json files, use them to construct
-    the disease model
+    the disease model (a posterior of a region in the run_status of
+    the model with no .json file is reported missing in
+    dm.merge_report, unless the model already holds a current fit of
+    it, carried forward from an earlier run)
     
     if not, fetch specificed disease model data from
     dismod server given in settings.py
     """
+    dir = JOB_WORKING_DIR % id
     try:
-        dir = JOB_WORKING_DIR % id
-        fname = '%s/json/dm-%s.json' % (dir, id)
-        f = open(fname)
-        dm_json = f.read()
-        dm = DiseaseJson(dm_json)  # TODO: handle error if json fails to load
+        f = open('%s/json/dm-%s.json' % (dir, id))
+        dm = DiseaseJson(f.read())  # TODO: handle error if json fails to load
         f.close()
-
-        import glob
-        for fname in glob.glob('%s/json/dm-%d*.json' % (dir, id)):
-            try:
-                debug('merging %s' % fname)
-                f = open(fname)
-                dm.merge(DiseaseJson(f.read()))
-                f.close()
-
-            except ValueError:
-                debug('failed to merge in %s' % fname)
-        return dm
-
     except IOError: # no local copy, so download from server
         return fetch_disease_model(id)
 
-def fetch_disease_model(id):
-    from twill import set_output
-    set_output(open('/dev/null', 'w'))
-
-    dismod_server_login()
-
-    twc.go(DISMOD_DOWNLOAD_URL % id)
-    result_json = twc.show()
-    twc.get_browser()._browser._response.close()  # end the connection, so that apache doesn't get upset
-
-    dm = DiseaseJson(result_json)
+    # merge in the results of the fits, parsing them in parallel; the
+    # report of the merge, with any missing or corrupt fits, is kept
+    # in dm.merge_report
+    import glob
+    import dismod3.merge
+    fnames = sorted(glob.glob('%s/json/dm-%d-*.json' % (dir, id)))
+    regions = dm.params.get('run_status', {}).get('regions_to_fit', [])
+    if regions and regions[0] == 'all_regions':
+        regions = gbd_regions
+    dm.merge_report = dismod3.merge.merge_shards(dm, fnames)
+
+    # a posterior that was not fit because its stored fit is current
+    # (see fingerprint.changed_posteriors) is not missing
+    import dismod3.fingerprint
+    for r in regions:
+        for s in gbd_sexes:
+            for y in gbd_years:
+                fname = dismod3.merge.posterior_fname(id, clean(r), s, y)
+                if not fname in fnames and not dismod3.fingerprint.posterior_is_current(dm, clean(r), y, s):
+                    dm.merge_report['missing'].append(fname)
+    if dm.merge_report['missing'] or dm.merge_report['corrupt']:
+        debug(dismod3.merge.report_str(dm.merge_report))
     return dm
 
+def fetch_disease_model(id):
+    """ fetch disease model id from the dismod server given in
+    settings.py, through the node-local cache in dismod3.model_cache"""
+    import dismod3.model_cache
+    return dismod3.model_cache.fetch(id)
+
 def get_disease_model(id):
     """ legacy function: pass it on to fetch disease model"""
     return fetch_disease_model(id)
 
-def try_posting_disease_model(dm, ntries):
-    # error handling: in case post fails try again, but stop after 3 tries
-    from twill.errors import TwillAssertionError
-    import random
-    import time
+def get_posterior_slice(id, type=None, region=None, year=None, sex=None, stat='mean',
+                        age_start=None, age_end=None, encoding='<f8'):
+    """
+    fetch a selection of the estimates of disease model id from the
+    dismod server given in settings.py, without downloading the model
 
+    type, region, year, sex and stat may each be a str or a list of
+    str; see dismod_posterior_slice in dismod_data_server/views.py.
+    Returns the selected ages, and a dict with a dict for each
+    statistic of the estimates of each gbd key, as arrays
+    """
+    import urllib
+    query = {}
+    for name, val in [['type', type], ['region', region], ['year', year], ['sex', sex], ['stat', stat]]:
+        if val is not None:
+            if isinstance(val, (list, tuple)):
+                val = ','.join([str(v) for v in val])
+            query[name] = val
+    for name, val in [['age_start', age_start], ['age_end', age_end], ['encoding', encoding]]:
+        if val is not None:
+            query[name] = val
+    result = session().get_json(DISMOD_POSTERIOR_SLICE_URL % id + '?' + urllib.urlencode(query))
+
+    estimates = result['estimates']
+    for stat in estimates:
+        for key, val in estimates[stat].items():
+            estimates[stat][key] = array_encoding.decode(val)
+    return result['age'], estimates
+
+def try_posting_disease_model(dm, ntries, keys_to_save=None, params_to_save=[]):
+    """ post dm to the dismod server, trying up to ntries times, and
+    return the url of the model, or '' if every try failed"""
     url = ''
-    for ii in range(ntries):
-        try:
-            url = post_disease_model(dm)
-            break
-        except TwillAssertionError:
-            pass
-        if ii < ntries-1:
-            debug('posting disease model failed, retrying in a bit')
-            time.sleep(random.random()*30)
-        else:
-            debug('posting disease model failed %d times, giving up' % (ii+1))
-
-    twc.get_browser()._browser._response.close()  # end the connection, so that apache doesn't get upset
-    return ''
+    try:
+        url = post_disease_model(dm, retries=ntries-1, keys_to_save=keys_to_save, params_to_save=params_to_save)
+    except DismodServerError, e:
+        debug('posting disease model failed, giving up: %s' % e)
+    return url
 
-def post_disease_model(disease):
+def post_disease_model(disease, retries=None, keys_to_save=None, params_to_save=[]):
     """
-    fetch specificed disease model data from
-    dismod server given in settings.py
+    post disease model to dismod server given in settings.py, as
+    json, and return the url of the model on the server
+
+    If keys_to_save is given, only the params that a fit of those keys
+    changed are sent (see DiseaseJson.params_patch), gzip-compressed,
+    and the server applies them as a patch to the model.
     """
-    dismod_server_login()
+    if keys_to_save != None:
+        patch = {'id': disease.id, 'params': disease.params_patch(keys_to_save, params_to_save)}
+        result = session().post_json(DISMOD_PATCH_URL % disease.id, patch, compress=True, retries=retries)
+        return result['url']
 
     # don't upload the disease data, since it is already on the server
     data = disease.data
@@ -706,9 +780,8 @@ def post_disease_model(disease):
     d_json = disease.to_json()
     disease.data = data
     
-    twc.go(DISMOD_UPLOAD_URL)
-    twc.fv('1', 'model_json', d_json)
-    twc.submit()
+    result = session().post_json(DISMOD_UPLOAD_URL, d_json, retries=retries)
+    return result['url']
 
 
 def add_covariates_to_disease_model(dm):
@@ -716,11 +789,7 @@ def add_covariates_to_disease_model(dm):
     submit request to dismod server to add covariates to disease model dm
     wait for response (which can take a while)
     """
-    dismod_server_login()
-
-    twc.go(DISMOD_BASE_URL + 'dismod/run/%d' % dm)
-    twc.fv('1', 'update', '')
-    twc.submit()
+    session().post_form(DISMOD_BASE_URL + 'dismod/update_covariates/%d' % dm, {'update': ''})
 
 
 def get_job_queue():
@@ -728,40 +797,83 @@ def get_job_queue():
     fetch list of disease model jobs waiting to run from dismod server
     given in settings.py.
     """
-    dismod_server_login()
-    twc.go(DISMOD_LIST_JOBS_URL)
-    return json.loads(twc.show())
+    return session().get_json(DISMOD_LIST_JOBS_URL)
 
 def remove_from_job_queue(id):
     """
     remove a disease model from the job queue on the dismod server
     given in dismod3/settings.py
     """
-    dismod_server_login()
-    
-    twc.go(DISMOD_REMOVE_JOB_URL)
-    twc.fv('1', 'id', str(id))
-    twc.submit()
-    return json.loads(twc.show())
+    return session().post_json(DISMOD_REMOVE_JOB_URL, {'id': id})
+
+def get_job_timings():
+    """
+    fetch the [features, seconds] of the recently finished jobs from
+    the dismod server, for training a RuntimePredictor
+    """
+    return session().get_json(DISMOD_JOB_TIMINGS_URL)
     
 
+def worker_name():
+    """ the name this process claims jobs under"""
+    import socket
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+def claim_job(timeout=JOB_QUEUE_POLL_TIMEOUT, order=JOB_CLAIM_ORDER):
+    """
+    claim the next job on the job queue of the dismod server given in
+    dismod3/settings.py, waiting up to timeout seconds for one to be
+    queued if there are none, and choosing among jobs of equal priority
+    by order ('shortest', 'longest' or 'oldest' first)
+
+    the job is leased to this process for JOB_LEASE_SECS, and the
+    lease must be renewed (see dismod3.job_lease) until finish_job is
+    called, or the job goes back on the queue
+
+    return the params of the job, including its job id as 'job_id'
+    and its param id as 'param_id', or None if no job was queued
+    before the timeout
+    """
+    return json.loads(session().post_form(DISMOD_CLAIM_JOB_URL,
+                                          {'timeout': timeout, 'order': order, 'worker': worker_name()}))
+
+def renew_job_lease(job_id, s=None):
+    """
+    renew the lease of this process on job job_id, using the
+    DismodSession s if given
+
+    return False if the lease had expired, and the job was given to
+    another worker
+    """
+    s = s or session()
+    return json.loads(s.post_form(DISMOD_RENEW_JOB_URL % job_id, {'worker': worker_name()}))['held']
+
+def finish_job(job_id, failed=False, timed=True):
+    """
+    mark job job_id as done, or as failed
+
+    if timed is False, the job's run time is not recorded for the run
+    time predictions, e.g. because it was only submitted to the cluster
+    """
+    session().post_form(DISMOD_FINISH_JOB_URL % job_id,
+                        {'worker': worker_name(), 'failed': failed and 1 or 0,
+                         'untimed': (not timed) and 1 or 0})
+
 def dismod_server_login():
-    """ login to the dismod server given in dismod3/settings.py."""
-    
-    twc.go(DISMOD_LOGIN_URL)
-    twc.fv('1', 'username', DISMOD_USERNAME)
-    twc.fv('1', 'password', DISMOD_PASSWORD)
-    twc.submit()
-    twc.url('accounts/profile')
+    """ login to the dismod server given in dismod3/settings.py.
+
+    This is not needed before the other server functions, which use a
+    session that logs in when it has to."""
+    session().login()
     
 def init_job_log(id, estimate_type, param_id):
     """
     initialize job log in the job status file on the webserver.
     """
-    twc.go(DISMOD_INIT_LOG_URL % (id, estimate_type, param_id))
+    session().get(DISMOD_INIT_LOG_URL % (id, estimate_type, param_id))
 
 def log_job_status(id, estimate_type, fitting_task, state):
     """
     log job status in the job status file on the webserver.
     """
-    twc.go(DISMOD_LOG_STATUS_URL % (id, estimate_type, fitting_task, state))
+    session().get(DISMOD_LOG_STATUS_URL % (id, estimate_type, fitting_task, state))
@@ -0,0 +1,113 @@
+""" Memoization of empirical prior fits
+
+An empirical prior fit for a rate type depends only on the data of
+that type (and the cause-specific mortality lower bound data, for
+excess-mortality), the priors for the type, the covariate settings,
+the age meshes, and the MCMC settings.  This module stores the results
+of each fit under ``EMP_PRIOR_CACHE_DIR``, in a file named by a hash
+of these inputs, so that a fit whose inputs have not changed can be
+skipped, and its results copied into the model instead.  Since the
+store is content-addressed, the results can be reused by a new
+version of the model as well as the one that was fit.
+
+Example
+-------
+>>> import dismod3.emp_prior_cache as emp_prior_cache
+>>> fp = emp_prior_cache.emp_prior_fingerprint(dm, 'incidence')
+>>> if not emp_prior_cache.restore(dm, 'incidence', fp):
+...     neg_binom_model.fit_emp_prior(dm, 'incidence')
+...     emp_prior_cache.store(dm, 'incidence', fp)
+"""
+
+import simplejson as json
+
+from dismod3.settings import EMP_PRIOR_CACHE_DIR, gbd_regions, gbd_years, gbd_sexes
+from dismod3.utils import clean, debug, gbd_keys, makedirs, write_atomically
+from dismod3.fingerprint import hash_obj
+
+# the keys of dm.params that fit_emp_prior sets for each region/year/sex
+region_params = ['initial_value', 'mcmc_emp_prior_mean', 'mcmc_emp_prior_upper_ui', 'mcmc_emp_prior_lower_ui']
+
+def emp_prior_data(dm, param_type):
+    """ Return the data and lower bound data that the empirical prior
+    fit of param_type uses (see neg_binom_model.fit_emp_prior)"""
+    data = [d for d in dm.data if clean(d['data_type']).find(param_type) != -1 and d.get('ignore') != -1]
+    lower_bound_data = []
+    if param_type == 'excess-mortality':
+        lower_bound_data = [d for d in dm.data if d['data_type'] == 'cause-specific mortality data']
+    return data, lower_bound_data
+
+def emp_prior_fingerprint(dm, param_type, iter=30000, thin=20, burn=10000):
+    """ Return a hash of all inputs to the empirical prior fit of param_type
+
+    This must be computed before fitting, since fitting adds derived
+    values (e.g. effective_sample_size) to the data rows.
+    """
+    data, lower_bound_data = emp_prior_data(dm, param_type)
+    inputs = {'type': param_type,
+              'data': sorted(data, key=lambda d: d.get('id')),
+              'lower_bound_data': sorted(lower_bound_data, key=lambda d: d.get('id')),
+              'priors': dm.get_priors(param_type),
+              'covariates': dm.get_covariates(),
+              'param_age_mesh': dm.get_param_age_mesh(),
+              'estimate_age_mesh': dm.get_estimate_age_mesh(),
+              'mcmc': [iter, thin, burn]}
+    return hash_obj(inputs)
+
+def cache_fname(fingerprint):
+    return '%s/%s.json' % (EMP_PRIOR_CACHE_DIR, fingerprint)
+
+def result_keys(param_type):
+    """ Return the keys of the dict params that the empirical prior
+    fit of param_type sets: the gbd keys of param_type in every
+    region/year/sex, param_type itself (for the initial value), and
+    the name of the empirical prior (for the fit timing)"""
+    return gbd_keys(type_list=[param_type], region_list=gbd_regions, year_list=gbd_years, sex_list=gbd_sexes) \
+           + [param_type, 'empirical_prior_%s' % param_type]
+
+def save(dm, param_type):
+    """ Save the results of the empirical prior fit of param_type in dm
+    to its shard, without the params of the model it did not set
+    (which would replace fresher results when the shards are merged)"""
+    dm.save('dm-%d-prior-%s.json' % (dm.id, param_type), keys_to_save=result_keys(param_type),
+            params_to_save=['empirical_prior_%s' % param_type])
+
+def store(dm, param_type, fingerprint):
+    """ Store the results of the empirical prior fit of param_type in dm"""
+    keys = gbd_keys(type_list=[param_type], region_list=gbd_regions, year_list=gbd_years, sex_list=gbd_sexes)
+    results = {'empirical_prior': dm.get_empirical_prior(param_type),
+               'initial_value': dm.get_key_by_type('initial_value', param_type),
+               'params': {}}
+    for p in region_params:
+        results['params'][p] = {}
+        for k in keys:
+            if dm.params.get(p, {}).has_key(k):
+                results['params'][p][k] = dm.params[p][k]
+
+    makedirs(EMP_PRIOR_CACHE_DIR)
+    write_atomically(cache_fname(fingerprint), json.dumps(results))
+
+def restore(dm, param_type, fingerprint):
+    """ Copy stored results of an empirical prior fit with the given
+    fingerprint into dm
+
+    Results
+    -------
+    Returns True if there were stored results
+    """
+    try:
+        f = open(cache_fname(fingerprint))
+        results = json.loads(f.read())
+        f.close()
+    except (IOError, ValueError):
+        return False
+
+    dm.set_empirical_prior(param_type, results['empirical_prior'])
+    if results['initial_value'] != None:
+        dm.set_key_by_type('initial_value', param_type, results['initial_value'])
+    for p, vals in results['params'].items():
+        for k, val in vals.items():
+            dm.set_key_by_type(p, k, val)
+
+    debug('using stored empirical prior fit for %s' % param_type)
+    return True
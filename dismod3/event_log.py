@@ -0,0 +1,185 @@
+""" Structured, append-only event logs of the fits of a job
+
+Each fit (an empirical prior of one rate type, or the posterior of
+one region/sex/year) writes the events of its run to its own log
+file, ``<JOB_WORKING_DIR>/<estimate_type>/events/<task>``, named like
+the stdout and stderr files of the fit.  Each line of the log is one
+json-encoded event, with the fields
+
+  event : 'start', 'phase_start', 'phase_end', 'progress', 'saved',
+          'error' or 'finish'
+  time : seconds since the epoch
+  ...and the fields particular to the event (the phase name,
+  iterations done, keys saved, error message, ...)
+
+Since the log is only ever appended to, a client that has read it up
+to a byte offset needs only the events after that offset (see
+read_events), instead of the whole log on every poll.  Next to each
+log is a small index, ``<task>.index``, which is rewritten after each
+event with the counts of each kind of event, the current phase and
+progress, the state of the fit ('running', 'done' or 'failed'), and
+the size of the log; the dismod server summarizes all the fits of a
+job from the indexes alone.
+
+The fit scripts open one log per process (see open_log), and the
+rest of dismod3 logs to it through the module-level functions, which
+do nothing if no log is open.
+
+Example
+-------
+>>> import dismod3.event_log as event_log
+>>> event_log.open_log(4222, 'posterior', 'asia_east+male+2005')
+>>> event_log.phase_start('mcmc')
+>>> event_log.progress(1000, 50000)
+>>> event_log.phase_end('mcmc')
+>>> event_log.close_log('done')
+>>> events, offset = event_log.read_events(event_log.log_fname(4222, 'posterior', 'asia_east+male+2005'))
+"""
+
+import os
+import time
+
+import simplejson as json
+
+from dismod3.settings import JOB_WORKING_DIR, EVENT_LOG_READ_BYTES
+from dismod3.utils import makedirs, write_atomically
+
+def log_fname(id, estimate_type, task):
+    return '%s/%s/events/%s' % (JOB_WORKING_DIR % int(id), estimate_type, task)
+
+def index_fname(fname):
+    return '%s.index' % fname
+
+class EventLog:
+    def __init__(self, fname):
+        """
+        Parameters
+        ----------
+        fname : str
+          the log file; events are appended to it if it exists, e.g.
+          when a fit is resumed from its checkpoint
+        """
+        self.fname = fname
+        makedirs(os.path.dirname(fname))
+
+        self.summary = read_summary(fname)
+        if not self.summary:
+            self.summary = {'counts': {}, 'started': time.time()}
+        self.summary.update(state='running', phase=None)
+
+    def log(self, event, **fields):
+        """ Append an event to the log, and update the index"""
+        fields.update(event=event, time=time.time())
+
+        # one write of one whole line, so that a reader never sees
+        # part of an event followed by part of another
+        f = open(self.fname, 'a')
+        f.write(json.dumps(fields) + '\n')
+        f.close()
+
+        counts = self.summary['counts']
+        counts[event] = counts.get(event, 0) + 1
+        if event == 'phase_start':
+            self.summary['phase'] = fields['phase']
+        elif event == 'phase_end':
+            self.summary['phase'] = None
+        elif event == 'progress':
+            self.summary['progress'] = [fields['iters_done'], fields['iter']]
+        elif event == 'error':
+            self.summary['error'] = fields['message']
+        elif event == 'finish':
+            self.summary['state'] = fields['state']
+        self.summary['updated'] = fields['time']
+        self.summary['size'] = os.path.getsize(self.fname)
+        write_atomically(index_fname(self.fname), json.dumps(self.summary))
+
+def read_summary(fname):
+    """ Return the index of the log fname, or {} if it has none"""
+    try:
+        f = open(index_fname(fname))
+        summary = json.loads(f.read())
+        f.close()
+        return summary
+    except (IOError, ValueError):
+        return {}
+
+def read_summaries(dir):
+    """ Return a dict of the indexes of all the logs in dir, keyed by task"""
+    summaries = {}
+    if not os.path.exists(dir):
+        return summaries
+    for fname in os.listdir(dir):
+        if fname.endswith('.index'):
+            task = fname[:-len('.index')]
+            summaries[task] = read_summary('%s/%s' % (dir, task))
+    return summaries
+
+def read_events(fname, offset=0, max_bytes=EVENT_LOG_READ_BYTES):
+    """ Read the events in the log fname after a byte offset
+
+    Parameters
+    ----------
+    fname : str
+    offset : int, optional
+      the offset returned by the previous call, or 0 to read from
+      the start
+    max_bytes : int, optional
+      read at most this much of the log; the rest can be read by
+      calling again with the new offset
+
+    Results
+    -------
+    Returns a list of the events, and the offset to read from next
+    time.  An event that is still being written is left for next
+    time, and an event longer than max_bytes is read whole.
+    """
+    if not os.path.exists(fname):
+        return [], offset
+    f = open(fname)
+    f.seek(offset)
+    s = f.read(max_bytes)
+    while s.find('\n') == -1:
+        more = f.read(max_bytes)
+        if not more:
+            break
+        s += more
+    f.close()
+
+    end = s.rfind('\n') + 1
+    events = [json.loads(line) for line in s[:end].splitlines() if line]
+    return events, offset + end
+
+# the log of the fit running in this process
+_log = None
+
+def open_log(id, estimate_type, task):
+    """ Start logging the events of this process to the log of a fit"""
+    global _log
+    _log = EventLog(log_fname(id, estimate_type, task))
+    _log.log('start', pid=os.getpid())
+    return _log
+
+def log(event, **fields):
+    if _log:
+        _log.log(event, **fields)
+
+def phase_start(phase, **fields):
+    log('phase_start', phase=phase, **fields)
+
+def phase_end(phase, **fields):
+    log('phase_end', phase=phase, **fields)
+
+def progress(iters_done, iter):
+    log('progress', iters_done=iters_done, iter=iter)
+
+def saved(keys, **fields):
+    log('saved', keys=list(keys), **fields)
+
+def error(message):
+    log('error', message=message)
+
+def close_log(state):
+    """ Record that the fit is finished, with state 'done' or 'failed'"""
+    global _log
+    log('finish', state=state)
+    _log = None
@@ -0,0 +1,150 @@
+""" Run fitting jobs as concurrent local processes
+
+The LocalExecutor keeps a queue of shell commands and runs up to
+``slots`` of them at a time, each in its own process group with
+optional limits on CPU time and memory.  It never blocks: the daemon
+calls poll() on each pass through its loop, which reaps finished
+processes, starts queued ones in the free slots, and reports what
+finished.
+
+Example
+-------
+>>> from dismod3.executor import LocalExecutor
+>>> ex = LocalExecutor(slots=4)
+>>> ex.submit('asia_east+male+2005', 'python gbd_fit.py -l -r asia_east -s male -y 2005 10 >o 2>e')
+>>> while ex.busy():
+...     for name, returncode in ex.poll():
+...         print name, returncode
+...     time.sleep(1.)
+"""
+
+import os
+import subprocess
+import time
+
+from dismod3.settings import LOCAL_EXECUTOR_SLOTS, JOB_CPU_LIMIT, JOB_MEM_LIMIT
+from dismod3.utils import makedirs, write_atomically
+
+def cpu_count():
+    """ Return the number of cores on this machine"""
+    try:
+        return int(os.sysconf('SC_NPROCESSORS_ONLN'))
+    except (AttributeError, ValueError, OSError):
+        return 1
+
+def limit_resources(cpu_limit, mem_limit):
+    """ Return a function to run in the child process before the job
+    starts, which puts it in its own process group and sets its
+    resource limits"""
+    def preexec():
+        import resource
+        os.setpgrp()
+        if cpu_limit:
+            resource.setrlimit(resource.RLIMIT_CPU, (cpu_limit, cpu_limit))
+        if mem_limit:
+            resource.setrlimit(resource.RLIMIT_AS, (mem_limit, mem_limit))
+    return preexec
+
+class Job:
+    def __init__(self, name, cmd, on_complete=None):
+        self.name = name
+        self.cmd = cmd
+        self.on_complete = on_complete
+        self.process = None
+        self.start_time = None
+        self.returncode = None
+
+class LocalExecutor:
+    def __init__(self, slots=LOCAL_EXECUTOR_SLOTS, cpu_limit=JOB_CPU_LIMIT, mem_limit=JOB_MEM_LIMIT):
+        """
+        Parameters
+        ----------
+        slots : int, optional
+          the number of jobs to run at once; defaults to the number of cores
+        cpu_limit : int, optional
+          the CPU time limit for each job, in seconds
+        mem_limit : int, optional
+          the address space limit for each job, in bytes
+        """
+        self.slots = slots or cpu_count()
+        self.cpu_limit = cpu_limit
+        self.mem_limit = mem_limit
+        self.pending = []
+        self.running = []
+
+    def submit(self, name, cmd, on_complete=None):
+        """ Queue the shell command cmd to run when a slot is free
+
+        on_complete, if given, is called with the name and the return
+        code of the job when it finishes
+        """
+        self.pending.append(Job(name, cmd, on_complete))
+        self.start_pending()
+
+    def submit_script(self, name, script, stdout='/dev/null', stderr='/dev/null', on_complete=None):
+        """ Queue a python script (with its arguments) to run when a
+        slot is free, with its output going to the files stdout and stderr"""
+        self.submit(name, 'python %s >%s 2>%s' % (script, stdout, stderr), on_complete)
+
+    def spawn(self, job):
+        """ Start job, and return its process, which must have a
+        poll() method like subprocess.Popen"""
+        return subprocess.Popen(job.cmd, shell=True, close_fds=True,
+                                preexec_fn=limit_resources(self.cpu_limit, self.mem_limit))
+
+    def start_pending(self):
+        while self.pending and len(self.running) < self.slots:
+            job = self.pending.pop(0)
+            job.process = self.spawn(job)
+            job.start_time = time.time()
+            self.running.append(job)
+
+    def poll(self):
+        """ Reap finished jobs and start queued ones, without blocking
+
+        Results
+        -------
+        Returns a list of (name, returncode) pairs for the jobs that
+        finished since the last poll
+        """
+        finished = []
+        for job in self.running[:]:
+            job.returncode = job.process.poll()
+            if job.returncode == None:
+                continue
+            self.running.remove(job)
+            finished.append((job.name, job.returncode))
+            if job.on_complete:
+                job.on_complete(job.name, job.returncode)
+        self.start_pending()
+        return finished
+
+    def busy(self):
+        """ Return True if there are jobs running or waiting to run"""
+        return len(self.running) + len(self.pending) > 0
+
+    def status(self):
+        """ Return a list of (name, state, seconds running) for all jobs
+        known to the executor"""
+        now = time.time()
+        return [(job.name, 'running', now - job.start_time) for job in self.running] \
+            + [(job.name, 'queued', 0.) for job in self.pending]
+
+    def save_status(self, fname):
+        """ Write the status of the executor to fname as json, for the
+        server load service (see server_load.py) to report"""
+        import socket
+        import simplejson as json
+        makedirs(os.path.dirname(fname))
+        write_atomically(fname, json.dumps({'host': socket.gethostname(), 'pid': os.getpid(), 'slots': self.slots,
+                                            'updated': time.time(), 'jobs': self.status()}))
+
+    def terminate(self):
+        """ Stop all running jobs, and forget the queued ones"""
+        import signal
+        for job in self.running:
+            try:
+                os.killpg(job.process.pid, signal.SIGTERM)
+            except OSError:
+                pass
+        self.pending = []
@@ -0,0 +1,96 @@
+""" Dependency fingerprints for incremental re-fitting
+
+A posterior fit for a region/year/sex depends only on the data
+relevant to that region/year/sex, the priors, the empirical prior
+results, the covariate settings, and the age meshes.  The fingerprint
+of a region/year/sex is an md5 hash of all of these, and it is stored
+in the model's params (under the 'posterior_fingerprint' key, for
+each gbd key of the region/year/sex) when the posterior is fit.
+
+A re-fit only needs to recompute the region/year/sexes whose current
+fingerprint differs from the stored one; the stored fits for the rest
+are carried forward unchanged.
+
+All-cause mortality data is left out of the fingerprint, since it
+does not change, and it is only merged into the model by some of the
+fitting scripts.
+"""
+
+import hashlib
+
+import numpy as np
+import simplejson as json
+
+from dismod3.settings import gbd_regions, gbd_years, gbd_sexes
+from dismod3.utils import clean, gbd_keys, gbd_key_for
+
+# rate types whose priors and empirical priors enter a posterior fit
+emp_prior_types = ['incidence', 'remission', 'excess-mortality', 'prevalence']
+prior_types = emp_prior_types + ['relative-risk', 'duration', 'mortality']
+
+def _json_default(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError, repr(obj)
+
+def hash_obj(obj):
+    """ Return an md5 hash of a json-able object (numpy arrays
+    allowed), which does not depend on dict ordering"""
+    return hashlib.md5(json.dumps(obj, sort_keys=True, default=_json_default)).hexdigest()
+
+def relevant_data(dm, region, year, sex):
+    """ Return the data rows that a posterior fit for region/year/sex
+    uses, sorted by id, leaving out all-cause mortality data"""
+    from dismod3.gbd_disease_model import relevant_to
+    data = [d for d in dm.data
+            if d['data_type'] != 'all-cause mortality data' and relevant_to(d, 'all', region, year, sex)]
+    return sorted(data, key=lambda d: d.get('id'))
+
+def posterior_fingerprint(dm, region, year, sex):
+    """ Return the dependency fingerprint of the posterior fit for region/year/sex
+
+    This must be computed before fitting, since fitting adds derived
+    values (e.g. age_weights) to the data rows.
+    """
+    key = gbd_key_for('%s', region, year, sex)
+    inputs = {'data': relevant_data(dm, region, year, sex),
+              'priors': dict([[t, dm.get_priors(key % t)] for t in prior_types]),
+              'emp_priors': dict([[t, dm.get_empirical_prior(t)] for t in emp_prior_types]),
+              'emp_prior_mean': dict([[t, dm.get_mcmc('emp_prior_mean', key % t)] for t in emp_prior_types]),
+              'covariates': dm.get_covariates(),
+              'param_age_mesh': dm.get_param_age_mesh(),
+              'estimate_age_mesh': dm.get_estimate_age_mesh()}
+    return hash_obj(inputs)
+
+def set_posterior_fingerprint(dm, region, year, sex, fingerprint):
+    """ Store the fingerprint of a posterior fit under each gbd key
+    for the region/year/sex"""
+    for k in gbd_keys(region_list=[region], year_list=[year], sex_list=[sex]):
+        dm.set_key_by_type('posterior_fingerprint', k, fingerprint)
+
+def get_posterior_fingerprint(dm, region, year, sex):
+    """ Return the stored fingerprint of the last posterior fit for
+    region/year/sex, or None if there is none"""
+    return dm.get_key_by_type('posterior_fingerprint', gbd_key_for('prevalence', region, year, sex))
+
+def posterior_is_current(dm, region, year, sex, fingerprint=None):
+    """ Return True if the stored posterior for region/year/sex was fit
+    with the inputs the model has now"""
+    if not dm.has_mcmc(gbd_key_for('prevalence', region, year, sex)):
+        return False
+    if fingerprint == None:
+        fingerprint = posterior_fingerprint(dm, region, year, sex)
+    return get_posterior_fingerprint(dm, region, year, sex) == fingerprint
+
+def changed_posteriors(dm, regions=gbd_regions, years=gbd_years, sexes=gbd_sexes):
+    """ Return a list of the (region, year, sex) triples whose posterior
+    must be re-fit, with regions clean()-ed"""
+    changed = []
+    for r in regions:
+        for y in years:
+            for s in sexes:
+                if not posterior_is_current(dm, clean(r), y, s):
+                    changed.append((clean(r), y, s))
+    return changed
@@ -0,0 +1,71 @@
+""" Run a fit with its event log, timing and memory accounting
+
+Each fit script (gbd_fit.py, fit_emp_prior.py, fit_posterior.py and
+upload_fits.py) runs its fit through run_fit, which opens the event
+log of the fit, starts the timer and the memory sampler, profiles the
+fit if asked to, and afterwards, whether the fit finished or failed,
+saves the timing and the memory report and closes the event log with
+the state of the fit.
+
+Example
+-------
+>>> from dismod3.fit_runner import run_fit
+>>> dm = run_fit(4222, 'posterior', 'asia_east+male+2005', fit_posterior, options,
+...              4222, 'asia_east', 'male', '2005')
+"""
+
+import dismod3.event_log as event_log
+import dismod3.timing as timing
+import dismod3.memory as memory
+
+def run_fit(id, estimate_type, task, f, options, *args, **kwargs):
+    """ Call f with args as the fit of task, and return what f returns
+
+    Parameters
+    ----------
+    id : int
+      The model id number of the fit
+    estimate_type : str
+      'empirical_priors', 'posterior', ..., which, with task, names the
+      event log, timing, profile and memory report of the fit
+    task : str
+      the rate type or region+sex+year of the fit
+    f : function
+      the fit, which returns the fitted DiseaseJson
+    options : optparse.Values
+      the options of the fit script, with ``memory`` and
+      ``memory_budget`` (and ``profile``, if it can be profiled)
+    log : bool, optional
+      keep the event log and the timing of the fit (a keyword argument)
+    """
+    log = kwargs.get('log', True)
+    if log:
+        event_log.open_log(id, estimate_type, task)
+    timing.reset()
+    mem_budget = memory.budget(options.memory_budget)
+    if options.memory or mem_budget:
+        memory.start(mem_budget)
+
+    dm = None
+    state = 'failed'
+    try:
+        try:
+            if getattr(options, 'profile', False):
+                import dismod3.profiling as profiling
+                dm = profiling.profile_fit(profiling.profile_fname(id, estimate_type, task), f, *args)
+            else:
+                dm = f(*args)
+            state = 'done'
+        except Exception:
+            import traceback
+            event_log.error(traceback.format_exc())
+            raise
+    finally:
+        if log:
+            timing.save(id, estimate_type, task)
+        if options.memory:
+            memory.save_report(memory.memory_fname(id, estimate_type, task), timing.phases(), dm)
+        memory.stop()
+        event_log.close_log(state)
+        timing.stop()
+    return dm
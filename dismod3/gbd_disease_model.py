@@ -3,12 +3,13 @@ import pymc as mc
 
 import dismod3
 from dismod3.utils import clean, gbd_keys, type_region_year_sex_from_key
+import dismod3.timing as timing
 
 import generic_disease_model as submodel
 import neg_binom_model as rate_model
 
 def fit(dm, method='map', keys=gbd_keys(), iter=50000, burn=25000, thin=1, verbose=1,
-        dbname='model.pickle'):
+        dbname='model.pickle', checkpoint=None, warm_start=False):
     """ Generate an estimate of the generic disease model parameters
     using maximum a posteriori liklihood (MAP) or Markov-chain Monte
     Carlo (MCMC)
@@ -32,6 +33,17 @@ def fit(dm, method='map', keys=gbd_keys(), iter=50000, burn=25000, thin=1, verbo
     thin : int, optional
       parameters for the MCMC, which control how long it takes, and
       how accurate it is
+
+    checkpoint : str, optional
+      a file to save the sampler state in periodically during MCMC;
+      if it already holds a checkpoint, sampling resumes from there
+      (see ``dismod3/checkpoint.py`` for details)
+
+    warm_start : bool, optional
+      for MAP, start from the values stored by an earlier fit of this
+      model (or the model it was copied from) when there are any, and
+      store the new MAP values for later fits (see
+      ``dismod3/warm_start.py`` for details)
     """
     if not hasattr(dm, 'vars'):
         print 'initializing model vars... ',
@@ -44,34 +56,54 @@ def fit(dm, method='map', keys=gbd_keys(), iter=50000, burn=25000, thin=1, verbo
         map_method = 'fmin_powell'
         #map_method = 'fmin_l_bfgs_b'
 
-        mc.MAP([dm.vars[k] for k in keys if k.find('incidence') != -1]).fit(method=map_method, iterlim=500, tol=.01, verbose=verbose)
-        mc.MAP([dm.vars[k] for k in keys if k.find('remission') != -1]).fit(method=map_method, iterlim=500, tol=.01, verbose=verbose)
-        mc.MAP([dm.vars[k] for k in keys if
-                k.find('excess-mortality') != -1 or
-                k.find('m') != -1 or
-                k.find('mortality') != -1 or
-                k.find('relative-risk') != -1 or
-                k.find('bins') != -1]).fit(method=map_method, iterlim=500, tol=.01, verbose=verbose)
-        mc.MAP([dm.vars[k] for k in keys if
-                k.find('incidence') != -1 or
-                k.find('bins') != -1 or
-                k.find('prevalence') != -1]).fit(method=map_method, iterlim=500, tol=.01, verbose=verbose)
-        mc.MAP([dm.vars[k] for k in keys if
-                k.find('excess-mortality') != -1 or
-                k.find('m') != -1 or
-                k.find('mortality') != -1 or
-                k.find('relative-risk') != -1 or
-                k.find('bins') != -1 or
-                k.find('prevalence') != -1]).fit(method=map_method, iterlim=500, tol=.01, verbose=verbose)
+        # a warm start from stored values makes the staged MAP
+        # sequence unnecessary
+        warm = False
+        if warm_start:
+            import dismod3.warm_start
+            warm = dismod3.warm_start.restore(dm, keys)
+
+        if not warm:
+            timing.phase_start('map stage 1')
+            mc.MAP([dm.vars[k] for k in keys if k.find('incidence') != -1]).fit(method=map_method, iterlim=500, tol=.01, verbose=verbose)
+            timing.phase_end('map stage 1')
+            timing.phase_start('map stage 2')
+            mc.MAP([dm.vars[k] for k in keys if k.find('remission') != -1]).fit(method=map_method, iterlim=500, tol=.01, verbose=verbose)
+            timing.phase_end('map stage 2')
+            timing.phase_start('map stage 3')
+            mc.MAP([dm.vars[k] for k in keys if
+                    k.find('excess-mortality') != -1 or
+                    k.find('m') != -1 or
+                    k.find('mortality') != -1 or
+                    k.find('relative-risk') != -1 or
+                    k.find('bins') != -1]).fit(method=map_method, iterlim=500, tol=.01, verbose=verbose)
+            timing.phase_end('map stage 3')
+            timing.phase_start('map stage 4')
+            mc.MAP([dm.vars[k] for k in keys if
+                    k.find('incidence') != -1 or
+                    k.find('bins') != -1 or
+                    k.find('prevalence') != -1]).fit(method=map_method, iterlim=500, tol=.01, verbose=verbose)
+            timing.phase_end('map stage 4')
+            timing.phase_start('map stage 5')
+            mc.MAP([dm.vars[k] for k in keys if
+                    k.find('excess-mortality') != -1 or
+                    k.find('m') != -1 or
+                    k.find('mortality') != -1 or
+                    k.find('relative-risk') != -1 or
+                    k.find('bins') != -1 or
+                    k.find('prevalence') != -1]).fit(method=map_method, iterlim=500, tol=.01, verbose=verbose)
+            timing.phase_end('map stage 5')
 
         dm.map = mc.MAP(dm.vars)
         print 'finished'
 
+        timing.phase_start('map final')
         try:
             dm.map.fit(method=map_method, iterlim=500, tol=.001, verbose=verbose)
         except KeyboardInterrupt:
             # if user cancels with cntl-c, save current values for "warm-start"
             pass
+        timing.phase_end('map final')
         
         for k in keys:
             try:
@@ -80,6 +112,9 @@ def fit(dm, method='map', keys=gbd_keys(), iter=50000, burn=25000, thin=1, verbo
             except KeyError:
                 pass
 
+        if warm_start:
+            dismod3.warm_start.save(dm, keys)
+
     if method == 'norm_approx':
         dm.na = mc.NormApprox(dm.vars, eps=.0001)
 
@@ -109,7 +144,13 @@ def fit(dm, method='map', keys=gbd_keys(), iter=50000, burn=25000, thin=1, verbo
         import sys
         mc.warnings.warn = sys.stdout.write
         
-        dm.mcmc = mc.MCMC(dm.vars, db='pickle', dbname=dbname)
+        state = None
+        if checkpoint:
+            import dismod3.checkpoint
+            state = dismod3.checkpoint.load(checkpoint)
+            dm.mcmc = mc.MCMC(dm.vars, db=dismod3.checkpoint.database(dbname, state), dbname=dbname)
+        else:
+            dm.mcmc = mc.MCMC(dm.vars, db='pickle', dbname=dbname)
         for k in keys:
             if 'dispersion_step_sd' in dm.vars[k]:
                 dm.mcmc.use_step_method(mc.Metropolis, dm.vars[k]['log_dispersion'],
@@ -118,8 +159,25 @@ def fit(dm, method='map', keys=gbd_keys(), iter=50000, burn=25000, thin=1, verbo
                 dm.mcmc.use_step_method(mc.AdaptiveMetropolis, dm.vars[k]['age_coeffs_mesh'],
                                         cov=dm.vars[k]['age_coeffs_mesh_step_cov'], verbose=0)
 
+        if state:
+            dismod3.checkpoint.restore(dm.mcmc, state)
+
+            # the MAP stage is skipped when resuming, so take its
+            # goodness-of-fit statistics from the checkpoint
+            if not hasattr(dm, 'map'):
+                dm.map = mc.MAP(dm.vars)
+                dm.map.AIC = state['extra'].get('AIC')
+                dm.map.BIC = state['extra'].get('BIC')
+
         try:
-            dm.mcmc.sample(iter=iter, thin=thin, burn=burn, verbose=verbose)
+            if checkpoint:
+                extra = {}
+                if hasattr(dm, 'map'):
+                    extra.update(AIC=getattr(dm.map, 'AIC', None), BIC=getattr(dm.map, 'BIC', None))
+                dismod3.checkpoint.sample(dm.mcmc, iter, burn, thin, checkpoint, state,
+                                          verbose=verbose, extra=extra)
+            else:
+                dm.mcmc.sample(iter=iter, thin=thin, burn=burn, verbose=verbose)
         except KeyboardInterrupt:
             # if user cancels with cntl-c, save current values for "warm-start"
             pass
@@ -128,12 +186,14 @@ def fit(dm, method='map', keys=gbd_keys(), iter=50000, burn=25000, thin=1, verbo
         for k in keys:
             t,r,y,s = type_region_year_sex_from_key(k)
             
+            timing.phase_start('summarize', k)
             if t in ['incidence', 'prevalence', 'remission', 'excess-mortality', 'mortality']:
                 import neg_binom_model
                 neg_binom_model.store_mcmc_fit(dm, k, dm.vars[k])
             elif t in ['relative-risk', 'duration', 'incidence_x_duration']:
                 import normal_model
                 normal_model.store_mcmc_fit(dm, k, dm.vars[k])
+            timing.phase_end('summarize', k)
 
 
 def setup(dm, keys):
@@ -169,9 +229,11 @@ def setup(dm, keys):
                     dm.set_units(key%t, '(per person-year)')
                     #dm.get_initial_estimate(key%t, [d for d in dm.data if relevant_to(d, t, r, y, s)])
 
+                timing.phase_start('setup', key % 'all')
                 data = [d for d in dm.data if relevant_to(d, 'all', r, y, s)]
                 sub_vars = submodel.setup(dm, key, data)
                 vars.update(sub_vars)
+                timing.phase_end('setup', key % 'all')
     
     return vars
 
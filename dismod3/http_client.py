@@ -0,0 +1,281 @@
+""" A persistent, authenticated session with the dismod data server
+
+The DismodSession logs in once, keeps the session cookie, and reuses
+one keep-alive connection for all of its requests.  It logs in again
+only if the server redirects a request to the login page (e.g. when
+the session expires).  Requests that fail with a connection error or
+a server error (5xx) are retried after an exponential backoff.
+
+The module-level session() returns the session shared by all the
+server functions in dismod3.disease_json.
+
+Example
+-------
+>>> from dismod3.http_client import session
+>>> session().get_json(DISMOD_LIST_JOBS_URL)
+[12, 15]
+>>> session().post_json(DISMOD_REMOVE_JOB_URL, {'id': 12})
+{u'dm_id': 4222, ...}
+"""
+
+import gzip
+import httplib
+import os
+import socket
+import random
+import time
+import urllib
+import urlparse
+from StringIO import StringIO
+
+import simplejson as json
+
+from dismod3.settings import DISMOD_LOGIN_URL, DISMOD_USERNAME, DISMOD_PASSWORD, \
+     DISMOD_HTTP_RETRIES, DISMOD_HTTP_BACKOFF
+from dismod3.utils import debug
+
+def gzip_str(s):
+    """ Return s compressed in gzip format"""
+    buf = StringIO()
+    f = gzip.GzipFile(fileobj=buf, mode='wb')
+    f.write(s)
+    f.close()
+    return buf.getvalue()
+
+class DismodServerError(Exception):
+    """ The dismod server could not be reached, or refused a request"""
+    def __init__(self, msg, status=None):
+        Exception.__init__(self, msg)
+        self.status = status
+
+# failures that are worth retrying
+RETRY_EXCEPTIONS = (socket.error, httplib.HTTPException)
+
+class DismodSession:
+    def __init__(self, login_url=DISMOD_LOGIN_URL, username=DISMOD_USERNAME, password=DISMOD_PASSWORD,
+                 retries=DISMOD_HTTP_RETRIES, backoff=DISMOD_HTTP_BACKOFF):
+        """
+        Parameters
+        ----------
+        login_url : str
+          the login page of the dismod server
+        username, password : str
+        retries : int, optional
+          the number of times to retry a request that fails
+        backoff : float, optional
+          the seconds to wait before the first retry; the wait doubles
+          (with random jitter) for each retry after that
+        """
+        self.login_url = login_url
+        self.username = username
+        self.password = password
+        self.retries = retries
+        self.backoff = backoff
+        self.cookies = {}
+        self.connection = None
+        self.logged_in = False
+        self.response_headers = {}
+
+    def connect(self, scheme, netloc):
+        if self.connection and self.connection_key == (scheme, netloc):
+            return self.connection
+        self.close()
+        if scheme == 'https':
+            self.connection = httplib.HTTPSConnection(netloc)
+        else:
+            self.connection = httplib.HTTPConnection(netloc)
+        self.connection_key = (scheme, netloc)
+        return self.connection
+
+    def close(self):
+        if self.connection:
+            self.connection.close()
+        self.connection = None
+
+    def store_cookies(self, response):
+        for header, val in response.getheaders():
+            if header.lower() != 'set-cookie':
+                continue
+            # Set-Cookie headers are joined with commas; the expiry
+            # dates of Django's cookies contain commas too, so only
+            # the pieces with an = before any ; are cookies
+            for cookie in val.split(','):
+                name_val = cookie.split(';')[0].strip()
+                if name_val.find('=') > 0:
+                    name, val = name_val.split('=', 1)
+                    self.cookies[name] = val
+
+    def send_once(self, scheme, netloc, method, path, body, headers):
+        try:
+            conn = self.connect(scheme, netloc)
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+            return response, response.read()
+        except RETRY_EXCEPTIONS:
+            self.close()
+            raise
+
+    def send(self, method, url, body=None, headers={}):
+        """ Make one request on the kept-alive connection, following
+        redirects
+
+        Results
+        -------
+        Returns the status, the final url, and the body of the response
+        """
+        for hop in range(5):
+            scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+            if query:
+                path += '?' + query
+
+            h = dict(headers)
+            if self.cookies:
+                h['Cookie'] = '; '.join(['%s=%s' % (k, v) for k, v in self.cookies.items()])
+            reused = self.connection != None
+            try:
+                response, content = self.send_once(scheme, netloc, method, path or '/', body, h)
+            except RETRY_EXCEPTIONS:
+                self.close()
+                if not reused:
+                    raise
+                # the server may have closed the idle connection, so try once more on a new one
+                response, content = self.send_once(scheme, netloc, method, path or '/', body, h)
+            self.store_cookies(response)
+            if response.getheader('connection', '').lower() == 'close':
+                self.close()
+
+            if response.status in [301, 302, 303, 307]:
+                url = urlparse.urljoin(url, response.getheader('location'))
+                method, body, headers = 'GET', None, {}
+                continue
+            self.response_headers = dict(response.getheaders())
+            return response.status, url, content
+
+        raise DismodServerError, 'too many redirects for %s' % url
+
+    def login(self):
+        """ Log in to the dismod server, through the django login form """
+        # the login page sets the test cookie the login form checks for
+        self.cookies = {}
+        self.send('GET', self.login_url)
+        form = urllib.urlencode({'username': self.username, 'password': self.password})
+        status, url, content = self.send('POST', self.login_url, form,
+                                         {'Content-Type': 'application/x-www-form-urlencoded'})
+        if url.find('accounts/profile') == -1:
+            raise DismodServerError, 'could not log in to %s as %s' % (self.login_url, self.username)
+        self.logged_in = True
+
+    def request(self, method, url, body=None, content_type=None, retries=None, headers={}):
+        """ Make an authenticated request, retrying on failure; see
+        fetch for the parameters
+
+        Results
+        -------
+        Returns the body of the response
+        """
+        return self.fetch(method, url, body, content_type, retries, headers)[2]
+
+    def fetch(self, method, url, body=None, content_type=None, retries=None, headers={}):
+        """ Make an authenticated request, retrying on failure
+
+        Parameters
+        ----------
+        method : str, 'GET' or 'POST'
+        url : str
+        body : str, optional
+        content_type : str, optional
+        retries : int, optional
+          override the number of retries for this request
+        headers : dict, optional
+          additional request headers
+
+        Results
+        -------
+        Returns the status, the headers (as a dict with lower case
+        names), and the body of the response
+        """
+        if retries == None:
+            retries = self.retries
+        headers = dict(headers)
+        if content_type:
+            headers['Content-Type'] = content_type
+
+        for ii in range(retries + 1):
+            try:
+                if not self.logged_in:
+                    self.login()
+                status, final_url, content = self.send(method, url, body, headers)
+
+                # the session has expired, so log in again and repeat
+                if final_url.startswith(self.login_url):
+                    self.login()
+                    status, final_url, content = self.send(method, url, body, headers)
+
+                if status < 400:
+                    return status, self.response_headers, content
+                if status < 500:
+                    raise DismodServerError('%s %s failed with status %d' % (method, url, status), status)
+                error = '%s %s failed with status %d' % (method, url, status)
+            except RETRY_EXCEPTIONS, e:
+                error = '%s %s failed: %s' % (method, url, e)
+
+            if ii < retries:
+                wait = self.backoff * 2**ii * (.5 + random.random())
+                debug('%s, retrying in %.0f seconds' % (error, wait))
+                time.sleep(wait)
+
+        raise DismodServerError, '%s (tried %d times)' % (error, retries + 1)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def get_json(self, url, **kwargs):
+        return json.loads(self.get(url, **kwargs))
+
+    def get_if_changed(self, url, etag=None, **kwargs):
+        """ GET url, unless it is unchanged since the response with the
+        given ETag
+
+        Results
+        -------
+        Returns the ETag and the body of the response, or the ETag
+        and None if the server answers 304 Not Modified
+        """
+        headers = dict(kwargs.pop('headers', {}))
+        if etag:
+            headers['If-None-Match'] = etag
+        status, response_headers, content = self.fetch('GET', url, headers=headers, **kwargs)
+        if status == 304:
+            return etag, None
+        return response_headers.get('etag'), content
+
+    def post_json(self, url, obj, compress=False, **kwargs):
+        """ POST obj (or a string that is already json) to url, and
+        return the decoded json response
+
+        If compress is True, the body is gzipped, and sent with
+        Content-Encoding: gzip
+        """
+        if not isinstance(obj, basestring):
+            obj = json.dumps(obj)
+        if compress:
+            obj = gzip_str(obj)
+            kwargs['headers'] = dict(kwargs.get('headers', {}), **{'Content-Encoding': 'gzip'})
+        return json.loads(self.request('POST', url, obj, 'application/json', **kwargs))
+
+    def post_form(self, url, fields, **kwargs):
+        """ POST a dict of form fields to url, and return the response"""
+        return self.request('POST', url, urllib.urlencode(fields),
+                            'application/x-www-form-urlencoded', **kwargs)
+
+_session = None
+_session_pid = None
+
+def session():
+    """ Return the DismodSession shared by this process (a forked child
+    gets a new one, since it must not use its parent's connection)"""
+    global _session, _session_pid
+    if _session == None or _session_pid != os.getpid():
+        _session = DismodSession()
+        _session_pid = os.getpid()
+    return _session
@@ -0,0 +1,124 @@
+""" Keep the leases on jobs claimed from the dismod server job queue
+
+A daemon that claims a job (with dismod3.claim_job) holds a lease on
+it for JOB_LEASE_SECS, and must renew the lease until the job is
+finished; if the daemon dies, the lease expires and the job goes back
+on the queue for another daemon to run.
+
+The LeaseKeeper renews the lease on one job from a background thread,
+for daemons that run a job to completion before claiming the next.
+The LeaseTracker renews the leases on all the jobs whose fits are
+running in an executor, and finishes each job when the last of its
+fits is done, for daemons that run many jobs at once.
+
+Example
+-------
+>>> from dismod3.job_lease import LeaseKeeper
+>>> job = dismod3.claim_job()
+>>> lease = LeaseKeeper(job['job_id'])
+>>> lease.start()
+>>> failed = fit_all.fit_all(job['dm_id'])
+>>> lease.stop()
+>>> dismod3.finish_job(job['job_id'], failed)
+"""
+
+import threading
+import time
+
+from dismod3.settings import JOB_LEASE_SECS
+from dismod3.utils import debug
+
+# renew leases when a third of their time has passed, so that a
+# renewal can fail and be retried before the lease expires
+RENEW_SECS = JOB_LEASE_SECS / 3.
+
+class LeaseKeeper(threading.Thread):
+    def __init__(self, job_id, renew_secs=RENEW_SECS):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.job_id = job_id
+        self.renew_secs = renew_secs
+        self.stopped = threading.Event()
+        self.held = True
+
+    def run(self):
+        from dismod3.disease_json import renew_job_lease
+        from dismod3.http_client import DismodSession
+
+        # the session of the main thread is not safe to share
+        s = DismodSession()
+        while not self.stopped.isSet():
+            self.stopped.wait(self.renew_secs)
+            if self.stopped.isSet():
+                break
+            try:
+                self.held = renew_job_lease(self.job_id, s)
+            except Exception, e:
+                debug('could not renew lease on job %d: %s' % (self.job_id, e))
+            if not self.held:
+                debug('lost lease on job %d' % self.job_id)
+                break
+        s.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+class LeaseTracker:
+    def __init__(self, executor, renew_secs=RENEW_SECS):
+        """
+        Parameters
+        ----------
+        executor : LocalExecutor or WorkerPool
+          the executor the fits of the jobs run in
+        renew_secs : float, optional
+          the time between renewals of the leases
+        """
+        self.executor = executor
+        self.renew_secs = renew_secs
+        self.jobs = {}
+        self.last_renewal = time.time()
+
+    def hold(self, job_id, prefix, timed=True):
+        """ Hold the lease on job_id until no fit whose name starts
+        with prefix is running or queued in the executor (see
+        dismod3.finish_job for timed)"""
+        self.jobs[job_id] = {'prefix': prefix, 'failed': False, 'timed': timed}
+
+    def poll(self):
+        """ Poll the executor, finish the jobs whose fits are all done,
+        and renew the leases on the rest when they are due
+
+        Results
+        -------
+        Returns the (name, returncode) pairs from the executor's poll
+        """
+        from dismod3.disease_json import renew_job_lease, finish_job
+
+        finished = self.executor.poll()
+        for name, returncode in finished:
+            for job in self.jobs.values():
+                if returncode != 0 and name.startswith(job['prefix']):
+                    job['failed'] = True
+
+        names = [name for name, state, secs in self.executor.status()]
+        for job_id, job in self.jobs.items():
+            if [n for n in names if n.startswith(job['prefix'])]:
+                continue
+            try:
+                finish_job(job_id, job['failed'], job['timed'])
+                del self.jobs[job_id]
+            except Exception, e:
+                debug('could not finish job %d: %s' % (job_id, e))
+
+        if self.jobs and time.time() - self.last_renewal > self.renew_secs:
+            self.last_renewal = time.time()
+            for job_id in self.jobs.keys():
+                try:
+                    if not renew_job_lease(job_id):
+                        debug('lost lease on job %d' % job_id)
+                        del self.jobs[job_id]
+                except Exception, e:
+                    debug('could not renew lease on job %d: %s' % (job_id, e))
+
+        return finished
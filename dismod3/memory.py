@@ -0,0 +1,226 @@
+""" Account for the memory a fit uses, and hold it to a budget
+
+A fit run with ``--memory`` samples the resident set size of its
+process every MEMORY_SAMPLE_SECS in a background thread, along with
+the number of open matplotlib figures.  When the fit is done, the
+samples are matched with the phases recorded by timing.py, to find
+the peak RSS of each phase and how much it grew during the phase, and
+the large objects still held by the model are measured: the MCMC
+traces (in bytes of their arrays), each entry of ``dm.params`` (in
+bytes of its json, which is also what is uploaded), and the open
+figures (in bytes of their pixel buffers).  The report is written as
+json to ``<JOB_WORKING_DIR>/<estimate_type>/memory/<task>.json``.
+
+If the fit has a memory budget (JOB_MEMORY_BUDGET, or
+``--memory-budget`` in MB), the RSS is checked against it at the
+start and end of each phase and after each MCMC checkpoint, and a fit
+that is over budget fails with MemoryBudgetExceeded, which says where
+it was, instead of being killed by the scheduler with no message.
+The check is only as frequent as the phases and checkpoints, so the
+budget should be set somewhat below the scheduler's limit.
+
+Example
+-------
+>>> import dismod3.memory as memory
+>>> memory.start(budget=4096 * 1024**2)
+>>> dm = fit_posterior.fit_posterior(4222, 'asia_east', 'male', '2005')
+>>> memory.stop()
+>>> print memory.report(memory.save(memory.memory_fname(4222, 'posterior', 'asia_east+male+2005'), timing.phases(), dm))
+"""
+
+import os
+import resource
+import sys
+import threading
+import time
+
+import numpy as np
+import simplejson as json
+
+from dismod3.settings import JOB_WORKING_DIR, MEMORY_SAMPLE_SECS, JOB_MEMORY_BUDGET
+from dismod3.utils import makedirs
+import dismod3.event_log as event_log
+
+class MemoryBudgetExceeded(MemoryError):
+    pass
+
+def rss():
+    """ Return the resident set size of this process now, in kilobytes
+    (or the peak so far, where /proc is not available)"""
+    try:
+        f = open('/proc/self/statm')
+        pages = int(f.read().split()[1])
+        f.close()
+        return pages * resource.getpagesize() / 1024
+    except (IOError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def memory_fname(id, estimate_type, task):
+    return '%s/%s/memory/%s.json' % (JOB_WORKING_DIR % int(id), estimate_type, task)
+
+def open_figures():
+    """ Return the open matplotlib figures (none if pylab has not been
+    loaded), without changing the current figure"""
+    helpers = sys.modules.get('matplotlib._pylab_helpers')
+    if not helpers:
+        return []
+    return [m.canvas.figure for m in helpers.Gcf.get_all_fig_managers()]
+
+class Sampler(threading.Thread):
+    def __init__(self, interval=MEMORY_SAMPLE_SECS, budget=None):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.interval = interval
+        self.budget = budget
+        self.samples = []
+        self.stopped = threading.Event()
+
+    def sample(self):
+        """ Record the time, the RSS (in kB) and the number of open figures"""
+        r = rss()
+        self.samples.append((time.time(), r, len(open_figures())))
+        return r
+
+    def run(self):
+        while not self.stopped.isSet():
+            self.sample()
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+
+    def check(self, where=''):
+        """ Raise MemoryBudgetExceeded if the RSS is over the budget"""
+        if not self.budget:
+            return
+        r = self.sample()
+        if r * 1024 > self.budget:
+            event_log.log('memory_budget_exceeded', rss=r, budget=self.budget, where=where)
+            raise MemoryBudgetExceeded, 'RSS of %d MB at %s is over the memory budget of %d MB' \
+                  % (r / 1024, where or 'this point', self.budget / 1024**2)
+
+    def peak(self):
+        return max([s[1] for s in self.samples] or [0])
+
+def by_phase(samples, phases):
+    """ Match RSS samples with the phases of a fit
+
+    Parameters
+    ----------
+    samples : list
+      (time, rss, figures) samples, as recorded by Sampler
+    phases : list
+      phase records, as recorded by timing.Timer
+
+    Results
+    -------
+    Returns a list of dicts, one for each phase record, with its phase
+    and key, peak RSS and RSS growth (in kB, from the last sample
+    before it started to the last sample before it ended), and the
+    most figures open during it, ranked by growth
+    """
+    def before(t):
+        earlier = [s for s in samples if s[0] <= t]
+        return earlier and earlier[-1] or None
+
+    samples = sorted(samples)  # the fit's own checks add samples between the sampler's
+    rows = []
+    for p in phases:
+        end = p['start'] + p['wall']
+        during = [s for s in samples if p['start'] <= s[0] <= end]
+        first, last = before(p['start']), before(end)
+        row = {'phase': p['phase'], 'key': p.get('key', ''),
+               'peak': max([s[1] for s in during] or [last and last[1] or 0]),
+               'growth': (first and last) and last[1] - first[1] or 0,
+               'figures': max([s[2] for s in during] or [0])}
+        rows.append(row)
+    rows.sort(key=lambda r: -r['growth'])
+    return rows
+
+def json_size(x):
+    try:
+        return len(json.dumps(x))
+    except TypeError:
+        return 0
+
+def object_sizes(dm=None):
+    """ Return a list of (kind, name, bytes) for the large objects held
+    by the model dm (its traces and params) and the open figures,
+    largest first"""
+    sizes = []
+    if dm is not None:
+        mcmc = getattr(dm, 'mcmc', None)
+        for name, trace in getattr(getattr(mcmc, 'db', None), '_traces', {}).items():
+            chains = getattr(trace, '_trace', {})
+            if isinstance(chains, dict):
+                chains = chains.values()
+            sizes.append(('trace', name, sum([np.asarray(c).nbytes for c in chains])))
+        for key, val in getattr(dm, 'params', {}).items():
+            sizes.append(('param', key, json_size(val)))
+    for fig in open_figures():
+        w, h = fig.get_size_inches()
+        sizes.append(('figure', str(fig.number), int(w * h * fig.dpi**2 * 4)))
+    sizes.sort(key=lambda s: -s[2])
+    return sizes
+
+def budget(mb=None):
+    """ Return a budget given in MB (e.g. on the command line) in
+    bytes, or JOB_MEMORY_BUDGET if none was given"""
+    if mb:
+        return mb * 1024**2
+    return JOB_MEMORY_BUDGET
+
+# the sampler of the fit running in this process, if it is accounting for its memory
+_sampler = None
+
+def start(budget=JOB_MEMORY_BUDGET, interval=MEMORY_SAMPLE_SECS):
+    """ Start sampling the RSS of this process (in a new sampler, e.g.
+    in a worker forked from a process that has sampled others)"""
+    global _sampler
+    stop()
+    _sampler = Sampler(interval, budget)
+    _sampler.start()
+    return _sampler
+
+def stop():
+    if _sampler:
+        _sampler.stop()
+
+def check(where=''):
+    if _sampler:
+        _sampler.check(where)
+
+def save(fname, phases, dm=None, n=50):
+    """ Write the samples, the RSS of each phase, and the n largest
+    objects of dm and the open figures to fname as json, and return
+    what was written"""
+    samples = _sampler and _sampler.samples or []
+    result = {'samples': samples,
+              'peak': _sampler and _sampler.peak() or rss(),
+              'budget': _sampler and _sampler.budget,
+              'phases': by_phase(samples, phases),
+              'objects': object_sizes(dm)[:n]}
+    makedirs(os.path.dirname(fname))
+    f = open(fname, 'w')
+    f.write(json.dumps(result))
+    f.close()
+    event_log.log('memory', peak_rss=result['peak'])
+    return result
+
+def report(result, n=20):
+    """ Return a table of the phases that grew the most, and the largest objects"""
+    lines = ['peak RSS %d MB' % (result['peak'] / 1024)]
+    if result.get('budget'):
+        lines[0] += ' (budget %d MB)' % (result['budget'] / 1024**2)
+    lines += ['', '%12s %12s %7s  %-15s %s' % ('growth (MB)', 'peak (MB)', 'figures', 'phase', 'key')]
+    for r in result['phases'][:n]:
+        lines.append('%12.1f %12.1f %7d  %-15s %s' % (r['growth'] / 1024., r['peak'] / 1024., r['figures'], r['phase'], r['key']))
+    lines += ['', '%12s  %-7s %s' % ('size (MB)', 'kind', 'name')]
+    for kind, name, bytes in result['objects'][:n]:
+        lines.append('%12.1f  %-7s %s' % (bytes / 1024.**2, kind, name))
+    return '\n'.join(lines)
+
+def save_report(fname, phases, dm=None):
+    """ Stop sampling, write the report of the fit to fname, and print it"""
+    stop()
+    print report(save(fname, phases, dm))
@@ -0,0 +1,305 @@
+""" Merge the results of the fits of a model, in parallel
+
+Each empirical prior fit and each posterior fit saves the params it
+changed to its own json file (a shard) in ``<JOB_WORKING_DIR>/json/``,
+and these are merged into the model before it is uploaded.  The
+shards of the empirical priors are merged first, and then those of
+the posteriors, so that a posterior's results always win.  Parsing
+the shards is most of the
+work, so merge_shards splits them among forked worker processes,
+which parse them and send the params of each back (pickled, which is
+much quicker to load than json) as soon as it is parsed.  The params
+of each shard are merged into the model as they arrive and then
+dropped, so the merging process holds the merged model, the shard it
+is merging and the pickles on their way, but never the json text of
+a shard or a second copy of its params.
+
+A shard that can not be read or parsed is not merged, and neither is
+a shard that does not exist; both are listed in the report that
+merge_shards returns, with the reason.
+
+Shards are written by write_shard (which DiseaseJson.save uses) to a
+temporary file that is renamed into place, so a reader never sees a
+partial shard, and a fit that crashes while saving leaves the last
+complete one.  Next to the shards, ``json/manifest/<shard>`` records
+the sha1 checksum, size and keys of each shard as it was written;
+a shard that does not match its manifest entry (e.g. one truncated
+or replaced by something other than write_shard) is reported as
+corrupt instead of being merged.  While a shard is replaced, its
+manifest entry accepts the checksums of both the old and the new
+shard, so a merge at that moment, or a crash, never finds a complete
+shard that does not match.  Each shard has its own manifest
+entry, so fits saving at once never write the same file, and saving
+a shard that is unchanged since it was last written does nothing.
+
+Example
+-------
+>>> import dismod3.merge as merge
+>>> dm = dismod3.disease_json.DiseaseJson(open('dm-4222.json').read())
+>>> report = merge.merge_shards(dm, merge.expected_posteriors(4222, ['asia_east']))
+>>> print merge.report_str(report)
+"""
+
+import cPickle
+import hashlib
+import os
+import select
+import time
+import traceback
+
+import simplejson as json
+
+from dismod3.settings import JOB_WORKING_DIR, MERGE_WORKERS, gbd_regions, gbd_sexes, gbd_years
+from dismod3.utils import clean, debug, makedirs, write_atomically
+
+def posterior_fname(id, region, sex, year):
+    return '%s/json/dm-%d-posterior-%s-%s-%s.json' % (JOB_WORKING_DIR % id, id, region, sex, year)
+
+def is_prior_shard(fname):
+    """ Return True if fname is the shard of an empirical prior fit
+    (named dm-<id>-prior-<type>.json by fit_emp_prior.py)"""
+    return os.path.basename(fname).find('-prior-') != -1
+
+def expected_posteriors(id, regions=gbd_regions):
+    """ Return the names of the shards of the posterior fits of every
+    sex and year of regions"""
+    return [posterior_fname(id, clean(r), s, y) for r in regions for s in gbd_sexes for y in gbd_years]
+
+def merge_params(params, more):
+    """ Merge the params dict more into params: the entries of a dict
+    valued param are added to (or replace) those of the same param
+    in params, and other params are replaced"""
+    for key, val in more.items():
+        if isinstance(val, dict):
+            if not key in params:
+                params[key] = {}
+            params[key].update(val)
+        else:
+            params[key] = val
+
+def manifest_fname(fname):
+    """ Return the name of the manifest entry of the shard fname"""
+    dir, name = os.path.split(fname)
+    return os.path.join(dir, 'manifest', name)
+
+def read_manifest_entry(fname):
+    """ Return the manifest entry of the shard fname, or None if it has none"""
+    try:
+        f = open(manifest_fname(fname))
+        try:
+            return json.loads(f.read())
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return None
+
+def file_sha1(fname):
+    """ Return the sha1 checksum of the file fname, or None if it can not be read"""
+    try:
+        f = open(fname)
+        try:
+            return hashlib.sha1(f.read()).hexdigest()
+        finally:
+            f.close()
+    except IOError:
+        return None
+
+def write_manifest_entry(fname, sha1, size, keys=[], previous=None):
+    """ Record the checksum, size and keys of the shard fname in the
+    manifest, and also accept the checksum previous, if given"""
+    entry = {'sha1': sha1, 'size': size, 'keys': list(keys), 'saved': time.time()}
+    if previous:
+        entry['previous'] = previous
+    makedirs(os.path.dirname(manifest_fname(fname)))
+    write_atomically(manifest_fname(fname), json.dumps(entry))
+
+def write_shard(fname, s, keys=[]):
+    """ Write the json string s to the shard fname, and record it in
+    the manifest, unless the shard already holds s
+
+    Results
+    -------
+    Returns True if the shard was written, and False if it was unchanged
+    """
+    sha1 = hashlib.sha1(s).hexdigest()
+    entry = read_manifest_entry(fname)
+    if entry and entry.get('sha1') == sha1 and file_sha1(fname) == sha1:
+        return False
+
+    # accept the old shard and the new one until the new one is in place
+    if entry and entry.get('sha1'):
+        write_manifest_entry(fname, sha1, len(s), keys, previous=entry['sha1'])
+    write_atomically(fname, s)
+    write_manifest_entry(fname, sha1, len(s), keys)
+    return True
+
+def parse_shard(fname):
+    """ Return (fname, params, None) for a shard that parses and
+    matches its manifest entry (if it has one), and (fname, None,
+    error) for one that does not"""
+    try:
+        f = open(fname)
+        try:
+            s = f.read()
+        finally:
+            f.close()
+        entry = read_manifest_entry(fname)
+        if entry and not hashlib.sha1(s).hexdigest() in [entry.get('sha1'), entry.get('previous')]:
+            raise ValueError, 'checksum does not match the manifest (%d bytes, %d expected)' % (len(s), entry.get('size', 0))
+        params = json.loads(s)['params']
+        if not isinstance(params, dict):
+            raise ValueError, 'params is not a dict'
+        return fname, params, None
+    except (IOError, ValueError, KeyError, TypeError), e:
+        return fname, None, '%s: %s' % (e.__class__.__name__, e)
+
+def write_message(fd, obj):
+    """ Write obj to the pipe fd, pickled, after a line giving its length"""
+    s = cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
+    s = '%d\n%s' % (len(s), s)
+    while s:
+        n = os.write(fd, s)
+        s = s[n:]
+
+class MessageReader:
+    """ Collect the messages written to a pipe by write_message, from
+    the chunks read from it"""
+    def __init__(self):
+        self.chunks = []
+        self.have = 0
+        self.size = None
+
+    def feed(self, chunk):
+        """ Add a chunk, and return the messages it completes"""
+        self.chunks.append(chunk)
+        self.have += len(chunk)
+        messages = []
+        while True:
+            if self.size is None:
+                buf = ''.join(self.chunks)
+                n = buf.find('\n')
+                if n == -1:
+                    self.chunks = [buf]
+                    break
+                self.size = int(buf[:n])
+                self.chunks = [buf[n+1:]]
+                self.have = len(buf) - n - 1
+            if self.have < self.size:
+                break
+            buf = ''.join(self.chunks)
+            messages.append(cPickle.loads(buf[:self.size]))
+            self.chunks = [buf[self.size:]]
+            self.have = len(buf) - self.size
+            self.size = None
+        return messages
+
+def parsed_shards(fnames, workers):
+    """ Parse the shards fnames in workers forked processes, and
+    return an iterator over what parse_shard returns for each, in the
+    order they are parsed"""
+    if workers <= 1 or len(fnames) <= 1:
+        for fname in fnames:
+            yield parse_shard(fname)
+        return
+
+    readers = {}
+    pids = []
+    for ii in range(workers):
+        share = fnames[ii::workers]
+        if not share:
+            continue
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # the worker: parse its share of the shards, and send each back
+            status = 0
+            try:
+                try:
+                    os.close(r)
+                    for fname in share:
+                        write_message(w, parse_shard(fname))
+                except:
+                    traceback.print_exc()
+                    status = 1
+            finally:
+                os._exit(status)
+        os.close(w)
+        readers[r] = MessageReader()
+        pids.append(pid)
+
+    while readers:
+        for fd in select.select(readers.keys(), [], [])[0]:
+            chunk = os.read(fd, 1 << 20)
+            if not chunk:
+                os.close(fd)
+                del readers[fd]
+                continue
+            for message in readers[fd].feed(chunk):
+                yield message
+
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+def merge_shards(dm, fnames, workers=MERGE_WORKERS):
+    """ Merge the params of the shards fnames into dm
+
+    Parameters
+    ----------
+    dm : DiseaseJson
+    fnames : list of str
+      the json files to merge; the shards of the empirical priors are
+      merged first, and then the rest, each group in the order its
+      shards are parsed (the shards of a group set different entries,
+      since each fit saves only the keys it fit); files that do not
+      exist are reported as missing
+    workers : int, optional
+      the number of processes to parse the shards in; defaults to the
+      number of cores
+
+    Results
+    -------
+    Returns a report, a dict with the shards that were ``merged``, the
+    ones that were ``missing``, and the ones that were ``corrupt``, as
+    (fname, error) pairs
+    """
+    from dismod3.executor import cpu_count
+    workers = workers or cpu_count()
+
+    report = {'merged': [], 'missing': [], 'corrupt': []}
+    present = []
+    for fname in fnames:
+        if os.path.exists(fname):
+            present.append(fname)
+        else:
+            report['missing'].append(fname)
+
+    parsed = set()
+    priors = [fname for fname in present if is_prior_shard(fname)]
+    rest = [fname for fname in present if not is_prior_shard(fname)]
+    for group in [priors, rest]:
+        for fname, params, error in parsed_shards(group, workers):
+            parsed.add(fname)
+            if error:
+                debug('failed to merge in %s (%s)' % (fname, error))
+                report['corrupt'].append((fname, error))
+            else:
+                debug('merging %s' % fname)
+                merge_params(dm.params, params)
+                report['merged'].append(fname)
+            del params
+
+    # shards a worker never sent back (e.g. the worker was killed)
+    for fname in present:
+        if not fname in parsed:
+            report['corrupt'].append((fname, 'not parsed (the worker parsing it failed)'))
+    return report
+
+def report_str(report):
+    """ Return a summary of a merge report, listing the missing and corrupt shards"""
+    lines = ['merged %d shards, %d missing, %d corrupt'
+             % (len(report['merged']), len(report['missing']), len(report['corrupt']))]
+    for fname in report['missing']:
+        lines.append('  missing: %s' % fname)
+    for fname, error in report['corrupt']:
+        lines.append('  corrupt: %s (%s)' % (fname, error))
+    return '\n'.join(lines)
@@ -0,0 +1,121 @@
+""" Node-local cache of disease models fetched from the dismod server
+
+Every fit job fetches the model it fits, and the posterior fits also
+fetch the all-cause mortality model, so the dozens of jobs of one fit
+running on a node download and parse the same json over and over.
+
+This module keeps one copy of each fetched model under
+``MODEL_CACHE_DIR``, as a pickled DiseaseJson in a file named by the
+ETag the server sent with it, so that loading it needs no json
+parsing.  The index file ``<id>.json`` records the ETag of the
+current copy of model id.  Models can be edited at any time, so a
+cached copy is revalidated on every fetch with a conditional GET,
+which the server answers with 304 Not Modified if the model has not
+changed; the fits never start from a stale copy.  The models in
+``MODEL_CACHE_STATIC_IDS`` (all-cause mortality) never change, and
+are never revalidated.
+
+A lock file for each model id ensures that, when many jobs start at
+once, only one of them downloads the model, and the rest wait for it
+and then use its copy.
+
+Example
+-------
+>>> import dismod3.model_cache as model_cache
+>>> dm = model_cache.fetch(4222)
+>>> mort = model_cache.fetch('all-cause_mortality')
+"""
+
+import cPickle
+import fcntl
+import hashlib
+import os
+
+import simplejson as json
+
+from dismod3.settings import DISMOD_DOWNLOAD_URL, MODEL_CACHE_DIR, MODEL_CACHE_STATIC_IDS
+from dismod3.utils import debug, makedirs, write_atomically
+import dismod3.timing as timing
+
+def index_fname(id):
+    return '%s/%s.json' % (MODEL_CACHE_DIR, id)
+
+def content_fname(etag):
+    return '%s/%s.pickle' % (MODEL_CACHE_DIR, hashlib.md5(etag).hexdigest())
+
+def read_index(id):
+    try:
+        f = open(index_fname(id))
+        index = json.loads(f.read())
+        f.close()
+        return index
+    except (IOError, ValueError):
+        return {}
+
+def load(etag):
+    """ Return the cached DiseaseJson with the given ETag, or None"""
+    try:
+        f = open(content_fname(etag), 'rb')
+        dm = cPickle.load(f)
+        f.close()
+        return dm
+    except (IOError, EOFError, cPickle.UnpicklingError):
+        return None
+
+def is_static(id):
+    return str(id) in [str(static_id) for static_id in MODEL_CACHE_STATIC_IDS]
+
+def fetch(id):
+    """ Return the DiseaseJson of model id, from the cache if the
+    server says the cached copy is current (or the model is static),
+    and from the dismod server if not
+
+    Each call returns a new DiseaseJson, which the caller is free
+    to change.
+    """
+    from dismod3.disease_json import DiseaseJson
+    from dismod3.http_client import session
+
+    makedirs(MODEL_CACHE_DIR)
+
+    lock = open(index_fname(id) + '.lock', 'w')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    try:
+        index = read_index(id)
+        dm = None
+        if index.get('etag'):
+            dm = load(index['etag'])
+        if dm and is_static(id):
+            debug('using cached copy of model %s' % id)
+            return dm
+
+        timing.phase_start('fetch', str(id))
+        etag, content = session().get_if_changed(DISMOD_DOWNLOAD_URL % id, dm and index['etag'])
+        timing.phase_end('fetch', str(id))
+        if content == None:
+            debug('cached copy of model %s is current' % id)
+        else:
+            timing.phase_start('parse', str(id))
+            dm = DiseaseJson(content)
+            timing.phase_end('parse', str(id))
+            if etag:
+                write_atomically(content_fname(etag), cPickle.dumps(dm, cPickle.HIGHEST_PROTOCOL))
+                if index.get('etag') and index['etag'] != etag:
+                    try:
+                        os.remove(content_fname(index['etag']))
+                    except OSError:
+                        pass
+
+        if etag:
+            write_atomically(index_fname(id), json.dumps({'etag': etag}))
+        return dm
+    finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+
+def clear():
+    """ Remove all cached models"""
+    if not os.path.exists(MODEL_CACHE_DIR):
+        return
+    for fname in os.listdir(MODEL_CACHE_DIR):
+        os.remove('%s/%s' % (MODEL_CACHE_DIR, fname))
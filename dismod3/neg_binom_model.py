@@ -22,6 +22,7 @@ import sys
 import dismod3
 from dismod3.utils import debug, interpolate, rate_for_range, indices_for_range, generate_prior_potentials, gbd_regions, clean, type_region_year_sex_from_key, standardize_data_type
 from dismod3.settings import MISSING, NEARLY_ZERO, MAX_AGE
+import dismod3.timing as timing
 
 def fit_emp_prior(dm, param_type, iter=30000, thin=20, burn=10000, dbname='/dev/null'):
     """ Generate an empirical prior distribution for a single disease parameter
@@ -53,10 +54,12 @@ def fit_emp_prior(dm, param_type, iter=30000, thin=20, burn=10000, dbname='/dev/
         lower_bound_data = [d for d in dm.data if d['data_type'] == 'cause-specific mortality data']
         dm.calc_effective_sample_size(lower_bound_data)
                         
+    timing.phase_start('setup', param_type)
     dm.clear_empirical_prior()
     dm.fit_initial_estimate(param_type, data)
 
     dm.vars = setup(dm, param_type, data, lower_bound_data=lower_bound_data)
+    timing.phase_end('setup', param_type)
 
     # don't do anything if there is no data for this parameter type
     if len(dm.vars['data']) == 0:
@@ -75,10 +78,12 @@ def fit_emp_prior(dm, param_type, iter=30000, thin=20, burn=10000, dbname='/dev/
     dm.map = mc.MAP(dm.vars)
     dm.vars.update(log_dispersion=log_dispersion)
     
+    timing.phase_start('map', param_type)
     try:
         dm.map.fit(method='fmin_powell', iterlim=500, verbose=1)
     except KeyboardInterrupt:
         debug('User halted optimization routine before optimal value found')
+    timing.phase_end('map', param_type)
     sys.stdout.flush()
 
     # make pymc warnings go to stdout
@@ -88,9 +93,12 @@ def fit_emp_prior(dm, param_type, iter=30000, thin=20, burn=10000, dbname='/dev/
                             proposal_sd=dm.vars['dispersion_step_sd'])
     dm.mcmc.use_step_method(mc.AdaptiveMetropolis, dm.vars['age_coeffs_mesh'],
                             cov=dm.vars['age_coeffs_mesh_step_cov'], verbose=0)
+    timing.phase_start('mcmc', param_type)
     dm.mcmc.sample(iter=iter, burn=burn, thin=thin, verbose=1)
     dm.mcmc.db.commit()
+    timing.phase_end('mcmc', param_type)
     
+    timing.phase_start('summarize', param_type)
     dm.vars['region_coeffs'].value = dm.vars['region_coeffs'].stats()['mean']
     dm.vars['study_coeffs'].value = dm.vars['study_coeffs'].stats()['mean']
     dm.vars['age_coeffs_mesh'].value = dm.vars['age_coeffs_mesh'].stats()['mean']
@@ -160,6 +168,7 @@ def fit_emp_prior(dm, param_type, iter=30000, thin=20, burn=10000, dbname='/dev/
                 rate_trace = np.sort(rate_trace, axis=0)
                 dm.set_mcmc('emp_prior_upper_ui', key, dismod3.utils.interpolate(param_mesh, rate_trace[.975 * len(rate_trace), :][param_mesh], age_mesh))
                 dm.set_mcmc('emp_prior_lower_ui', key, dismod3.utils.interpolate(param_mesh, rate_trace[.025 * len(rate_trace), :][param_mesh], age_mesh))
+    timing.phase_end('summarize', param_type)
 
 def store_mcmc_fit(dm, key, model_vars):
     """ Store the parameter estimates generated by an MCMC fit of the
@@ -185,13 +194,13 @@ def store_mcmc_fit(dm, key, model_vars):
     rate_trace = []
 
     if isinstance(model_vars['region_coeffs'], mc.Stochastic) and isinstance(model_vars['study_coeffs'], mc.Stochastic):
-        for alpha, beta, gamma in zip(model_vars['region_coeffs'].trace(), model_vars['study_coeffs'].trace(), model_vars['age_coeffs'].trace()):
+        for alpha, beta, gamma in zip(model_vars['region_coeffs'].trace(chain=None), model_vars['study_coeffs'].trace(chain=None), model_vars['age_coeffs'].trace(chain=None)):
             mu = predict_region_rate(key, alpha, beta, gamma, covariates_dict, model_vars['bounds_func'], dm.get_estimate_age_mesh())
             rate_trace.append(mu)
     else:
         alpha = model_vars['region_coeffs']
         beta = model_vars['study_coeffs']
-        for gamma in model_vars['age_coeffs'].trace():
+        for gamma in model_vars['age_coeffs'].trace(chain=None):
             mu = predict_region_rate(key, alpha, beta, gamma, covariates_dict, model_vars['bounds_func'], dm.get_estimate_age_mesh())
             rate_trace.append(mu)
 
@@ -264,17 +273,24 @@ def covariates(d, covariates_dict):
     return Xa, Xb
 
 
-from dismod3.utils import clean
+from dismod3.utils import clean, LazyDict
 import csv
 import settings
-countries_for = dict(
-    [[clean(x[0]), x[1:]] for x in csv.reader(open(settings.CSV_PATH + 'country_region.csv'))]
-    )
-population_by_age = dict(
-    [[(d['Country Code'], d['Year'], d['Sex']),
-      [max(.001,float(d['Age %d Population' % i])) for i in range(MAX_AGE)]] for d in csv.DictReader(open(settings.CSV_PATH + 'population.csv'))
-     if len(d['Country Code']) == 3]
-    )
+
+# the geography and population tables are read from csv the first time they are used
+def load_countries_for():
+    return dict(
+        [[clean(x[0]), x[1:]] for x in csv.reader(open(settings.CSV_PATH + 'country_region.csv'))]
+        )
+countries_for = LazyDict(load_countries_for)
+
+def load_population_by_age():
+    return dict(
+        [[(d['Country Code'], d['Year'], d['Sex']),
+          [max(.001,float(d['Age %d Population' % i])) for i in range(MAX_AGE)]] for d in csv.DictReader(open(settings.CSV_PATH + 'population.csv'))
+         if len(d['Country Code']) == 3]
+        )
+population_by_age = LazyDict(load_population_by_age)
 
 def regional_population(key):
     """ calculate regional population for a gbd key"""
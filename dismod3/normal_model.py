@@ -103,7 +103,7 @@ def store_mcmc_fit(dm, key, model_vars):
     Save a sketch of the distribution of rate_stoch keyed by key.
     """
 
-    rate_trace = model_vars['rate_stoch'].trace()
+    rate_trace = model_vars['rate_stoch'].trace(chain=None)
     rate_trace = np.sort(rate_trace, axis=0)
 
     rate = {}
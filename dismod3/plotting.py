@@ -362,7 +362,7 @@ def tile_plot_disease_model(dm_json, keys, defaults={}):
         plot_empirical_prior(dm, k, color=color_for.get(type, 'black'))
         if region == 'all':
             if dm.params.has_key('empirical_prior_%s' % type):
-                emp_prior_effects = json.loads(dm.params['empirical_prior_%s' % type])
+                emp_prior_effects = dm.get_empirical_prior(type)
                 alpha = np.array(emp_prior_effects['alpha'])
                 beta = np.array(emp_prior_effects['beta'])
                 gamma = np.array(emp_prior_effects['gamma'])
@@ -637,7 +637,7 @@ def plot_empirical_prior_effects(dm_list, effect, **params):
                 # TODO: mix color with something to indicate different models
                 #color = mix(color, pl.cm.spectral(ii/dm_len))
                 
-                emp_p = json.loads(dm.params.get(k, '{}'))
+                emp_p = dm.get_empirical_prior(t)
                 val = emp_p.get(effect)
                 se = emp_p.get('sigma_%s'%effect)
 
@@ -679,7 +679,7 @@ def plot_empirical_prior_effects(dm_list, effect, **params):
                 # TODO: mix color with something to indicate different models
                 #color = mix(color, pl.cm.spectral(ii/dm_len))
                 
-                emp_p = json.loads(dm.params.get(k, '{}'))
+                emp_p = dm.get_empirical_prior(t)
                 val = emp_p.get(effect)
                 se = emp_p.get('sigma_%s'%effect)
 
@@ -729,7 +729,7 @@ def plot_empirical_prior_effects(dm_list, effect, **params):
                 color = pl.cm.spectral(ii/dm_len)
 
                 if dm.params.has_key(k):
-                    emp_p = json.loads(dm.params[k])
+                    emp_p = dm.get_empirical_prior(t)
                     val = emp_p.get(effect)
                     se = emp_p.get('sigma_%s'%effect)
                 else:
@@ -826,9 +826,9 @@ def plot_intervals(dm, data, print_sample_size=False, **params):
             pl.text(.5*(d['age_start']+d['age_end']), val, d.get('effective_sample_size', ''), fontsize=6, horizontalalignment='center', verticalalignment='center')
 
 def plot_fit(dm, fit_name, key, **params):
-    fit = dm.params.get(fit_name, {}).get(key)
+    fit = dm.get_estimate(fit_name, key)
     age = dm.get_estimate_age_mesh()
-    if fit and age:
+    if len(fit) > 0 and age:
         pl.plot(age, fit, **params)
 
 def plot_initial_estimate(dm, type, **params):
@@ -931,7 +931,7 @@ def plot_posterior_predicted_checks(dm, key):
         return
     
     n = len(vars['observed_counts'].value)
-    k = len(vars['predicted_rates'].trace())
+    k = len(vars['predicted_rates'].trace(chain=None))
 
 
     pl.figure(figsize=(max(6, .75*n), 8))
@@ -947,12 +947,12 @@ def plot_posterior_predicted_checks(dm, key):
 
     pl.plot([-1], [-1], 'go', mew=0, ms=10, label='Data Predicted Rate')
     pl.plot((pl.outer(pl.ones(k), range(n)) + pl.randn(k, n)*.1).flatten(),
-            vars['predicted_rates'].trace()[:, sorted_indices].flatten(),
+            vars['predicted_rates'].trace(chain=None)[:, sorted_indices].flatten(),
             'g.', alpha=.5)
 
     pl.plot([-1], [-1], 'bo', mew=0, ms=10, label='Expected Rate')
     pl.plot((pl.outer(pl.ones(k), range(n)) + pl.randn(k, n)*.05).flatten(),
-            vars['expected_rates'].trace()[:, sorted_indices].flatten(),
+            vars['expected_rates'].trace(chain=None)[:, sorted_indices].flatten(),
             'b.', alpha=.5)
 
     pl.plot([-1], [-1], 'ro', mew=0, ms=10, label='Observed Rate')
@@ -986,7 +986,7 @@ def plot_posterior_predicted_checks(dm, key):
     
     for ii, jj in enumerate(sorted_indices):
         pl.axes([.1 + ii*dx, .1, dx, .2])
-        x = vars['expected_rates'].trace()[:, jj]
+        x = vars['expected_rates'].trace(chain=None)[:, jj]
         pl.acorr(x, normed=True, detrend=pl.mlab.detrend_mean, usevlines=True, maxlags=20,)
         pl.xticks([])
         pl.yticks([])
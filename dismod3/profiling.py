@@ -0,0 +1,179 @@
+""" Profile a fit, and find which nodes of the model are expensive
+
+A cProfile of a fit shows that most of the time goes into the logp
+and value functions of PyMC nodes, but not which nodes.  This module
+does both: profile_call runs a fit under cProfile, and profile_nodes
+takes MCMC steps in the fitted model and times the logp function of
+every stochastic and potential and the value function of every
+deterministic at each step.  The nodes are labelled with the key and
+the name they have in dm.vars (for example the ``rate_stoch``,
+``age_coeffs_potential`` or ``observed_counts`` of one
+type/region/year/sex), and report() ranks them by total time.
+
+The fit scripts do both when run with ``--profile``, and write the
+cProfile dump and the report to
+``<JOB_WORKING_DIR>/<estimate_type>/profile/<task>.prof`` and
+``<task>.txt``.
+
+Example
+-------
+>>> import dismod3.profiling as profiling
+>>> dm = profiling.profile_call('fit.prof', fit_posterior.fit_posterior, 4222, 'asia_east', 'male', '2005')
+>>> print profiling.report(profiling.profile_nodes(dm.vars, dm.mcmc), n=20)
+"""
+
+import cProfile
+import os
+import time
+
+import pymc as mc
+
+from dismod3.settings import JOB_WORKING_DIR, PROFILE_NODE_STEPS
+from dismod3.utils import makedirs
+
+def profile_fname(id, estimate_type, task):
+    """ Return the name of the profile files of a fit, without the extension"""
+    return '%s/%s/profile/%s' % (JOB_WORKING_DIR % int(id), estimate_type, task)
+
+def profile_call(fname, f, *args, **kwargs):
+    """ Call f with args and kwargs under cProfile, write the profile
+    to fname (for reading with pstats), and return what f returns"""
+    makedirs(os.path.dirname(fname))
+    prof = cProfile.Profile()
+    try:
+        return prof.runcall(f, *args, **kwargs)
+    finally:
+        prof.dump_stats(fname)
+
+def is_node(x):
+    return isinstance(x, (mc.Stochastic, mc.Deterministic, mc.Potential))
+
+def labelled_nodes(vars):
+    """ Return a list of (key, name, node) for the PyMC nodes in vars
+
+    Parameters
+    ----------
+    vars : dict
+      the vars of a model, either keyed by gbd key, with a dict of
+      named nodes for each key (as in gbd_disease_model.setup), or a
+      dict of named nodes for a single key (as in
+      neg_binom_model.setup)
+    """
+    if [v for v in vars.values() if isinstance(v, dict)]:
+        keyed = vars.items()
+    else:
+        keyed = [('', vars)]
+
+    found = set()
+    labelled = []
+    def add(key, name, x):
+        if is_node(x):
+            if not id(x) in found:
+                found.add(id(x))
+                labelled.append((key, name, x))
+        elif isinstance(x, (list, tuple)):
+            for y in x:
+                add(key, name, y)
+        elif isinstance(x, dict):
+            for y in x.values():
+                add(key, name, y)
+
+    for key, named in sorted(keyed):
+        if isinstance(named, dict):
+            for name, x in sorted(named.items()):
+                add(key, name, x)
+        else:
+            add(key, '', named)  # e.g. the with-condition mortality of gbd_disease_model
+    return labelled
+
+def kind(node):
+    if isinstance(node, mc.Stochastic):
+        return 'stochastic'
+    elif isinstance(node, mc.Deterministic):
+        return 'deterministic'
+    return 'potential'
+
+def node_function(node):
+    """ Return the logp function of a stochastic or potential, or the
+    value function of a deterministic, with the current values of its
+    parents bound, so that calling it recomputes the node without
+    going through PyMC's cache"""
+    parents = node.parents.value
+    if isinstance(node, mc.Stochastic):
+        value = node.value
+        return lambda: node._logp_fun(value=value, **parents)
+    elif isinstance(node, mc.Deterministic):
+        return lambda: node._eval_fun(**parents)
+    else:
+        return lambda: node._logp_fun(**parents)
+
+def profile_nodes(vars, mcmc, steps=PROFILE_NODE_STEPS):
+    """ Time every node of a model over a sample of MCMC steps
+
+    Parameters
+    ----------
+    vars : dict
+      the vars of the model (see labelled_nodes)
+    mcmc : pymc.MCMC
+      the sampler of the model; its stochastics are returned to their
+      current values afterwards
+    steps : int, optional
+      the number of MCMC steps to time the nodes at
+
+    Results
+    -------
+    Returns a list of dicts, one for each node, with its key, name,
+    node name, kind, and total seconds and number of calls, ranked by
+    total seconds
+    """
+    labelled = labelled_nodes(vars)
+    secs = [0.] * len(labelled)
+    saved = dict([[s, s.value] for s in mcmc.stochastics])
+    try:
+        for ii in range(steps):
+            for sm in mcmc.step_methods:
+                sm.step()
+            for jj, (key, name, node) in enumerate(labelled):
+                f = node_function(node)
+                start = time.time()
+                f()
+                secs[jj] += time.time() - start
+    finally:
+        for s, val in saved.items():
+            s.value = val
+
+    rows = []
+    for (key, name, node), t in zip(labelled, secs):
+        rows.append({'key': key, 'name': name, 'node': node.__name__,
+                     'kind': kind(node), 'secs': t, 'calls': steps})
+    rows.sort(key=lambda r: -r['secs'])
+    return rows
+
+def report(rows, n=None):
+    """ Return a table of the n most expensive nodes (all of them if
+    n is None), with their share of the time of all nodes"""
+    total = sum([r['secs'] for r in rows]) or 1.
+    lines = ['%10s %10s %7s  %-13s %-40s %-20s %s' % ('total (s)', 'call (ms)', 'share', 'kind', 'key', 'name', 'node')]
+    for r in rows[:n]:
+        lines.append('%10.4f %10.4f %6.1f%%  %-13s %-40s %-20s %s'
+                     % (r['secs'], 1000. * r['secs'] / max(r['calls'], 1), 100. * r['secs'] / total,
+                        r['kind'], r['key'], r['name'], r['node']))
+    return '\n'.join(lines)
+
+def profile_fit(fname, f, *args, **kwargs):
+    """ Run a fit under cProfile, then time the nodes of the fitted
+    model, and write the profile to fname.prof and the report of the
+    nodes to fname.txt
+
+    f must return the fitted DiseaseJson (with its vars and mcmc);
+    if it returns nothing or a model without an MCMC fit, there is
+    only the cProfile dump.
+    """
+    dm = profile_call(fname + '.prof', f, *args, **kwargs)
+    if dm and hasattr(dm, 'mcmc') and hasattr(dm, 'vars'):
+        table = report(profile_nodes(dm.vars, dm.mcmc))
+        print table
+        out = open(fname + '.txt', 'w')
+        out.write(table + '\n')
+        out.close()
+    return dm
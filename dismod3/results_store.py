@@ -0,0 +1,118 @@
+""" A consolidated store of the estimates of a model, with random access by gbd key
+
+The estimates of a fitted model (``initial_value``, ``map``,
+``truth``, and the ``mcmc_*`` summaries, one vector for each
+type/region/year/sex) are most of its params, but a plot, a table
+or a map needs only a few of them.  The results store keeps each
+vector as a little-endian float64 blob in a SQLite table indexed by
+param and gbd key, in ``<RESULTS_STORE_DIR>/dm-<id>.sqlite``, so that
+reading one curve is a single indexed lookup, instead of parsing the
+json of the whole model.
+
+The data server writes the store as it stores the params of a model
+(see DiseaseModel.update_params), and stamps it with the version its
+database gives the estimates of the model, which changes whenever
+they do; when it opens the store with another stamp (say, after the
+database was reset, or the estimates were changed some other way) it
+fills the store again (see DiseaseModel.results_store).  DiseaseJson reads an estimate
+from its results store (in ``dm.results``) when it is not in its
+params (see DiseaseJson.get_estimate), so that the plotting, table
+and map code read the estimates they use from the store without
+changing.
+
+Example
+-------
+>>> import dismod3.results_store as results_store
+>>> store = results_store.ResultsStore(results_store.store_fname(4222))
+>>> store.update(dm.params)
+>>> store.get('mcmc_mean', 'prevalence+asia_east+2005+male')
+"""
+
+import os
+import sqlite3
+
+import numpy as np
+
+from dismod3.settings import RESULTS_STORE_DIR
+from dismod3.utils import makedirs, type_region_year_sex_from_key
+import dismod3.array_encoding as array_encoding
+
+def store_fname(id):
+    return '%s/dm-%d.sqlite' % (RESULTS_STORE_DIR, int(id))
+
+# the params that hold estimates, besides those named mcmc_<stat>
+ESTIMATE_PARAMS = ['initial_value', 'map', 'truth']
+
+def is_estimate_param(param):
+    """ Return True if param holds estimate vectors (see DiseaseJson.get_estimate)"""
+    return param in ESTIMATE_PARAMS or param.startswith('mcmc_')
+
+def is_estimate(key, val):
+    """ Return True if val is an estimate vector for the gbd key"""
+    return type_region_year_sex_from_key(key)[0] != 'unknown' \
+           and (array_encoding.is_encoded(val) or array_encoding.is_numeric_list(val))
+
+class ResultsStore:
+    def __init__(self, fname):
+        makedirs(os.path.dirname(fname))
+        self.conn = sqlite3.connect(fname, timeout=30.)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS estimates '
+                          '(param TEXT, key TEXT, value BLOB, PRIMARY KEY (param, key))')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+        self.conn.commit()
+
+    def put(self, param, key, val):
+        """ Store the vector val as param for gbd key (without committing)"""
+        blob = np.asarray(array_encoding.decode(val), dtype='<f8').tostring()
+        self.conn.execute('INSERT OR REPLACE INTO estimates (param, key, value) VALUES (?, ?, ?)',
+                          (param, key, sqlite3.Binary(blob)))
+
+    def get(self, param, key, default=None):
+        """ Return the vector stored as param for gbd key, as a float
+        array, or default if there is none"""
+        row = self.conn.execute('SELECT value FROM estimates WHERE param=? AND key=?', (param, key)).fetchone()
+        if row is None:
+            return default
+        return np.fromstring(str(row[0]), dtype='<f8').astype(float)
+
+    def has(self, param, key):
+        return self.conn.execute('SELECT 1 FROM estimates WHERE param=? AND key=?', (param, key)).fetchone() is not None
+
+    def keys(self, param):
+        """ Return the gbd keys with a vector stored as param"""
+        return [row[0] for row in self.conn.execute('SELECT key FROM estimates WHERE param=? ORDER BY key', (param,))]
+
+    def update(self, params):
+        """ Store every estimate vector in the estimate params of
+        params (which may be a patch), and return how many there were"""
+        n = 0
+        for param, val in params.items():
+            if not is_estimate_param(param) or not isinstance(val, dict):
+                continue
+            for key, v in val.items():
+                if is_estimate(key, v):
+                    self.put(param, key, v)
+                    n += 1
+        self.conn.commit()
+        return n
+
+    def stamp(self):
+        """ Return the stamp of the params the store was filled from
+        (see set_stamp), or None if it has not been filled"""
+        row = self.conn.execute("SELECT value FROM meta WHERE name='stamp'").fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def set_stamp(self, stamp):
+        self.conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('stamp', ?)", (stamp,))
+        self.conn.commit()
+
+    def clear(self):
+        """ Delete every vector and the stamp, before refilling the store"""
+        self.conn.execute('DELETE FROM estimates')
+        self.conn.execute('DELETE FROM meta')
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
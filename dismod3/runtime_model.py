@@ -0,0 +1,123 @@
+""" Predict how long a fit will take, from the timings of past fits
+
+The run time of a fit varies by orders of magnitude with the amount of
+data, the number of rate types that have data, the number of
+region/year/sex keys that are fit, and the number of MCMC iterations.
+The RuntimePredictor models the log of the run time as linear in the
+logs of these, and learns the coefficients by least squares from the
+recorded features and run times of finished fits.  Until there are
+MIN_RUNTIME_RECORDS of them, it uses default coefficients, which
+give run times roughly proportional to rows * keys * iterations; these
+order jobs sensibly, but are not reliable in absolute terms.
+
+The data server uses the predictions to order the job queue
+(shortest-expected-first, so that small models do not wait behind
+GBD-wide refits) and to show predicted completion times, and fit_all
+uses them, trained on the timings of the jobs the server has
+finished, to start the longest tasks of a fit first, so that they
+pack well onto the available slots.  Both describe their fits with
+job_features, so that the empirical prior of each rate type, and the
+posterior of each region/year/sex, counts as one key in either.
+
+Example
+-------
+>>> from dismod3.runtime_model import RuntimePredictor, job_features
+>>> p = RuntimePredictor()
+>>> p.train([[job_features('empirical priors', data_types), 600.], ...])
+>>> p.predict(job_features('posterior', data_types, ['asia_east']))
+>>> p.predict(job_features('empirical priors', data_types, emp_prior_types=['prevalence']))
+"""
+
+import numpy as np
+
+from dismod3.settings import gbd_regions, gbd_years, gbd_sexes, MIN_RUNTIME_RECORDS
+from dismod3.utils import clean
+
+# the rate types whose data drive the fits
+rate_types = ['incidence', 'prevalence', 'remission', 'excess-mortality']
+
+# MCMC iterations of each kind of fit (see gbd_fit.fit and neg_binom_model.fit_emp_prior)
+EMP_PRIOR_ITER = 30000
+POSTERIOR_ITER = 10000
+
+# log(secs) = coef . [1, log(1+rows), types with data, log(1+keys), log(iter)]
+DEFAULT_COEFS = [-12., 1., 0., 1., 1.]
+
+def fit_features(data_types, n_keys, iter):
+    """ Return the features of one fit
+
+    Parameters
+    ----------
+    data_types : list of str
+      the data_type of each data row of the model
+    n_keys : int
+      the number of region/year/sex keys the fit estimates
+    iter : int
+      the number of MCMC iterations
+    """
+    types = set()
+    for t in data_types:
+        for r in rate_types:
+            if clean(t).find(r) != -1:
+                types.add(r)
+    return {'rows': len(data_types), 'types': len(types), 'keys': n_keys, 'iter': iter}
+
+def job_features(estimate_type, data_types, regions_to_fit=[],
+                 emp_prior_types=rate_types, years=gbd_years, sexes=gbd_sexes):
+    """ Return the features of a job, which fits the empirical priors
+    of the rate types in emp_prior_types, or the posteriors of the
+    regions in regions_to_fit (all of them, if it includes
+    'all_regions'), for the given years and sexes
+
+    A job on the queue fits every rate type, or every year and sex of
+    its regions; a task of fit_all fits a single one.
+    """
+    if estimate_type.find('empirical priors') != -1:
+        return fit_features(data_types, len(emp_prior_types), EMP_PRIOR_ITER)
+
+    if 'all_regions' in regions_to_fit or not regions_to_fit:
+        regions_to_fit = gbd_regions
+    return fit_features(data_types, len(regions_to_fit) * len(years) * len(sexes), POSTERIOR_ITER)
+
+def feature_vector(features):
+    return [1., np.log(1. + features['rows']), features['types'],
+            np.log(1. + features['keys']), np.log(features['iter'])]
+
+class RuntimePredictor:
+    def __init__(self):
+        self.coefs = np.array(DEFAULT_COEFS)
+        self.trained = False
+
+    def train(self, records):
+        """ Fit the coefficients to the run times of past fits
+
+        Parameters
+        ----------
+        records : list of [features, seconds] pairs
+          features as returned by fit_features or job_features
+
+        Results
+        -------
+        Returns True if there were enough records to fit, and False if
+        the default coefficients are still in use
+        """
+        records = [[f, secs] for f, secs in records if secs > 0]
+        if len(records) < MIN_RUNTIME_RECORDS:
+            return False
+
+        X = np.array([feature_vector(f) for f, secs in records])
+        y = np.log([secs for f, secs in records])
+
+        # a little ridge regularization toward the default
+        # coefficients, since many past fits share the same iterations
+        # and key counts, which leaves those coefficients unidentified
+        ridge = .1
+        A = np.dot(X.T, X) + ridge * np.eye(len(DEFAULT_COEFS))
+        b = np.dot(X.T, y) + ridge * np.array(DEFAULT_COEFS)
+        self.coefs = np.linalg.solve(A, b)
+        self.trained = True
+        return True
+
+    def predict(self, features):
+        """ Return the predicted run time, in seconds, of a fit with the given features"""
+        return float(np.exp(np.dot(self.coefs, feature_vector(features))))
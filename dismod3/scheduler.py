@@ -0,0 +1,203 @@
+""" Dependency-driven scheduling of the fitting pipeline
+
+A fit is a DAG of jobs: the empirical prior fits, the posterior fits
+for each region/year/sex, and the upload of the results.  Each job
+names the jobs it depends on, and starts as soon as those jobs (and
+only those) have finished, instead of waiting for a whole stage.
+
+The Scheduler runs the DAG on this machine, through a LocalExecutor,
+retrying failed jobs and recording the state of every job in a json
+file, so that an interrupted pipeline can be resumed without re-running
+the jobs that finished.  The SGEScheduler submits the same DAG to the
+cluster, with each job held until its own dependencies finish.
+
+Example
+-------
+>>> from dismod3.scheduler import Scheduler
+>>> s = Scheduler('/var/tmp/dismod_working/test/dm-4222/scheduler.json')
+>>> s.add('i-4222', 'fit_emp_prior.py 4222 -t incidence')
+>>> s.add('a1m54222', 'fit_posterior.py 4222 -r asia_east -s male -y 2005', deps=['i-4222'])
+>>> s.add('upld-4222', 'upload_fits.py 4222', deps=['a1m54222'])
+>>> s.run()
+"""
+
+import os
+import subprocess
+import time
+
+import simplejson as json
+
+from dismod3.settings import SCHEDULER_RETRIES, SLEEP_SECS
+from dismod3.executor import LocalExecutor
+from dismod3.utils import debug, write_atomically
+
+class Task:
+    def __init__(self, name, cmd, deps=[], stdout='/dev/null', stderr='/dev/null', retry_cmd=None, cost=0.):
+        """
+        Parameters
+        ----------
+        name : str
+          a unique name for the task, which is also its SGE job name
+        cmd : str
+          the python script to run, with its arguments
+        deps : list of str, optional
+          the names of the tasks that must finish before this one starts
+        stdout, stderr : str, optional
+          files for the output of the task
+        retry_cmd : str, optional
+          the script to run when retrying the task after a failure,
+          e.g. to resume from a checkpoint; defaults to cmd
+        cost : float, optional
+          the predicted run time of the task, in seconds (see
+          dismod3.runtime_model); of the tasks that are ready, the
+          costliest start first, so that the long tasks do not end up
+          running alone at the end
+        """
+        self.name = name
+        self.cmd = cmd
+        self.deps = list(deps)
+        self.stdout = stdout
+        self.stderr = stderr
+        self.retry_cmd = retry_cmd or cmd
+        self.cost = cost
+        self.state = 'waiting'
+        self.tries = 0
+
+class Scheduler:
+    def __init__(self, state_fname=None, retries=SCHEDULER_RETRIES, executor=None):
+        """
+        Parameters
+        ----------
+        state_fname : str, optional
+          json file to record the state of each task in; tasks that it
+          records as done (with the same command) are not run again
+        retries : int, optional
+          the number of times to re-run a task that fails
+        executor : LocalExecutor or WorkerPool, optional
+        """
+        self.state_fname = state_fname
+        self.retries = retries
+        self.executor = executor or LocalExecutor()
+        self.tasks = {}
+        self.order = []
+
+        self.stored_state = {}
+        if state_fname and os.path.exists(state_fname):
+            try:
+                f = open(state_fname)
+                self.stored_state = json.loads(f.read())
+                f.close()
+            except (IOError, ValueError):
+                self.stored_state = {}
+
+    def add(self, name, cmd, deps=[], stdout='/dev/null', stderr='/dev/null', retry_cmd=None, cost=0.):
+        """ Add a task to the DAG; see Task for the parameters"""
+        for d in deps:
+            if not self.tasks.has_key(d):
+                raise KeyError, 'task %s depends on unknown task %s' % (name, d)
+        task = Task(name, cmd, deps, stdout, stderr, retry_cmd, cost)
+
+        stored = self.stored_state.get(name, {})
+        if stored.get('state') == 'done' and stored.get('cmd') == cmd:
+            task.state = 'done'
+
+        self.tasks[name] = task
+        self.order.append(name)
+        return task
+
+    def save_state(self):
+        """ Write the state of every task to the state file (atomically)"""
+        if not self.state_fname:
+            return
+        state = dict([[t.name, {'state': t.state, 'cmd': t.cmd, 'tries': t.tries}]
+                      for t in self.tasks.values()])
+        write_atomically(self.state_fname, json.dumps(state))
+
+    def ready(self):
+        """ Return the waiting tasks whose dependencies are all done,
+        costliest first, and in the order they were added among those
+        of equal cost"""
+        ready = [self.tasks[n] for n in self.order
+                 if self.tasks[n].state == 'waiting'
+                 and not [d for d in self.tasks[n].deps if self.tasks[d].state != 'done']]
+        return sorted(ready, key=lambda t: -t.cost)
+
+    def skip_dependents(self):
+        """ Mark the tasks that can never run, because something they
+        depend on failed, as skipped"""
+        changed = True
+        while changed:
+            changed = False
+            for n in self.order:
+                t = self.tasks[n]
+                if t.state == 'waiting' and [d for d in t.deps if self.tasks[d].state in ['failed', 'skipped']]:
+                    t.state = 'skipped'
+                    debug('skipping %s, since a task it depends on failed' % n)
+                    changed = True
+
+    def start(self, task):
+        if task.tries == 0:
+            cmd = task.cmd
+        else:
+            cmd = task.retry_cmd
+        task.tries += 1
+        task.state = 'running'
+        self.executor.submit_script(task.name, cmd, task.stdout, task.stderr)
+
+    def step(self):
+        """ Record finished tasks and start the ready ones, without blocking
+
+        Results
+        -------
+        Returns True while there are tasks left to run
+        """
+        for name, returncode in self.executor.poll():
+            task = self.tasks[name]
+            if returncode == 0:
+                task.state = 'done'
+            elif task.tries <= self.retries:
+                debug('%s failed (return code %d), retrying' % (name, returncode))
+                task.state = 'waiting'
+            else:
+                debug('%s failed (return code %d), giving up' % (name, returncode))
+                task.state = 'failed'
+
+        self.skip_dependents()
+        for task in self.ready():
+            self.start(task)
+        self.save_state()
+
+        return len([t for t in self.tasks.values() if t.state in ['waiting', 'running']]) > 0
+
+    def run(self, sleep_secs=SLEEP_SECS):
+        """ Run the DAG to completion
+
+        Results
+        -------
+        Returns a list of the names of the tasks that failed or were skipped
+        """
+        while self.step():
+            time.sleep(sleep_secs)
+        return [n for n in self.order if self.tasks[n].state != 'done']
+
+class SGEScheduler(Scheduler):
+    """ Submit the DAG to SGE, holding each job until the jobs it
+    depends on finish.  SGE runs the jobs after this returns, so failed
+    jobs are not retried, and the state file is not updated."""
+    def start(self, task):
+        hold_str = ''
+        deps = [d for d in task.deps if self.tasks[d].state != 'done']
+        if deps:
+            hold_str = '-hold_jid %s ' % ','.join(deps)
+        call_str = 'qsub -cwd -o %s -e %s ' % (task.stdout, task.stderr) \
+                   + hold_str \
+                   + '-N %s ' % task.name \
+                   + 'run_on_cluster.sh %s' % task.cmd
+        subprocess.call(call_str, shell=True)
+        task.state = 'submitted'
+
+    def run(self, sleep_secs=SLEEP_SECS):
+        for n in self.order:
+            if self.tasks[n].state == 'waiting':
+                self.start(self.tasks[n])
+        return []
@@ -13,19 +13,39 @@ DISMOD_TWITTER_PASSWORD = 's3cr3t_p4sswd'
 
 DISMOD_LOGIN_URL = DISMOD_BASE_URL + 'accounts/login/'
 DISMOD_DOWNLOAD_URL = DISMOD_BASE_URL + 'dismod/show/%s.json'
-DISMOD_UPLOAD_URL = DISMOD_BASE_URL + 'dismod/upload'
+DISMOD_UPLOAD_URL = DISMOD_BASE_URL + 'dismod/upload/'
+DISMOD_PATCH_URL = DISMOD_BASE_URL + 'dismod/upload/%d'
+DISMOD_POSTERIOR_SLICE_URL = DISMOD_BASE_URL + 'dismod/posterior_slice/%d'
 
 DISMOD_LIST_JOBS_URL = DISMOD_BASE_URL + 'dismod/job_queue/list/?format=json'
 DISMOD_REMOVE_JOB_URL = DISMOD_BASE_URL + 'dismod/job_queue/remove/'
+DISMOD_CLAIM_JOB_URL = DISMOD_BASE_URL + 'dismod/job_queue/claim/'
+DISMOD_RENEW_JOB_URL = DISMOD_BASE_URL + 'dismod/job_queue/renew/%d'
+DISMOD_FINISH_JOB_URL = DISMOD_BASE_URL + 'dismod/job_queue/finish/%d'
+DISMOD_JOB_TIMINGS_URL = DISMOD_BASE_URL + 'dismod/job_queue/timings/'
 DISMOD_INIT_LOG_URL = DISMOD_BASE_URL + 'dismod/init_log/%d/%s/%d'
 DISMOD_LOG_STATUS_URL = DISMOD_BASE_URL + 'dismod/log_status/%d/%s/%s/%s'
 
+# number of times to retry a failed request to the dismod server, and
+# the seconds to wait before the first retry (doubling for each retry)
+DISMOD_HTTP_RETRIES = 3
+DISMOD_HTTP_BACKOFF = 5.
+
 
 ON_SGE = 0
 SERVER_LOAD_STATUS_HOST = 'omak.ihme.washington.edu'
 SERVER_LOAD_STATUS_PORT = 1723
 SERVER_LOAD_STATUS_SIZE = 20480
 
+# seconds between refreshes of the cluster load snapshot kept by
+# server_load.py, and seconds the data server reuses a copy of it
+SERVER_LOAD_REFRESH_SECS = 15.
+SERVER_LOAD_CACHE_SECS = 5.
+
+# path where the local fitting daemons write the status of their
+# executors, for server_load.py to report
+LOCAL_EXECUTOR_STATUS_DIR = '/var/tmp/dismod_executor_status'
+
 # path to job working directory
 # dir = JOB_WORKING_DIR % id
 #JOB_WORKING_DIR = '../../dismod_status/test/dm-%d'
@@ -35,6 +55,26 @@ JOB_WORKING_DIR = '/var/tmp/dismod_working/test/dm-%d'
 # dir = JOB_LOG_DIR % id
 JOB_LOG_DIR = '/var/tmp/dismod_log/test/dm-%d'
 
+# the most bytes of a fit's event log sent in one status request
+# (see dismod3/event_log.py)
+EVENT_LOG_READ_BYTES = 65536
+
+# the most bytes from the end of a fit's stdout and stderr shown on
+# the status page
+STATUS_TAIL_BYTES = 65536
+
+# path to store of MAP solutions used to warm-start later fits
+WARM_START_DIR = '/var/tmp/dismod_warm_start/test'
+
+# path to store of empirical prior fit results, keyed by a hash of their inputs
+EMP_PRIOR_CACHE_DIR = '/var/tmp/dismod_emp_prior_cache/test'
+
+# path to node-local cache of models fetched from the dismod server
+MODEL_CACHE_DIR = '/var/tmp/dismod_model_cache/test'
+
+# models that never change, so a cached copy is always current
+MODEL_CACHE_STATIC_IDS = ['all-cause_mortality']
+
 # path and name of daemon log file
 DAEMON_LOG_FILE = '/var/tmp/daemon_test.log'
 
@@ -45,13 +85,79 @@ GBD_FIT_LOCK_FILE = '/var/tmp/gbd_fit_test.lock'
 GBD_FIT_STR = 'python gbd_fit.py %s %d >%s 2>%s'
 #GBD_FIT_STR = 'qsub -cwd -o %s -e %s /home/j/Project/dismod/gbd/gbd_fit.sh %s %d'
 
-# time to wait (in seconds) between checking the server for new jobs
+# number of fit processes the daemon runs at once when not on SGE
+# (None means one per core), and the CPU time (in seconds) and memory
+# (in bytes) each may use (None means no limit)
+LOCAL_EXECUTOR_SLOTS = None
+JOB_CPU_LIMIT = None
+JOB_MEM_LIMIT = None
+
+# number of processes that parse the results of the fits of a model
+# when they are merged for upload (None means one per core)
+MERGE_WORKERS = None
+
+# number of times the fit_all scheduler re-runs a job that fails
+SCHEDULER_RETRIES = 2
+
+# time to wait (in seconds) between checks on running jobs
 SLEEP_SECS = 2.
 
+# longest time (in seconds) a request for a job waits on the server
+# for one to be queued, the time between its checks of the stamp file
+# that is touched when a job is queued, and the time between its
+# checks of the database when the stamp is unchanged (for jobs whose
+# leases expire)
+JOB_QUEUE_POLL_TIMEOUT = 30.
+JOB_QUEUE_CHECK_SECS = .5
+JOB_QUEUE_RECHECK_SECS = 15.
+JOB_QUEUE_STAMP_FILE = '/var/tmp/dismod_job_queue_test.stamp'
+
+# time (in seconds) a daemon holds a claimed job without renewing its
+# lease; a job whose lease expires goes back on the queue, until it
+# has been tried JOB_MAX_TRIES times
+JOB_LEASE_SECS = 300.
+JOB_MAX_TRIES = 3
+
+# order in which this daemon claims jobs of equal priority:
+# 'shortest' predicted run time first, 'longest' first (to pack batch
+# runs), or 'oldest' first; jobs queued for more than
+# JOB_QUEUE_MAX_WAIT seconds are claimed first regardless
+JOB_CLAIM_ORDER = 'shortest'
+JOB_QUEUE_MAX_WAIT = 6 * 3600.
+
+# number of daemons claiming jobs, for predicting when queued jobs finish
+JOB_QUEUE_WORKERS = 1
+
+# number of finished jobs needed to train the run time predictions,
+# and the time (in seconds) between retraining them
+MIN_RUNTIME_RECORDS = 10
+RUNTIME_RETRAIN_SECS = 3600.
+
+# number of MCMC iterations between checkpoints of the sampler state
+CHECKPOINT_ITERS = 1000
+
+# number of MCMC steps at which --profile times each node of the model
+PROFILE_NODE_STEPS = 20
+
+# seconds between samples of the RSS of a fit run with --memory, and
+# the most memory (in bytes) a fit may use before it stops with an
+# error (None means no budget; see dismod3/memory.py)
+MEMORY_SAMPLE_SECS = 1.
+JOB_MEMORY_BUDGET = None
+
 R_PATH = '/usr/bin/R'
 CSV_PATH = './'
 LIB_PATH = '/var/tmp/libdismod.so'
 
+# numpy dtype (e.g. '<f8' or '<f4') that DiseaseJson stores estimate
+# vectors with, base64 encoded, or None to store them as json lists
+# of floats (see dismod3/array_encoding.py)
+ARRAY_ENCODING = None
+
+# directory of the results store of each model, an indexed SQLite file
+# of its estimate vectors (see dismod3/results_store.py)
+RESULTS_STORE_DIR = '/var/tmp/dismod_results/test'
+
 # disease model parameters
 NEARLY_ZERO = 1.e-7
 MAX_AGE = 101
@@ -0,0 +1,154 @@
+""" Time the phases of a fit, and the resources they use
+
+The fit scripts mark the start and end of each phase of a fit (model
+fetch, json parsing, model setup, each MAP stage, MCMC, summarizing
+the traces, plotting, saving and uploading), and, for the phases that
+work on one gbd key at a time, the key.  For each phase this records
+the wall time, the CPU time (user and system), and the resident set
+size of the process at the end of the phase and how much it grew
+during the phase; the peak RSS of each phase, from samples taken
+while it runs, is in the report of memory.py.  Phases may nest
+(the setup of each key is part of the MAP phase, for example), so the
+times of all the phases can add up to more than the whole fit.  The
+start and end of each phase also go to the event log of the fit,
+with the same measurements (see event_log.py), and are where a fit
+with a memory budget checks it (see memory.py).
+
+Phases are only recorded between reset(), which the fit scripts call
+when a fit starts, and stop(), so that a long-running process (the
+daemon, or a warm worker between fits) does not collect the phases of
+the models it fetches for ever.
+
+When the fit is done, the record of all phases is written as json to
+``<JOB_WORKING_DIR>/<estimate_type>/timing/<task>.json``, and a
+summary, totalled by phase, is attached to the model in the
+``fit_timing`` param, under the first key of the results of the fit,
+so that it is uploaded with them.
+
+Example
+-------
+>>> import dismod3.timing as timing
+>>> timing.reset()
+>>> timing.phase_start('mcmc')
+>>> model.fit(dm, method='mcmc', keys=keys)
+>>> timing.phase_end('mcmc')
+>>> timing.attach(dm, keys)
+>>> timing.save(4222, 'posterior', 'asia_east+male+2005')
+"""
+
+import os
+import resource
+import time
+
+import simplejson as json
+
+from dismod3.settings import JOB_WORKING_DIR
+from dismod3.utils import makedirs
+import dismod3.event_log as event_log
+import dismod3.memory as memory
+
+def peak_rss():
+    """ Return the peak resident set size of this process so far, in kilobytes"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def cpu_time():
+    """ Return the user and system CPU time of this process so far, in seconds"""
+    t = os.times()
+    return t[0] + t[1]
+
+def timing_fname(id, estimate_type, task):
+    return '%s/%s/timing/%s.json' % (JOB_WORKING_DIR % int(id), estimate_type, task)
+
+class Timer:
+    def __init__(self):
+        self.started = time.time()
+        self.cpu_started = cpu_time()
+        self.running = {}
+        self.phases = []
+
+    def phase_start(self, phase, key=None):
+        self.running[(phase, key)] = (time.time(), cpu_time(), memory.rss())
+
+    def phase_end(self, phase, key=None):
+        """ Record the end of a phase, and return its record"""
+        start, cpu_start, rss_start = self.running.pop((phase, key))
+        rss_end = memory.rss()
+        record = {'phase': phase, 'start': start,
+                  'wall': time.time() - start, 'cpu': cpu_time() - cpu_start,
+                  'rss': rss_end, 'rss_growth': rss_end - rss_start}
+        if key:
+            record['key'] = key
+        self.phases.append(record)
+        return record
+
+    def summary(self):
+        """ Return the wall and CPU time and the RSS growth of each
+        phase, totalled over its keys, and the wall and CPU time of the
+        whole fit so far, with the peak RSS of the process"""
+        phases = {}
+        for r in self.phases:
+            s = phases.setdefault(r['phase'], {'wall': 0., 'cpu': 0., 'count': 0, 'rss_growth': 0})
+            s['wall'] += r['wall']
+            s['cpu'] += r['cpu']
+            s['count'] += 1
+            s['rss_growth'] += r['rss_growth']
+        return {'wall': time.time() - self.started, 'cpu': cpu_time() - self.cpu_started,
+                'peak_rss': peak_rss(), 'phases': phases}
+
+    def save(self, fname):
+        """ Write the record of every phase, and the summary, to fname as json"""
+        makedirs(os.path.dirname(fname))
+        f = open(fname, 'w')
+        f.write(json.dumps({'phases': self.phases, 'summary': self.summary()}))
+        f.close()
+
+# the timer of the fit running in this process, or None if no fit is
+# being timed
+_timer = None
+
+def reset():
+    """ Start timing a new fit (e.g. in a worker forked from a process
+    that has timed others)"""
+    global _timer
+    _timer = Timer()
+
+def stop():
+    """ Stop timing, and drop the record of the phases timed so far"""
+    global _timer
+    _timer = None
+
+def phase_start(phase, key=None):
+    memory.check('the start of %s' % ' '.join(filter(None, [phase, key])))
+    if not _timer:
+        return
+    _timer.phase_start(phase, key)
+    if key:
+        event_log.phase_start(phase, key=key)
+    else:
+        event_log.phase_start(phase)
+
+def phase_end(phase, key=None):
+    if _timer:
+        record = _timer.phase_end(phase, key)
+        event_log.phase_end(**record)
+    memory.check('the end of %s' % ' '.join(filter(None, [phase, key])))
+
+def summary():
+    if not _timer:
+        return {}
+    return _timer.summary()
+
+def phases():
+    if not _timer:
+        return []
+    return _timer.phases
+
+def attach(dm, keys):
+    """ Store the summary of the fit in dm once, under the first of
+    keys (the keys of its results, which it is saved with)"""
+    if _timer and keys:
+        dm.set_key_by_type('fit_timing', keys[0], summary())
+
+def save(id, estimate_type, task):
+    if _timer:
+        _timer.save(timing_fname(id, estimate_type, task))
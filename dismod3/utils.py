@@ -1,10 +1,11 @@
-import pylab as pl
+import os
+
 import numpy as np
-import pymc as mc
-from pymc import gp
-from ctypes import *
 from settings import *
 
+# pymc is imported by the functions that use it, so that importing
+# dismod3.utils (e.g. for the gbd keys) does not load it
+
 try:
     from gbd.settings import DEBUG_TO_STDOUT
 except:
@@ -20,6 +21,28 @@ def debug(string):
         sys.stdout.flush()
 
 
+def makedirs(dir):
+    """ Make dir, and its parents, unless it exists (which it may, if
+    another process makes it at the same time)"""
+    if dir and not os.path.exists(dir):
+        try:
+            os.makedirs(dir)
+        except OSError:
+            if not os.path.isdir(dir):
+                raise
+
+def write_atomically(fname, s):
+    """ Write the string s to fname, by writing a temporary file and
+    renaming it, so that readers never see a partial file, and an
+    interrupted write leaves the old one"""
+    tmp_fname = '%s.%d.tmp' % (fname, os.getpid())
+    f = open(tmp_fname, 'wb')
+    try:
+        f.write(s)
+    finally:
+        f.close()
+    os.rename(tmp_fname, fname)
+
 def trim(x, a, b):
     return np.maximum(a, np.minimum(b, x))
 
@@ -37,6 +60,7 @@ def uninformative_prior_gp(c=-10.,  diff_degree=2., amp=100., scale=200.):
     return mean and covariance objects for an uninformative prior on
     the age-specific rate
     """
+    from pymc import gp
     M = gp.Mean(const_func, c=c)
     C = gp.Covariance(gp.matern.euclidean, diff_degree=diff_degree,
                       amp=amp, scale=scale)
@@ -158,6 +182,7 @@ def prior_vals(dm, type):
     
     """
     import random
+    import pymc as mc
     import dismod3.neg_binom_model as model
 
     data = [d for d in dm.data if clean(d['data_type']).find(type) != -1 and not d.get('ignore') != 1]
@@ -284,6 +309,7 @@ def generate_prior_potentials(rate_vars, prior_str, age_mesh):
 
     age_mesh[i] indicates what age the value of rate[i] corresponds to
     """
+    import pymc as mc
 
     def derivative_sign_prior(rate, prior, deriv, sign):
         age_start = int(prior[1])
@@ -328,7 +354,7 @@ def generate_prior_potentials(rate_vars, prior_str, age_mesh):
             @mc.potential(name='unimodal_{%d,%d}^%s' % (age_start, age_end, rate))
             def unimodal_rate(f=rate, age_indices=age_indices, tau=1.e5):
                 df = np.diff(f[age_indices])
-                sign_changes = pl.find((df[:-1] > NEARLY_ZERO) & (df[1:] < -NEARLY_ZERO))
+                sign_changes = np.flatnonzero((df[:-1] > NEARLY_ZERO) & (df[1:] < -NEARLY_ZERO))
                 sign = np.ones(len(age_indices)-2)
                 if len(sign_changes) > 0:
                     change_age = sign_changes[len(sign_changes)/2]
@@ -423,6 +449,40 @@ def generate_prior_potentials(rate_vars, prior_str, age_mesh):
 
     rate_vars['priors'] = priors
 
+class LazyDict(dict):
+    """ A dict whose contents are loaded by calling load() the first
+    time it is used, for module-level tables that are expensive to
+    build and not needed by every user of the module
+
+    Example
+    -------
+    >>> countries_for = LazyDict(lambda: {'asia_east': ['CHN', 'PRK', 'TWN']})
+    >>> countries_for['asia_east']
+    ['CHN', 'PRK', 'TWN']
+    """
+    def __init__(self, load):
+        dict.__init__(self)
+        self._load = load
+        self._loaded = False
+
+    def load(self):
+        if not self._loaded:
+            self._loaded = True
+            dict.update(self, self._load())
+
+def _loading(name):
+    method = getattr(dict, name)
+    def loading_method(self, *args, **kwargs):
+        self.load()
+        return method(self, *args, **kwargs)
+    loading_method.__name__ = name
+    return loading_method
+
+for _name in ['__getitem__', '__setitem__', '__delitem__', '__contains__', '__iter__', '__len__',
+              '__eq__', '__ne__', '__repr__', 'get', 'has_key', 'keys', 'values', 'items',
+              'iterkeys', 'itervalues', 'iteritems', 'pop', 'setdefault', 'update', 'copy']:
+    setattr(LazyDict, _name, _loading(_name))
+
 standardize_data_type = {
     'incidence data': 'incidence data',
     'incidence': 'incidence data',
@@ -0,0 +1,146 @@
+""" Persistent store of MAP solutions, for warm-starting later fits
+
+After the MAP stage of a posterior fit, the values of all the
+stochastics for each region/year/sex (alpha, beta, gamma_mesh,
+dispersion, C_0, etc) are saved under ``WARM_START_DIR``, keyed by
+model id and region/year/sex, together with a fingerprint of the
+model structure (stochastic names and shapes, and the age mesh).
+
+A new fit of the same model, or of a model copied from it (found by
+following ``dm.params['parent']``), starts from the stored values
+whenever the fingerprints match, which lets it skip the staged MAP
+sequence in ``gbd_disease_model.fit``.
+
+Example
+-------
+>>> import dismod3.warm_start as warm_start
+>>> warm_start.restore(dm, keys)   # True if stored values were found and applied
+>>> model.fit(dm, method='map', keys=keys)
+>>> warm_start.save(dm, keys)
+"""
+
+import os
+import cPickle
+import hashlib
+
+import numpy as np
+import pymc as mc
+
+from dismod3.settings import WARM_START_DIR, KEY_DELIM_CHAR
+from dismod3.utils import debug, makedirs, write_atomically, type_region_year_sex_from_key
+
+def rys_groups(keys):
+    """ Return a list of the distinct region+year+sex key suffixes in keys"""
+    groups = []
+    for k in keys:
+        t, r, y, s = type_region_year_sex_from_key(k)
+        g = KEY_DELIM_CHAR.join([r, y, s])
+        if not g in groups:
+            groups.append(g)
+    return groups
+
+def group_stochastics(dm, keys, group):
+    """ Return a dict of the (non-observed) stochastics in dm.vars for
+    keys whose names end with the region+year+sex suffix group"""
+    model = mc.Model([dm.vars[k] for k in keys if dm.vars.has_key(k)])
+    return dict([[s.__name__, s] for s in model.stochastics
+                 if s.__name__.endswith(group)])
+
+def group_logp(dm, keys, group):
+    """ Return the joint log-probability of the vars for the keys in
+    the region+year+sex group, including their observed children and
+    potentials, or -inf if their current values are ruled out"""
+    model = mc.Model([dm.vars[k] for k in keys if dm.vars.has_key(k) and rys_groups([k]) == [group]])
+    try:
+        return model.logp
+    except mc.ZeroProbability:
+        return -np.inf
+
+def structure_fingerprint(dm, stochs):
+    """ Hash the structure of a group of stochastics, so that stored
+    values are only applied to a model they fit"""
+    structure = [(name, np.shape(stochs[name].value)) for name in sorted(stochs)]
+    structure.append(list(dm.get_param_age_mesh()))
+    structure.append(list(dm.get_estimate_age_mesh()))
+    return hashlib.md5(repr(structure)).hexdigest()
+
+def store_fname(id, group):
+    return '%s/dm-%s/%s.pickle' % (WARM_START_DIR, id, group)
+
+def save(dm, keys):
+    """ Save the current values of the stochastics for keys in the
+    warm-start store"""
+    for g in rys_groups(keys):
+        stochs = group_stochastics(dm, keys, g)
+        if len(stochs) == 0:
+            continue
+
+        fname = store_fname(dm.id, g)
+        makedirs(os.path.dirname(fname))
+
+        entry = {'fingerprint': structure_fingerprint(dm, stochs),
+                 'values': dict([[name, stochs[name].value] for name in stochs])}
+
+        # other jobs may be reading it
+        write_atomically(fname, cPickle.dumps(entry, cPickle.HIGHEST_PROTOCOL))
+        debug('saved warm-start values for %s' % g)
+
+def load(id, group):
+    """ Return the stored entry for model id and region+year+sex group,
+    or None if there is none"""
+    try:
+        f = open(store_fname(id, group), 'rb')
+        entry = cPickle.load(f)
+        f.close()
+        return entry
+    except (IOError, EOFError, cPickle.UnpicklingError):
+        return None
+
+def candidate_ids(dm):
+    """ The models to look for warm-start values in: this one first,
+    then the one it was copied from"""
+    ids = [dm.id]
+    parent = dm.params.get('parent')
+    if parent and parent != dm.id:
+        ids.append(parent)
+    return ids
+
+def restore(dm, keys):
+    """ Set the stochastics for keys to stored values, where the store
+    has values for a model of the same structure
+
+    Stored values are only used if the whole model of their group
+    (with its data and potentials) has finite log-probability at them.
+
+    Results
+    -------
+    Returns True if every region/year/sex group in keys was restored
+    """
+    all_restored = True
+    for g in rys_groups(keys):
+        stochs = group_stochastics(dm, keys, g)
+        if len(stochs) == 0:
+            continue
+        fingerprint = structure_fingerprint(dm, stochs)
+
+        restored = False
+        for id in candidate_ids(dm):
+            entry = load(id, g)
+            if not entry or entry['fingerprint'] != fingerprint:
+                continue
+
+            old_values = dict([[name, stochs[name].value] for name in stochs])
+            for name, val in entry['values'].items():
+                stochs[name].value = val
+            if np.isfinite(group_logp(dm, keys, g)):
+                debug('warm-starting %s from model %s' % (g, id))
+                restored = True
+                break
+
+            # the new data or priors rule the stored values out; start cold
+            for name, val in old_values.items():
+                stochs[name].value = val
+            debug('stored values from model %s are ruled out for %s' % (id, g))
+
+        all_restored = all_restored and restored
+    return all_restored
@@ -0,0 +1,137 @@
+""" A pool of warm workers, which keep dismod3 loaded between fits
+
+Starting a fit in a fresh python process means importing pylab,
+PyMC, scipy and xlwt, and parsing population.csv and
+country_region.csv, before any fitting can begin.  For the empirical
+prior fits and small posterior fits this is a large part of the run
+time.
+
+The WorkerPool does all of this once, in the long-running process
+that creates it, and then runs each job in a child forked from that
+process, so the child starts with everything loaded.  Since every job
+runs in its own child, jobs can not change the state of the pool or
+of each other.  The WorkerPool has the same interface as the
+LocalExecutor, so it can be used wherever the LocalExecutor is.
+
+Example
+-------
+>>> from dismod3.worker_pool import WorkerPool
+>>> pool = WorkerPool(slots=4)
+>>> pool.submit_script('4222 incidence', 'fit_emp_prior.py 4222 -t incidence', 'o', 'e')
+>>> while pool.busy():
+...     pool.poll()
+...     time.sleep(1.)
+"""
+
+import os
+import sys
+import random
+import shlex
+import signal
+import traceback
+
+from dismod3.settings import LOCAL_EXECUTOR_SLOTS, JOB_CPU_LIMIT, JOB_MEM_LIMIT
+from dismod3.executor import LocalExecutor, limit_resources
+
+def preload():
+    """ Import the libraries and load the data that every fit uses"""
+    import matplotlib
+    matplotlib.use('AGG')
+    import pylab
+    import pymc
+    import scipy.interpolate
+    import dismod3
+    import dismod3.neg_binom_model
+    dismod3.neg_binom_model.countries_for.load()
+    dismod3.neg_binom_model.population_by_age.load()
+    import dismod3.disease_json
+    import dismod3.plotting
+    import dismod3.table
+    import dismod3.normal_model
+    import dismod3.gbd_disease_model
+    import dismod3.generic_disease_model
+
+def run_script(script):
+    """ Run a python script, given with its arguments, as __main__ in
+    this process"""
+    argv = shlex.split(script)
+    sys.argv = argv
+    execfile(argv[0], {'__name__': '__main__', '__file__': argv[0]})
+
+def redirect(fd, fname):
+    """ Point the file descriptor fd at the file fname"""
+    f = os.open(fname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+    os.dup2(f, fd)
+    os.close(f)
+
+class ForkedProcess:
+    """ A forked child, with the poll() method of subprocess.Popen"""
+    def __init__(self, pid):
+        self.pid = pid
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode == None:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if pid == self.pid:
+                if os.WIFSIGNALED(status):
+                    self.returncode = -os.WTERMSIG(status)
+                else:
+                    self.returncode = os.WEXITSTATUS(status)
+        return self.returncode
+
+class WorkerPool(LocalExecutor):
+    def __init__(self, slots=LOCAL_EXECUTOR_SLOTS, cpu_limit=JOB_CPU_LIMIT, mem_limit=JOB_MEM_LIMIT):
+        """ Load everything the fits need, so that the workers forked
+        later start with it; see LocalExecutor for the parameters"""
+        LocalExecutor.__init__(self, slots, cpu_limit, mem_limit)
+        preload()
+
+    def submit_script(self, name, script, stdout='/dev/null', stderr='/dev/null', on_complete=None):
+        """ Queue a python script (with its arguments) to run in a
+        warm worker when a slot is free, with its output going to the
+        files stdout and stderr"""
+        self.submit(name, (script, stdout, stderr), on_complete)
+
+    def spawn(self, job):
+        script, stdout, stderr = job.cmd
+        for f in [sys.stdout, sys.stderr, sys.__stdout__, sys.__stderr__]:
+            f.flush()
+
+        pid = os.fork()
+        if pid != 0:
+            return ForkedProcess(pid)
+
+        # in the worker
+        returncode = 1
+        try:
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                limit_resources(self.cpu_limit, self.mem_limit)()
+                # sys.stdout may not be a real file (e.g. under nose's
+                # output capture), so point fds 1 and 2 at the job's files
+                # and write to them through the original streams
+                redirect(1, stdout)
+                redirect(2, stderr)
+                sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+
+                # do not share random numbers with the other workers
+                import numpy as np
+                np.random.seed()
+                random.seed()
+
+                run_script(script)
+                returncode = 0
+            except SystemExit, e:
+                if e.code == None:
+                    returncode = 0
+                elif isinstance(e.code, int):
+                    returncode = e.code
+                else:
+                    print >> sys.stderr, e.code
+            except:
+                traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(returncode)
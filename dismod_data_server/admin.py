@@ -5,4 +5,4 @@ from gbd.dismod_data_server.models import *
 admin.site.register(Data, DataAdmin)
 admin.site.register(DiseaseModel, DiseaseModelAdmin)
 admin.site.register(DiseaseModelParameter, DiseaseModelParameterAdmin)
-
+admin.site.register(Job, JobAdmin)
@@ -4,6 +4,8 @@ from django.utils.translation import ugettext as _
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User
 
+import datetime
+import time
 import simplejson as json
 
 import gbd.fields
@@ -308,6 +310,13 @@ def create_disease_model(dj, creator):
 
     return dm
 
+def stat_param_key(stat):
+    """ Return the param that holds the estimates of statistic stat
+    (e.g. 'mcmc_mean' for 'mean', and 'map' for 'map')"""
+    if stat in ['map', 'initial_value', 'truth']:
+        return stat
+    return 'mcmc_%s' % stat
+
 class DiseaseModelParameter(models.Model):
     """ Any sort of semi-structured data that is associated with a
     disease model.
@@ -315,13 +324,14 @@ class DiseaseModelParameter(models.Model):
     Used for holding priors, initial values, model fits, etc.
     """
     # TODO: remove region, sex, year, type, file from dm_param 
-    region = models.CharField(max_length=200, blank=True)
+    region = models.CharField(max_length=200, blank=True, db_index=True)
     sex = gbd.fields.SexField(blank=True)
     year = models.CharField(max_length=200, blank=True)
     type = gbd.fields.DataTypeField(blank=True)
     file = models.FileField(upload_to='%Y/%m/%d', blank=True)
 
-    key = models.CharField(max_length=200)
+    # indexed, with region, for DiseaseModel.posterior_slice
+    key = models.CharField(max_length=200, db_index=True)
     json = models.TextField(default=json.dumps({}))
 
 
@@ -386,6 +396,118 @@ class DiseaseModel(models.Model):
         param.save()
         self.params.add(param)
 
+    def update_params(self, params):
+        """ Store the params of a dismod_dataset json in this model,
+        adding to or replacing the params already stored
+
+        The params may be partial, as in a patch from
+        DiseaseJson.params_patch; params that are not included are
+        left unchanged.
+
+        Results
+        -------
+        Returns the set of regions whose gbd-keyed params changed, and
+        a flag that is True if any params not keyed by region changed
+        """
+        regions = set()
+        global_change = False
+        from dismod3.results_store import is_estimate_param
+        store = None
+        if [key for key, val in params.items() if is_estimate_param(key) and isinstance(val, dict)]:
+            # bring the results store up to date with the estimates
+            # before they change, so that the patch is all it needs
+            store = self.results_store()
+        for key, val in params.items():
+            if isinstance(val, dict):
+                # look up the stored params for this key in one query
+                stored = {}
+                for p in self.params.filter(key=key):
+                    stored[(p.type, p.region, p.year, p.sex)] = p
+
+                for subkey in val:
+                    t,r,y,s = dismod3.type_region_year_sex_from_key(subkey)
+                    if t != 'unknown':
+                        param = stored.get((t, r, y, s))
+                        if not param:
+                            param = self.params.create(key=key, type=t, region=r, sex=s, year=y)
+                        param.json = json.dumps(val[subkey])
+                        regions.add(r)
+                    else:
+                        param = stored.get((t, '', '', ''))
+                        if not param:
+                            param = self.params.create(key=key, type=t)
+                        pd = json.loads(param.json)
+                        pd[subkey] = val[subkey]
+                        param.json = json.dumps(pd)
+                        global_change = True
+                    param.save()
+
+            else:
+                param, flag = self.params.get_or_create(key=key)
+                param.json = json.dumps(val)
+                param.save()
+                global_change = True
+
+        if store:
+            self.results_changed()
+            store.update(params)
+            store.set_stamp(self.results_version())
+            store.close()
+        return regions, global_change
+
+    def estimate_params(self):
+        """ Return the params of this model that hold its estimates
+        (see dismod3/results_store.py)"""
+        from django.db.models import Q
+        from dismod3.results_store import ESTIMATE_PARAMS
+        return self.params.exclude(region='').filter(Q(key__in=ESTIMATE_PARAMS) | Q(key__startswith='mcmc_'))
+
+    def results_version(self):
+        """ Return the version of the estimates of this model (see ResultsVersion)"""
+        import uuid
+        version, created = ResultsVersion.objects.get_or_create(disease_model=self,
+                                                                defaults={'version': uuid.uuid4().hex})
+        return version.version
+
+    def results_changed(self):
+        """ Give the estimates of this model a new version, so that
+        its results store is filled again the next time it is opened;
+        code that changes the estimate params other than through
+        update_params must call this"""
+        ResultsVersion.objects.filter(disease_model=self).delete()
+
+    def results_store(self):
+        """ Return the results store of this model (see
+        dismod3/results_store.py), filling it again from the stored
+        estimates if they have changed since it was filled"""
+        from dismod3.results_store import ResultsStore, store_fname, is_estimate
+        store = ResultsStore(store_fname(self.id))
+        version = self.results_version()
+        if store.stamp() != version:
+            store.clear()
+            for p in self.estimate_params():
+                if p.type and p.region and p.sex and p.year:
+                    key = dismod3.gbd_key_for(p.type, p.region, p.year, p.sex)
+                    try:
+                        val = json.loads(p.json)
+                    except ValueError:
+                        # skip bad json, it sometimes happens, for unknown reasons (HTTP glitches?)
+                        continue
+                    if is_estimate(key, val):
+                        store.put(p.key, key, val)
+            store.set_stamp(version)
+        return store
+
+    def clear_cached_plots(self, regions=None):
+        """ Delete the cached plots of this model, or, if regions is
+        given, only those for the regions in it and those not specific
+        to any region"""
+        plots = self.params.filter(key__contains='plot')
+        if regions != None:
+            plots = plots.filter(region__in=list(regions) + ['', 'all'])
+        for p in plots:
+            p.delete()
+
     def to_djson(self, region='*'):
         """ Return a dismod_dataset json corresponding to this model object
 
@@ -444,6 +566,124 @@ class DiseaseModel(models.Model):
 
         return dj
 
+    def posterior_slice(self, types=None, regions=None, years=None, sexes=None,
+                        stats=['mean'], age_start=None, age_end=None):
+        """ Return a selection of the estimates of this model, reading
+        only the params that hold them
+
+        Parameters
+        ----------
+        types, regions, years, sexes : lists of str, optional
+          the gbd keys to select; None selects all of them
+        stats : list of str, optional
+          the statistics to select, e.g. 'mean', 'lower_ui',
+          'upper_ui', 'emp_prior_mean' or 'map'
+        age_start, age_end : int, optional
+          the range of ages to select from the estimate age mesh;
+          None selects all of it
+
+        Results
+        -------
+        Returns the selected ages, and a dict with a dict for each
+        statistic of the estimates of each selected gbd key that has
+        one, as arrays over the selected ages
+
+        Example
+        -------
+        >> dm = DiseaseModel.objects.get(id=1)
+        >> ages, slices = dm.posterior_slice(types=['prevalence'], years=['2005'], sexes=['male'], age_start=15, age_end=49)
+        >> slices['mean']['prevalence+asia_east+2005+male']
+        """
+        from dismod3.array_encoding import decode
+        from dismod3.utils import indices_for_range
+
+        age_mesh = range(dismod3.settings.MAX_AGE)
+        for p in self.params.filter(key='estimate_age_mesh').order_by('-id')[:1]:
+            age_mesh = json.loads(p.json)
+        if age_start == None:
+            age_start = age_mesh[0]
+        if age_end == None:
+            age_end = age_mesh[-1]
+        ii = indices_for_range(age_mesh, age_start, age_end)
+        if years != None:
+            years = [str(y) for y in years]
+
+        def selected(t, r, y, s):
+            return t != 'unknown' and (types == None or t in types) and (regions == None or r in regions) \
+                   and (years == None or y in years) and (sexes == None or s in sexes)
+
+        stat_for = dict([[stat_param_key(stat), stat] for stat in stats])
+        slices = dict([[stat, {}] for stat in stats])
+        def add(p_key, gbd_key, val):
+            try:
+                val = decode(val)
+            except (TypeError, ValueError):
+                return
+            if len(val.shape) == 1 and len(val) == len(age_mesh):  # skip the {} of a bad mcmc key
+                slices[stat_for[p_key]][gbd_key] = val[ii]
+
+        # the estimates of a model created from a whole json are
+        # stored in one param that is not specific to a region
+        for p in self.params.filter(key__in=stat_for.keys(), region=''):
+            try:
+                d = json.loads(p.json)
+            except ValueError:
+                continue
+            if isinstance(d, dict):
+                for gbd_key, val in d.items():
+                    if selected(*dismod3.type_region_year_sex_from_key(gbd_key)):
+                        add(p.key, gbd_key, val)
+
+        # those stored since are in one param for each gbd key
+        params = self.params.filter(key__in=stat_for.keys()).exclude(region='')
+        if types != None:
+            params = params.filter(type__in=types)
+        if regions != None:
+            params = params.filter(region__in=regions)
+        if years != None:
+            params = params.filter(year__in=years)
+        if sexes != None:
+            params = params.filter(sex__in=sexes)
+        for p in params:
+            try:
+                val = json.loads(p.json)
+            except ValueError:
+                # skip bad json, it sometimes happens, for unknown reasons (HTTP glitches?)
+                continue
+            add(p.key, dismod3.gbd_key_for(p.type, p.region, p.year, p.sex), val)
+
+        return [age_mesh[i] for i in ii], slices
+
+    def results_djson(self):
+        """ Return a dismod_dataset json of this model without the
+        params that hold its estimates, which reads the estimates it
+        is asked for from the results store of the model instead, for
+        the views that plot, tabulate or map a few of them
+
+        Example
+        -------
+        >> dm = DiseaseModel.objects.get(id=1)
+        >> dm.results_djson().get_mcmc('mean', 'prevalence+asia_east+2005+male')
+        """
+        store = self.results_store()
+        dj = self.to_djson(region='none')
+
+        # the other region-keyed params, such as the units and priors
+        # of each key, are still read from the database (but not the
+        # cached plots)
+        estimate_ids = self.estimate_params().values_list('id', flat=True)
+        for p in self.params.exclude(region='').exclude(id__in=estimate_ids).exclude(key__contains='plot'):
+            if p.type and p.region and p.sex and p.year:
+                try:
+                    val = json.loads(p.json)
+                except ValueError:
+                    # skip bad json, it sometimes happens, for unknown reasons (HTTP glitches?)
+                    continue
+                dj.params.setdefault(p.key, {})[dismod3.gbd_key_for(p.type, p.region, p.year, p.sex)] = val
+
+        dj.results = store
+        return dj
+
     def country_level_covariates(self):
         from gbd.covariate_data_server.models import CovariateType, Covariate
         cov_dict = {}
@@ -527,3 +767,226 @@ class DiseaseModel(models.Model):
         return cov_dict
    
 
+
+class ResultsVersion(models.Model):
+    """ The version of the estimates of a disease model
+
+    A new version is made whenever the estimates change (see
+    DiseaseModel.results_changed), and the results store of the model
+    is stamped with the version it was filled from, so that the store
+    is filled again if they differ, even when the database was reset
+    and the model id reused.
+    """
+    disease_model = models.ForeignKey(DiseaseModel, unique=True)
+    version = models.CharField(max_length=32)
+
+    def __unicode__(self):
+        return '%s: %s' % (self.disease_model_id, self.version)
+
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'disease_model', 'state', 'priority', 'predicted_secs', 'tries', 'worker', 'lease_expires')
+    list_filter = ['state', 'worker',]
+    search_fields = ['id',]
+
+class Job(models.Model):
+    """ A fit of a disease model on the job queue
+
+    A daemon that claims a queued job holds a lease on it, which it
+    renews while the fit runs.  If the lease expires, because the
+    daemon died, the job goes back on the queue, until it has been
+    tried dismod3.settings.JOB_MAX_TRIES times.  Every change of state
+    is a conditional update, so a job is only ever held by one daemon.
+
+    The job's parameter (keyed 'needs_to_run' while queued and
+    'run_status' once claimed) holds the details of the fit, as the
+    daemons read them from the disease model json.
+
+    The features of the fit (see dismod3.runtime_model) and its
+    predicted run time are stored when the job is queued, and the
+    times it started and finished when it runs, so that finished jobs
+    train the predictions for later ones.
+    """
+    STATE_CHOICES = (('queued', 'Queued'), ('running', 'Running'),
+                     ('done', 'Done'), ('failed', 'Failed'))
+
+    disease_model = models.ForeignKey(DiseaseModel)
+    param = models.ForeignKey(DiseaseModelParameter)
+
+    state = models.CharField(max_length=10, choices=STATE_CHOICES, default='queued', db_index=True)
+    priority = models.IntegerField(default=0, db_index=True)
+    tries = models.IntegerField(default=0)
+    worker = models.CharField(max_length=200, blank=True)
+    lease_expires = models.DateTimeField(null=True, blank=True, db_index=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    features = models.TextField(default=json.dumps({}))
+    predicted_secs = models.FloatField(default=0., db_index=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    class Meta:
+        ordering = ['-priority', 'id']
+
+    def __unicode__(self):
+        return '%d: %s (%s)' % (self.id, self.disease_model_id, self.state)
+
+    def renew(self, worker, lease_secs=dismod3.settings.JOB_LEASE_SECS):
+        """ Extend the lease of worker on this job
+
+        Results
+        -------
+        Returns True if worker still holds the job
+        """
+        rows = Job.objects.filter(id=self.id, state='running', worker=worker).update(
+            lease_expires=datetime.datetime.now() + datetime.timedelta(seconds=lease_secs))
+        return rows == 1
+
+    def finish(self, worker, failed=False, timed=True):
+        """ Mark the job held by worker as done (or failed)
+
+        If timed is False, the time the job finished is not recorded,
+        e.g. because the worker only submitted it to the cluster, so
+        it does not train the run time predictions.
+
+        Results
+        -------
+        Returns True if worker held the job
+        """
+        state = failed and 'failed' or 'done'
+        finished = None
+        if timed:
+            finished = datetime.datetime.now()
+        rows = Job.objects.filter(id=self.id, state='running', worker=worker).update(
+            state=state, lease_expires=None, finished=finished)
+        return rows == 1
+
+    def predicted_minutes(self):
+        return self.predicted_secs / 60.
+
+    def run_secs(self):
+        """ Return the seconds from the start of the job to its finish"""
+        d = self.finished - self.started
+        return d.days * 86400. + d.seconds + d.microseconds / 1.e6
+
+def runtime_records(n=1000):
+    """ Return the [features, seconds] of the n most recently finished
+    jobs, for training a RuntimePredictor"""
+    records = []
+    for job in Job.objects.filter(state='done', finished__isnull=False, started__isnull=False).order_by('-finished')[:n]:
+        records.append([json.loads(job.features), job.run_secs()])
+    return records
+
+_runtime_predictor = None
+_runtime_predictor_time = 0.
+
+def runtime_predictor():
+    """ Return a RuntimePredictor trained on the timings of recently
+    finished jobs, retraining it at most every RUNTIME_RETRAIN_SECS"""
+    global _runtime_predictor, _runtime_predictor_time
+    if _runtime_predictor == None or time.time() - _runtime_predictor_time > dismod3.settings.RUNTIME_RETRAIN_SECS:
+        from dismod3.runtime_model import RuntimePredictor
+        _runtime_predictor = RuntimePredictor()
+        _runtime_predictor.train(runtime_records())
+        _runtime_predictor_time = time.time()
+    return _runtime_predictor
+
+def enqueue_job(dm, param, priority=0):
+    """ Put a fit of disease model dm on the job queue, with the details
+    of the fit in param (keyed 'needs_to_run'), and predict its run time"""
+    from dismod3.runtime_model import job_features
+    param_val = json.loads(param.json)
+    features = job_features(param_val.get('estimate_type', ''),
+                            list(dm.data.values_list('data_type', flat=True)),
+                            param_val.get('regions_to_fit', []))
+    return Job.objects.create(disease_model=dm, param=param, priority=priority,
+                              features=json.dumps(features),
+                              predicted_secs=runtime_predictor().predict(features))
+
+# the orders in which jobs of equal priority can be claimed
+JOB_CLAIM_ORDERS = {'shortest': ['predicted_secs', 'id'],
+                    'longest': ['-predicted_secs', 'id'],
+                    'oldest': ['id']}
+
+def requeue_expired_jobs():
+    """ Put the running jobs whose leases have expired back on the
+    queue, or mark them failed if they have been tried too often"""
+    now = datetime.datetime.now()
+    expired = Job.objects.filter(state='running', lease_expires__lt=now)
+    expired.filter(tries__gte=dismod3.settings.JOB_MAX_TRIES).update(state='failed', lease_expires=None)
+    expired.update(state='queued', worker='', lease_expires=None, started=None)
+
+def claim_next_job(worker, lease_secs=dismod3.settings.JOB_LEASE_SECS, job_id=None, order='shortest'):
+    """ Lease the queued job with the highest priority to worker,
+    choosing among those of equal priority by order
+
+    To keep long jobs from waiting forever behind a stream of short
+    ones, jobs that have been queued for more than JOB_QUEUE_MAX_WAIT
+    seconds are claimed first, oldest first.
+
+    Parameters
+    ----------
+    worker : str
+      a name for the daemon claiming the job
+    lease_secs : float, optional
+      the time the worker holds the job for without renewing its lease
+    job_id : int, optional
+      claim only the job with this id
+    order : str, optional
+      one of JOB_CLAIM_ORDERS: 'shortest' for the shortest predicted
+      run time first (for interactive use), 'longest' for the longest
+      first (for packing batch runs), or 'oldest'
+
+    Results
+    -------
+    Returns the Job, or None if the queue is empty
+    """
+    requeue_expired_jobs()
+    while True:
+        queued = Job.objects.filter(state='queued')
+        if job_id != None:
+            queued = queued.filter(id=job_id)
+        max_wait = datetime.datetime.now() - datetime.timedelta(seconds=dismod3.settings.JOB_QUEUE_MAX_WAIT)
+        candidates = list(queued.filter(created__lt=max_wait).order_by('id')[:10]) \
+                     or list(queued.order_by('-priority', *JOB_CLAIM_ORDERS[order])[:10])
+        if not candidates:
+            return None
+        for job in candidates:
+            now = datetime.datetime.now()
+            rows = Job.objects.filter(id=job.id, state='queued').update(
+                state='running', worker=worker, tries=job.tries + 1, started=now,
+                lease_expires=now + datetime.timedelta(seconds=lease_secs))
+            if rows == 1:
+                job = Job.objects.get(id=job.id)
+                job.param.key = 'run_status'
+                param_val = json.loads(job.param.json)
+                param_val['run_status'] = '%s started at %s' % (param_val.get('estimate_type', ''), time.strftime('%H:%M on %m/%d/%Y'))
+                job.param.json = json.dumps(param_val)
+                job.param.save()
+                return job
+            # another worker claimed this one first, so try the next
+
+def predicted_completion_times(n_workers=dismod3.settings.JOB_QUEUE_WORKERS, order='shortest'):
+    """ Predict when each running and queued job will finish, if
+    n_workers daemons claim the queued jobs in the given order
+
+    Results
+    -------
+    Returns a list of (job, predicted finish datetime) pairs, for the
+    running jobs and then the queued jobs in the order they will run
+    """
+    now = datetime.datetime.now()
+    results = []
+    free = []  # the times at which each worker will be free
+    for job in Job.objects.filter(state='running').order_by('started'):
+        finish = max(now, (job.started or now) + datetime.timedelta(seconds=job.predicted_secs))
+        results.append((job, finish))
+        free.append(finish)
+    free = sorted(free)[-n_workers:]
+    free += [now] * (n_workers - len(free))
+
+    for job in Job.objects.filter(state='queued').order_by('-priority', *JOB_CLAIM_ORDERS[order]):
+        free.sort()
+        finish = free[0] + datetime.timedelta(seconds=job.predicted_secs)
+        free[0] = finish
+        results.append((job, finish))
+    return results
@@ -715,6 +715,26 @@ class DisModDataServerTestCase(TestCase):
             assert 0, 'Response could not be interpreted as JSON'
         self.assertEqual(set(r_json.keys()), set(['params', 'data', 'id']))
         
+    def test_get_model_json_etag(self):
+        """ Test that the json is not sent again to a client with a current copy"""
+        c = Client()
+        c.login(username='red', password='red')
+        url = self.dm.get_absolute_url() + '.json'
+        response = c.get(url)
+        etag = response['ETag']
+
+        response = c.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, '')
+
+        # changing the model changes the etag
+        p = DiseaseModelParameter(key='notes', json=json.dumps('changed'))
+        p.save()
+        self.dm.params.add(p)
+        response = c.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertSuccess(response)
+        self.assertNotEqual(response['ETag'], etag)
+
     def test_post_model_json(self):
         """ Test posting a json encoding of the disease model"""
         c = Client()
@@ -761,6 +781,29 @@ class DisModDataServerTestCase(TestCase):
         self.assertEqual(DiseaseModel.objects.count(), initial_dm_cnt+1)
         
 
+    def test_post_model_json_body(self):
+        """ Test posting a disease model as the json body of the request"""
+        c = Client()
+        c.login(username='red', password='red')
+        url = reverse('gbd.dismod_data_server.views.dismod_upload')
+
+        # check that bad input is rejected
+        response = c.post(url, '{}', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+        # check that good input updates the model, and returns its url as json
+        p = DiseaseModelParameter(key='map', json=json.dumps({'prevalence': [0,0,0,0]}))
+        p.save()
+        self.dm.params.add(p)
+        dm_json = self.dm.to_djson().to_json()
+        self.dm.params.remove(p)
+
+        response = c.post(url, dm_json, content_type='application/json')
+        self.assertSuccess(response)
+        self.assertEqual(json.loads(response.content), {'id': self.dm.id, 'url': self.dm.get_absolute_url()})
+        dm = DiseaseModel.objects.get(id=self.dm.id)
+        self.assertEqual(json.loads(dm.params.filter(key='map').latest('id').json)['prevalence'], [0,0,0,0])
+
     def test_post_model_json_refreshes_cache(self):
         """ Test that posting updated disease model refreshes cache"""
         c = Client()
@@ -789,6 +832,34 @@ class DisModDataServerTestCase(TestCase):
         self.assertEqual(self.dm.params.filter(key__contains='plot').count(), 0)
         
 
+    def test_post_model_patch(self):
+        """ Test posting a gzipped patch of params, and that it only clears the cached plots it changes"""
+        c = Client()
+        c.login(username='red', password='red')
+        url = reverse('gbd.dismod_data_server.views.dismod_upload_patch', args=[self.dm.id])
+
+        # check that bad input is rejected
+        response = c.post(url, 'not json', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+        # make cached plots for two regions
+        for r in ['asia_southeast', 'europe_western']:
+            p = DiseaseModelParameter(key='tile-plot-png', type='prevalence', region=r, year='2005', sex='male', json='{}')
+            p.save()
+            self.dm.params.add(p)
+
+        # post a patch changing a key in one region
+        from dismod3.http_client import gzip_str
+        patch = {'id': self.dm.id, 'params': {'map': {'prevalence+asia_southeast+2005+male': [0,0,0,0]}}}
+        response = c.post(url, gzip_str(json.dumps(patch)), content_type='application/json',
+                          HTTP_CONTENT_ENCODING='gzip')
+        self.assertSuccess(response)
+        self.assertEqual(json.loads(response.content), {'id': self.dm.id, 'url': self.dm.get_absolute_url()})
+
+        dm = DiseaseModel.objects.get(id=self.dm.id)
+        self.assertEqual(dm.to_djson().get_map('prevalence+asia_southeast+2005+male').tolist(), [0,0,0,0])
+        self.assertEqual([p.region for p in dm.params.filter(key__contains='plot')], ['europe_western'])
+
     def test_get_job_queue_list_and_remove(self):
         """ Test getting list of jobs waiting on queue to run"""
         c = Client()
@@ -799,6 +870,7 @@ class DisModDataServerTestCase(TestCase):
         p.save()
         self.dm.params.add(p)
         self.dm.save()
+        enqueue_job(self.dm, p)
 
         # test GET list
         url = reverse('gbd.dismod_data_server.views.job_queue_list')
@@ -815,8 +887,114 @@ class DisModDataServerTestCase(TestCase):
 
         dm = DiseaseModel.objects.get(id=self.dm.id)
         self.assertTrue(self.dm.params.filter(key='needs_to_run').count() == 0)
+
+        # test POST remove with a json body
+        p = DiseaseModelParameter(key='needs_to_run', json=json.dumps({'dm_id': self.dm.id}))
+        p.save()
+        self.dm.params.add(p)
+        enqueue_job(self.dm, p)
+        response = c.post(url, json.dumps({'id': p.id}), content_type='application/json')
+        self.assertEqual(json.loads(response.content)['dm_id'], self.dm.id)
+        self.assertTrue(self.dm.params.filter(key='needs_to_run').count() == 0)
         
 
+    def test_job_queue_claim(self):
+        """ Test claiming jobs from the queue, each exactly once, in order of priority"""
+        c = Client()
+        c.login(username='red', password='red')
+        url = reverse('gbd.dismod_data_server.views.job_queue_claim')
+
+        jobs = []
+        for priority in [0, 1, 0]:
+            p = DiseaseModelParameter(key='needs_to_run', json=json.dumps({'dm_id': self.dm.id, 'estimate_type': 'posterior'}))
+            p.save()
+            self.dm.params.add(p)
+            jobs.append(enqueue_job(self.dm, p, priority))
+
+        # jobs are claimed highest priority first, then oldest first
+        for job in [jobs[1], jobs[0], jobs[2]]:
+            response = c.post(url, {'timeout': 0, 'worker': 'w1'})
+            r_json = json.loads(response.content)
+            self.assertEqual(r_json['job_id'], job.id)
+            self.assertEqual(r_json['param_id'], job.param_id)
+            self.assertEqual(r_json['dm_id'], self.dm.id)
+        self.assertEqual(Job.objects.filter(state='running', worker='w1').count(), 3)
+        self.assertEqual(self.dm.params.filter(key='needs_to_run').count(), 0)
+
+        # with nothing on the queue, the claim waits for the timeout and returns null
+        response = c.post(url, {'timeout': .1, 'worker': 'w1'})
+        self.assertEqual(json.loads(response.content), None)
+
+    def test_job_queue_lease(self):
+        """ Test renewing and finishing a leased job, and requeueing it when its lease expires"""
+        c = Client()
+        c.login(username='red', password='red')
+
+        p = DiseaseModelParameter(key='needs_to_run', json=json.dumps({'dm_id': self.dm.id}))
+        p.save()
+        self.dm.params.add(p)
+        job = enqueue_job(self.dm, p)
+
+        # a job whose lease expires goes back on the queue, and is claimed again
+        self.assertEqual(claim_next_job('w1', lease_secs=-1).id, job.id)
+        self.assertEqual(claim_next_job('w2').id, job.id)
+        self.assertEqual(Job.objects.get(id=job.id).tries, 2)
+
+        # only the worker holding the lease can renew it, or finish the job
+        url = reverse('gbd.dismod_data_server.views.job_queue_renew', args=[job.id])
+        response = c.post(url, {'worker': 'w1'})
+        self.assertEqual(json.loads(response.content), {'held': False})
+        response = c.post(url, {'worker': 'w2'})
+        self.assertEqual(json.loads(response.content), {'held': True})
+
+        url = reverse('gbd.dismod_data_server.views.job_queue_finish', args=[job.id])
+        response = c.post(url, {'worker': 'w2', 'failed': 0})
+        self.assertEqual(json.loads(response.content), {'held': True})
+        self.assertEqual(Job.objects.get(id=job.id).state, 'done')
+
+        # a job that keeps losing its lease is marked failed
+        job = enqueue_job(self.dm, p)
+        for i in range(dismod3.settings.JOB_MAX_TRIES):
+            self.assertEqual(claim_next_job('w1', lease_secs=-1).id, job.id)
+        self.assertEqual(claim_next_job('w1'), None)
+        self.assertEqual(Job.objects.get(id=job.id).state, 'failed')
+
+    def test_job_queue_order(self):
+        """ Test claiming jobs shortest or longest predicted run time first, and predicting when they finish"""
+        c = Client()
+        c.login(username='red', password='red')
+
+        jobs = []
+        for regions in [['asia_east'], ['all_regions'], ['asia_east', 'europe_western']]:
+            p = DiseaseModelParameter(key='needs_to_run', json=json.dumps({'dm_id': self.dm.id, 'estimate_type': 'posterior',
+                                                                            'regions_to_fit': regions}))
+            p.save()
+            self.dm.params.add(p)
+            jobs.append(enqueue_job(self.dm, p))
+        self.assertTrue(jobs[0].predicted_secs < jobs[2].predicted_secs < jobs[1].predicted_secs)
+
+        # the predicted finish times follow the claim order
+        finish = dict([[job.id, t] for job, t in predicted_completion_times(1)])
+        self.assertTrue(finish[jobs[0].id] < finish[jobs[2].id] < finish[jobs[1].id])
+        response = c.get(reverse('gbd.dismod_data_server.views.job_queue_list'))
+        self.assertTemplateUsed(response, 'job_queue_list.html')
+
+        url = reverse('gbd.dismod_data_server.views.job_queue_claim')
+        response = c.post(url, {'timeout': 0, 'order': 'longest'})
+        self.assertEqual(json.loads(response.content)['job_id'], jobs[1].id)
+        response = c.post(url, {'timeout': 0, 'order': 'shortest'})
+        self.assertEqual(json.loads(response.content)['job_id'], jobs[0].id)
+        response = c.post(url, {'timeout': 0, 'order': 'fastest'})
+        self.assertEqual(response.status_code, 400)
+
+        # finished jobs are listed with their features and run times
+        url = reverse('gbd.dismod_data_server.views.job_queue_finish', args=[jobs[1].id])
+        c.post(url, {'worker': 'red', 'failed': 0})
+        response = c.get(reverse('gbd.dismod_data_server.views.job_queue_timings'))
+        timings = json.loads(response.content)
+        self.assertEqual(len(timings), 1)
+        self.assertEqual(timings[0][0], json.loads(jobs[1].features))
+
     def test_job_queue_add(self):
         """ Test adding a job to job queue to run"""
         c = Client()
@@ -830,6 +1008,162 @@ class DisModDataServerTestCase(TestCase):
         p = dm.params.filter(key='needs_to_run').latest('id')
         self.assertEqual(json.loads(p.json).get('estimate_type'), 'fit each region/year/sex individually')
 
+    def test_dismod_show_events(self):
+        """ Test that the event log of a fit is sent from an offset, with its summary"""
+        import os
+        import gbd.dismod3.event_log as event_log
+        c = Client()
+        c.login(username='red', password='red')
+
+        fname = event_log.log_fname(self.dm.id, 'posterior', 'asia_east+male+2005')
+        for f in [fname, event_log.index_fname(fname)]:
+            if os.path.exists(f):
+                os.remove(f)  # left by an earlier test run
+        log = event_log.EventLog(fname)
+        log.log('phase_start', phase='mcmc')
+        log.log('progress', iters_done=1000, iter=2000)
+
+        url = reverse('gbd.dismod_data_server.views.dismod_show_events',
+                      args=[self.dm.id, 'posterior', 'asia_east+male+2005'])
+        response = c.get(url)
+        r = json.loads(response.content)
+        self.assertEqual([e['event'] for e in r['events']], ['phase_start', 'progress'])
+        self.assertEqual(r['summary']['progress'], [1000, 2000])
+
+        log.log('finish', state='failed')
+        response = c.get(url, {'offset': r['offset']})
+        r = json.loads(response.content)
+        self.assertEqual([e['event'] for e in r['events']], ['finish'])
+
+        response = c.get(url, {'offset': 'x'})
+        self.assertEqual(response.status_code, 400)
+
+        url = reverse('gbd.dismod_data_server.views.dismod_show_events_summary',
+                      args=[self.dm.id, 'posterior'])
+        response = c.get(url)
+        self.assertEqual(json.loads(response.content)['asia_east+male+2005']['state'], 'failed')
+
+    def test_read_tail(self):
+        """ Test that the output of a fit is read from where the last poll stopped, up to its last bytes"""
+        import os
+        from views import read_tail
+        d = '%s/posterior/stdout' % (dismod3.settings.JOB_WORKING_DIR % self.dm.id)
+        if not os.path.exists(d):
+            os.makedirs(d)
+        fname = '%s/asia_east+male+2005' % d
+        f = open(fname, 'w')
+        f.write('line 1\n')
+        f.close()
+        self.assertEqual(read_tail(fname, 20), 'line 1\n')
+
+        f = open(fname, 'a')
+        f.write('line 2\nline 3\n')
+        f.close()
+        self.assertEqual(read_tail(fname, 20), '[first 7 bytes not shown]\nline 2\nline 3\n')
+
+        # a fit that is run again starts its output over
+        os.remove(fname)
+        f = open(fname, 'w')
+        f.write('rerun\n')
+        f.close()
+        self.assertEqual(read_tail(fname, 20), 'rerun\n')
+        os.remove(fname)
+        self.assertEqual(read_tail(fname, 20), 'unavailable')
+
+    def test_dismod_server_load(self):
+        """ Test that the server load is shown from the cached snapshot"""
+        from django.core.cache import cache
+        c = Client()
+
+        cache.set('server_load', {'qstat': 'job-ID  prior   name\n', 'local': {},
+                                  'age': 3., 'fetched': time.time()})
+        url = reverse('gbd.dismod_data_server.views.dismod_server_load')
+        response = c.get(url)
+        self.assertEqual(response.content, 'job-ID  prior   name')
+        assert float(response['X-Snapshot-Age']) >= 3.
+
+        response = c.get(url, {'format': 'json'})
+        self.assertEqual(json.loads(response.content)['local'], {})
+        cache.delete('server_load')
+
+    def test_results_store(self):
+        """ Test that the results store of a model is built from its params, and kept up to date"""
+        from dismod3.results_store import ResultsStore, store_fname
+        k = 'prevalence+asia_southeast+2005+male'
+
+        # a store left by a model that had this id before is filled again
+        store = ResultsStore(store_fname(self.dm.id))
+        store.put('mcmc_mean', k, [.9])
+        store.set_stamp('stale')
+        store.close()
+
+        self.dm.update_params({'mcmc_mean': {k: [.1, .2]}})
+        store = self.dm.results_store()
+        self.assertEqual(store.stamp(), self.dm.results_version())
+        self.assertEqual(store.get('mcmc_mean', k).tolist(), [.1, .2])
+        store.close()
+
+        # params changed after the store is built are stored in it too
+        self.dm.update_params({'mcmc_mean': {k: [.3, .4]},
+                               'units': {k: 'per 1000'},
+                               'priors': {k: 'smooth 10'}})
+        dj = self.dm.results_djson()
+        assert not dj.params.has_key('mcmc_mean')
+        self.assertEqual(dj.get_mcmc('mean', k).tolist(), [.3, .4])
+        self.assertEqual(dj.get_units(k), 'per 1000')
+        self.assertEqual(dj.get_priors(k), 'smooth 10')
+        dj.results.close()
+
+        # cached plots do not change the version of the estimates
+        version = self.dm.results_version()
+        self.dm.update_params({'units': {k: 'per 100'}})
+        plot = DiseaseModelParameter(key='tile-plot', region='asia_southeast')
+        plot.save()
+        self.dm.params.add(plot)
+        self.dm.clear_cached_plots()
+        self.assertEqual(self.dm.results_version(), version)
+
+        # estimates changed without update_params are read again once marked as changed
+        p = self.dm.params.get(key='mcmc_mean', region='asia_southeast')
+        p.json = json.dumps([.5, .6])
+        p.save()
+        self.dm.results_changed()
+        store = self.dm.results_store()
+        self.assertEqual(store.get('mcmc_mean', k).tolist(), [.5, .6])
+        store.close()
+
+    def test_posterior_slice(self):
+        """ Test selecting estimates of a model by gbd key, statistic and age"""
+        import dismod3.array_encoding as array_encoding
+        k_m = 'prevalence+asia_southeast+2005+male'
+        k_f = 'prevalence+asia_southeast+2005+female'
+        self.dm.update_params({'estimate_age_mesh': [0, 10, 20, 30],
+                               'mcmc_mean': {k_m: [.1, .2, .3, .4], k_f: [.5, .6, .7, .8]},
+                               'mcmc_upper_ui': {k_m: [1., 2., 3., 4.]}})
+
+        ages, slices = self.dm.posterior_slice(types=['prevalence'], regions=['asia_southeast'], years=['2005'],
+                                               sexes=['male'], stats=['mean', 'upper_ui'], age_start=10, age_end=20)
+        self.assertEqual(ages, [10, 20])
+        self.assertEqual(slices['mean'].keys(), [k_m])
+        self.assertEqual(slices['mean'][k_m].tolist(), [.2, .3])
+        self.assertEqual(slices['upper_ui'][k_m].tolist(), [2., 3.])
+
+        c = Client()
+        c.login(username='red', password='red')
+        url = reverse('gbd.dismod_data_server.views.dismod_posterior_slice', args=[self.dm.id])
+        response = c.get(url, {'region': 'asia_southeast', 'year': '2005', 'sex': 'male,female', 'age_start': 0, 'age_end': 10})
+        self.assertSuccess(response)
+        r = json.loads(response.content)
+        self.assertEqual(r['age'], [0, 10])
+        self.assertEqual(r['estimates']['mean'][k_f], [.5, .6])
+
+        response = c.get(url, {'region': 'asia_southeast', 'sex': 'female', 'encoding': '<f8'})
+        r = json.loads(response.content)
+        self.assertEqual(array_encoding.decode(r['estimates']['mean'][k_f]).tolist(), [.5, .6, .7, .8])
+
+        response = c.get(url, {'age_start': 'x'})
+        self.assertEqual(response.status_code, 400)
+
     def test_dismod_run(self):
         """ Test adding a job to job queue to run"""
         c = Client()
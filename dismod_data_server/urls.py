@@ -9,9 +9,14 @@ urlpatterns = patterns(
     (r'data/(\d+).(\w+)$', 'data_show'),
                        
     (r'upload/$', 'dismod_upload'),
+    (r'upload/(\d+)$', 'dismod_upload_patch'),
     (r'job_queue/list/', 'job_queue_list'),
     (r'job_queue/add/(\d+)', 'job_queue_add'),
     (r'job_queue/remove', 'job_queue_remove'),
+    (r'job_queue/claim/', 'job_queue_claim'),
+    (r'job_queue/renew/(\d+)', 'job_queue_renew'),
+    (r'job_queue/finish/(\d+)', 'job_queue_finish'),
+    (r'job_queue/timings/', 'job_queue_timings'),
     
     (r'show/spark_(\d+)\.(\w+)$', 'dismod_sparkplot'),
     (r'show/overlay_(\d+)_([\w-]+)\+([\w-]+)\+([\w-]+)\+(\w+)\+(\w+)\.(\w+)', 'dismod_plot', {'style': 'overlay'}),
@@ -25,6 +30,7 @@ urlpatterns = patterns(
     (r'show/(\d+)/([\w-]+)\.(\w+)$', 'dismod_show_by_region'),
      
     (r'download_posterior/(\d+)$', 'dismod_download_posterior'),
+    (r'posterior_slice/(\d+)$', 'dismod_posterior_slice'),
     
     (r'show/plot_selected_regions_(\d+)$', 'dismod_show_selected_regions'),
     (r'show/plot_all_years_(\d+)$', 'dismod_show_all_years'),
@@ -57,6 +63,8 @@ urlpatterns = patterns(
     (r'preview_prior/(\d+)', 'dismod_preview_priors'),
     (r'run/(\d+)', 'dismod_run'),
     (r'show_status/(\d+)$', 'dismod_show_status'),
+    (r'show_status/(\d+)/([\w-]+)/events$', 'dismod_show_events_summary'),
+    (r'show_status/(\d+)/([\w-]+)/events/([\w+-]+)$', 'dismod_show_events'),
     (r'init_log/(\d+)/([\w-]+)/(\d+)$', 'dismod_init_log'),
     (r'log_status/(\d+)/([\w-]+)/([\w-]+)/(\w+)$', 'dismod_log_status'),
     (r'server_load$', 'dismod_server_load'),
@@ -5,15 +5,18 @@ from django.core.urlresolvers import reverse
 from django.utils.translation import ugettext as _
 from django import forms
 from django.core.servers.basehttp import FileWrapper
+from django.core.cache import cache
 
 import pymc.gp as gp
 import numpy as np
 import pylab as pl
 import csv
+import hashlib
 from StringIO import StringIO
 import time
 import os
 import socket
+import threading
 from shutil import rmtree
 import math
 
@@ -24,7 +27,10 @@ import dismod3
 from gbd.covariate_data_server.models import CovariateType
 from models import *
 from gbd.dismod3.utils import clean
-from gbd.dismod3.settings import JOB_LOG_DIR, JOB_WORKING_DIR, SERVER_LOAD_STATUS_HOST, SERVER_LOAD_STATUS_PORT, SERVER_LOAD_STATUS_SIZE, DISMOD_BASE_URL
+from gbd.dismod3.settings import JOB_LOG_DIR, JOB_WORKING_DIR, SERVER_LOAD_STATUS_HOST, SERVER_LOAD_STATUS_PORT, SERVER_LOAD_STATUS_SIZE, DISMOD_BASE_URL, \
+     JOB_QUEUE_POLL_TIMEOUT, JOB_QUEUE_CHECK_SECS, JOB_QUEUE_RECHECK_SECS, JOB_QUEUE_STAMP_FILE, STATUS_TAIL_BYTES, SERVER_LOAD_CACHE_SECS
+import gbd.dismod3.event_log as event_log
+import gbd.dismod3.array_encoding as array_encoding
 from gbd.dismod3.table import population_by_region_year_sex
 from gbd.dismod3.neg_binom_model import countries_for
 import fcntl
@@ -227,16 +233,25 @@ def dismod_show(request, id, format='html'):
                                   {'dm': dm,
                                   'paginated_models': view_utils.paginated_models(request, dm.data.all()), 'page_description': 'Full Data from'})
     elif format == 'json':
-        return HttpResponse(dm.to_djson().to_json(), view_utils.MIMETYPE[format])
+        # tag the json with a hash of its content, so that clients with
+        # a current copy (see dismod3.model_cache) need not download it again
+        content = dm.to_djson().to_json()
+        etag = '"%s"' % hashlib.md5(content).hexdigest()
+        if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(content, view_utils.MIMETYPE[format])
+        response['ETag'] = etag
+        return response
     elif format in ['png', 'svg', 'eps', 'pdf']:
-        dismod3.tile_plot_disease_model(dm.to_djson(),
+        dismod3.tile_plot_disease_model(dm.results_djson(),
                                         dismod3.utils.gbd_keys(type_list=dismod3.utils.output_data_types))
         return HttpResponse(view_utils.figure_data(format),
                             view_utils.MIMETYPE[format])
     elif format == 'xls':
         group_size = int(request.GET.get('group_size', 1))
 
-        content = dismod3.table(dm.to_djson(),
+        content = dismod3.table(dm.results_djson(),
                       dismod3.utils.gbd_keys(
                 type_list=dismod3.utils.output_data_types), request.user, group_size)
         return HttpResponse(content, mimetype='application/ms-excel')
@@ -262,7 +277,7 @@ def dismod_show(request, id, format='html'):
 
         if is_new:
             X = ['type, region, sex, year, age, prior, posterior, upper, lower'.split(', ')]
-            dm = dm.to_djson()
+            dm = dm.results_djson()
             for t in dismod3.utils.output_data_types:
                 for r in dismod3.settings.gbd_regions:
                     r = clean(r)
@@ -765,13 +780,13 @@ def dismod_plot(request, id, condition, type, region, year, sex, format='png', s
     pl.title('%s; %s; %s; %s' % (dismod3.plotting.prettify(condition),
                                  dismod3.plotting.prettify(region), year, sex))
     if style == 'tile':
-        dismod3.tile_plot_disease_model(dm.to_djson(region), keys, defaults=request.GET)
+        dismod3.tile_plot_disease_model(dm.results_djson(), keys, defaults=request.GET)
     elif style == 'overlay':
-        dismod3.overlay_plot_disease_model([dm.to_djson(region)], keys)
+        dismod3.overlay_plot_disease_model([dm.results_djson()], keys)
     elif style == 'bar':
-        dismod3.bar_plot_disease_model(dm.to_djson(region), keys)
+        dismod3.bar_plot_disease_model(dm.results_djson(), keys)
     elif style == 'sparkline':
-        dismod3.plotting.sparkline_plot_disease_model(dm.to_djson(region), keys)
+        dismod3.plotting.sparkline_plot_disease_model(dm.results_djson(), keys)
     else:
         raise Http404
 
@@ -871,11 +886,8 @@ def dismod_show_map(request, id):
     
     dm = get_object_or_404(DiseaseModel, id=id)
 
-    if map != None:
-        if map == 'emp-prior':
-            dm_json = dm.to_djson()
-        elif map == 'posterior':
-            dm_json = dm.to_djson()
+    if map == 'emp-prior':
+        dm_json = dm.results_djson()
 
     age_start = 0
     age_end = 100
@@ -900,6 +912,18 @@ def dismod_show_map(request, id):
             for age in range(age_end - age_start + 1):
                 population_world[age] += population_region[age]
 
+    if map == 'posterior':
+        # read only the posterior means the map shows
+        t = type
+        if type == 'with-condition-mortality':
+            t = 'mortality'
+        if sex == 'total':
+            sexes = ['male', 'female']
+        else:
+            sexes = [sex]
+        ages, posterior = dm.posterior_slice(types=[t], years=[year], sexes=sexes, age_start=age_start, age_end=age_end)
+        posterior = posterior['mean']
+
     data = dm.data.all()
     vals = {}
     data_type = 'float'
@@ -962,7 +986,7 @@ def dismod_show_map(request, id):
         elif map == 'emp-prior':
             if dm_json.get_empirical_prior(type) != 'empty':
                 dm_json.vars = dismod3.neg_binom_model.setup(dm_json, type, [])
-                priors = dict([[p.key, json.loads(json.loads(p.json))] for p in dm.params.filter(key__contains='empirical_prior')])
+                priors = dict([[p.key, array_encoding.decode_dict(json.loads(json.loads(p.json)))] for p in dm.params.filter(key__contains='empirical_prior')])
                 if priors == 'empty':
                     return render_to_response('dismod_message.html', {'type': type, 'year': year, 'sex': sex, 'map': map})
                 try:
@@ -981,21 +1005,18 @@ def dismod_show_map(request, id):
 
         elif map == 'posterior':
             try:
-                t = type
-                if type == 'with-condition-mortality':
-                    t = 'mortality'
                 rate = []
                 if sex == 'total':
-                    rate_m = dm_json.get_mcmc('mean', '%s+%s+%s+%s' % (t, clean(r), year, 'male'))[age_start:age_end + 1]
+                    rate_m = posterior.get('%s+%s+%s+%s' % (t, clean(r), year, 'male'), [])
                     if len(rate_m) > 0:
-                        rate_f = dm_json.get_mcmc('mean', '%s+%s+%s+%s' % (t, clean(r), year, 'female'))[age_start:age_end + 1]
+                        rate_f = posterior.get('%s+%s+%s+%s' % (t, clean(r), year, 'female'), [])
                         if len(rate_f) > 0:
                             population_m = population_by_region_year_sex(clean(r), year, 'male')[age_start:age_end + 1]
                             population_f = population_by_region_year_sex(clean(r), year, 'female')[age_start:age_end + 1]
                             for i in range(age_end - age_start + 1):
                                 rate.append((rate_m[i] * population_m[i] + rate_f[i] * population_f[i]) / (population_m[i] + population_f[i]))
                 else:
-                    rate = dm_json.get_mcmc('mean', '%s+%s+%s+%s' % (t, clean(r), year, sex))[age_start:age_end + 1]
+                    rate = posterior.get('%s+%s+%s+%s' % (t, clean(r), year, sex), [])
                 if len(rate) != 0:
                     set_region_value_dict(vals, r, rate, weight, year, sex, age_start, age_end, population_world)
                 else:
@@ -1050,7 +1071,7 @@ def dismod_show_emp_priors(request, id, format='html', effect='alpha'):
         raise Http404
 
     dm = get_object_or_404(DiseaseModel, id=id)
-    priors = dict([[p.key, json.loads(json.loads(p.json))] for p in dm.params.filter(key__contains='empirical_prior')])  # TODO: load from fs instead from db
+    priors = dict([[p.key, array_encoding.decode_dict(json.loads(json.loads(p.json)))] for p in dm.params.filter(key__contains='empirical_prior')])  # TODO: load from fs instead from db
 
     if format == 'json':
         return HttpResponse(json.dumps(priors),
@@ -1114,7 +1135,7 @@ def dismod_comparison_plot(request, id1=-1, id2=-1, type='alpha', format='png'):
         dismod3.plotting.plot_empirical_prior_effects(dm_list, type)
     elif type.startswith('overlay'):
         plot_type, rate_type, region, year, sex = type.split('+')
-        dm_list = [dm.to_djson(region) for dm in [dm1, dm2]]  # TODO: load from fs instead from db
+        dm_list = [dm.results_djson() for dm in [dm1, dm2]]
         dismod3.overlay_plot_disease_model(dm_list, ['%s+%s+%s+%s' % (rate_type, region, year, sex)], defaults=request.GET)
 
     return HttpResponse(view_utils.figure_data(format),
@@ -1141,12 +1162,20 @@ class NewDiseaseModelForm(forms.Form):
         self.cleaned_data['model_dict'] = model_dict
         return model_json
 
+def is_json_post(request):
+    """ True if request is a POST with a json body, as sent by
+    dismod3.http_client, rather than a form submission"""
+    return request.method == 'POST' and request.META.get('CONTENT_TYPE', '').startswith('application/json')
+
 @login_required
 def dismod_upload(request):
     if request.method == 'GET':  # no form data is associated with page, yet
         form = NewDiseaseModelForm()
     elif request.method == 'POST':  # If the form has been submitted...
-        form = NewDiseaseModelForm(request.POST)  # A form bound to the POST data
+        if is_json_post(request):  # the model json is the body of the request
+            form = NewDiseaseModelForm({'model_json': request.raw_post_data})
+        else:
+            form = NewDiseaseModelForm(request.POST)  # A form bound to the POST data
 
         if form.is_valid():
             # All validation rules pass, so update or create new disease model
@@ -1154,54 +1183,190 @@ def dismod_upload(request):
             id = model_dict['id']
             if id > 0:
                 dm = get_object_or_404(DiseaseModel, id=id)
-                for key,val in model_dict['params'].items():
-                    if isinstance(val, dict):
-                        for subkey in val:
-                            t,r,y,s = dismod3.type_region_year_sex_from_key(subkey)
-                            if t != 'unknown':
-                                param, flag = dm.params.get_or_create(key=key, type=t, region=r, sex=s, year=y)
-                                param.json = json.dumps(val[subkey])
-                            else:
-                                param, flag = dm.params.get_or_create(key=key, type=t)
-
-                                pd=json.loads(param.json)
-                                pd[subkey] = val[subkey]
-                                param.json = json.dumps(pd)
-
-                            param.save()
-
-                    else:
-                        param, flag = dm.params.get_or_create(key=key)
-                        param.json = json.dumps(val)
-                        param.save()
+                dm.update_params(model_dict['params'])
             else:
                 from dismod3.disease_json import DiseaseJson
                 dj = DiseaseJson(form.cleaned_data['model_json'])
                 dm = create_disease_model(dj, request.user)
 
             # clear cache of images by type, region, year, and sex
-            for p in dm.params.filter(key__contains='plot'):
-                p.delete()
+            dm.clear_cached_plots()
 
             # TODO: remember to clear anything else that is cached as a param file here too
 
+            if is_json_post(request):
+                return HttpResponse(json.dumps({'id': dm.id, 'url': dm.get_absolute_url()}),
+                                    view_utils.MIMETYPE['json'])
             return HttpResponseRedirect(dm.get_absolute_url()) # Redirect after POST
 
+        elif is_json_post(request):
+            return HttpResponseBadRequest(json.dumps(form.errors), view_utils.MIMETYPE['json'])
+
     return render_to_response('dismod_upload.html', {'form': form})
 
+@login_required
+def dismod_upload_patch(request, id):
+    """ Apply a patch of params, as sent by dismod3.post_disease_model
+    with keys_to_save, to model id
+
+    The body of the POST is a (possibly gzipped) json dict with the
+    params to change under 'params'.  Only the cached plots for the
+    regions the patch changes are cleared, unless it changes params
+    that are not specific to a region.
+    """
+    if request.method != 'POST':
+        raise Http404
+    dm = get_object_or_404(DiseaseModel, id=id)
+
+    body = request.raw_post_data
+    if request.META.get('HTTP_CONTENT_ENCODING', '') == 'gzip':
+        import gzip
+        try:
+            body = gzip.GzipFile(fileobj=StringIO(body)).read()
+        except IOError:
+            return HttpResponseBadRequest('body could not be decompressed')
+    try:
+        patch = json.loads(body)
+    except ValueError:
+        return HttpResponseBadRequest('JSON object could not be decoded')
+    if not isinstance(patch.get('params'), dict):
+        return HttpResponseBadRequest('missing params')
+
+    regions, global_change = dm.update_params(patch['params'])
+    if global_change:
+        dm.clear_cached_plots()
+    else:
+        dm.clear_cached_plots(regions)
+
+    return HttpResponse(json.dumps({'id': dm.id, 'url': dm.get_absolute_url()}),
+                        view_utils.MIMETYPE['json'])
+
 @login_required
 def job_queue_list(request):
     # accept format specified in url
     format = request.GET.get('format', 'html')
 
-    to_run_list = DiseaseModelParameter.objects.filter(key='needs_to_run')
+    to_run_list = Job.objects.filter(state='queued')
     if format == 'json':
-        return HttpResponse(json.dumps([ param.id for param in to_run_list ]),
+        return HttpResponse(json.dumps([ job.param_id for job in to_run_list ]),
                             view_utils.MIMETYPE[format])
+    elif format == 'html':
+        return render_to_response('job_queue_list.html',
+                                  {'jobs': predicted_completion_times()})
     else:
         # more formats shall be added one day
         raise Http404
         
+@login_required
+def job_queue_timings(request):
+    """ Respond with the json list of the [features, seconds] of the
+    recently finished jobs, for training the run time predictions of
+    fits that run off the queue (see dismod3.runtime_model)"""
+    return HttpResponse(json.dumps(runtime_records()), view_utils.MIMETYPE['json'])
+
+# notified when a job is added to the queue, to wake the long polls
+# of job_queue_claim that are waiting in this process; those waiting
+# in other processes see the mtime of JOB_QUEUE_STAMP_FILE change
+job_queue_changed = threading.Condition()
+
+def notify_job_queue():
+    f = open(JOB_QUEUE_STAMP_FILE, 'a')
+    f.close()
+    os.utime(JOB_QUEUE_STAMP_FILE, None)
+    job_queue_changed.acquire()
+    job_queue_changed.notifyAll()
+    job_queue_changed.release()
+
+def job_queue_stamp():
+    try:
+        return os.stat(JOB_QUEUE_STAMP_FILE).st_mtime
+    except OSError:
+        return None
+
+def job_to_json(job):
+    """ Return the json of the params of a claimed job, with its job
+    id under 'job_id' and its param id under 'param_id'"""
+    job_val = json.loads(job.param.json)
+    job_val['job_id'] = job.id
+    job_val['param_id'] = job.param_id
+    return json.dumps(job_val)
+
+@login_required
+def job_queue_claim(request):
+    """ Claim the next job on the queue, waiting for one to be added
+    if the queue is empty
+
+    The wait is given in seconds by the timeout parameter, up to
+    JOB_QUEUE_POLL_TIMEOUT, and the order to claim jobs in by the
+    order parameter (see claim_next_job).  The job is leased to the
+    worker named by the worker parameter, which must renew the lease
+    with job_queue_renew until it calls job_queue_finish.  The
+    response is the json from job_to_json, or null if no job was added
+    before the timeout.
+    """
+    if request.method != 'POST':
+        raise Http404
+    try:
+        timeout = float(request.POST.get('timeout', 0))
+    except ValueError:
+        return HttpResponseBadRequest('timeout must be a number')
+    timeout = max(0., min(timeout, JOB_QUEUE_POLL_TIMEOUT))
+    worker = request.POST.get('worker', '') or request.user.username
+    order = request.POST.get('order', 'shortest')
+    if not order in JOB_CLAIM_ORDERS:
+        return HttpResponseBadRequest('order must be one of %s' % ', '.join(JOB_CLAIM_ORDERS.keys()))
+
+    end_time = time.time() + timeout
+    stamp = job_queue_stamp()
+    checked = time.time()
+    job = claim_next_job(worker, order=order)
+    while job == None and time.time() < end_time:
+        # jobs added by this process wake the wait at once, and those
+        # added by other processes change the stamp; the database is
+        # only queried again when one was added, or when a lease may
+        # have expired since the last query
+        job_queue_changed.acquire()
+        job_queue_changed.wait(min(JOB_QUEUE_CHECK_SECS, end_time - time.time()))
+        job_queue_changed.release()
+        if job_queue_stamp() == stamp and time.time() - checked < JOB_QUEUE_RECHECK_SECS:
+            continue
+        stamp = job_queue_stamp()
+        checked = time.time()
+        job = claim_next_job(worker, order=order)
+
+    if job == None:
+        return HttpResponse(json.dumps(None), view_utils.MIMETYPE['json'])
+    return HttpResponse(job_to_json(job), view_utils.MIMETYPE['json'])
+
+@login_required
+def job_queue_renew(request, id):
+    """ Extend the lease of the worker given by the worker parameter on
+    job id, and respond with json {'held': true}, or {'held': false}
+    if the lease has expired and the job was given to another worker
+    """
+    if request.method != 'POST':
+        raise Http404
+    job = get_object_or_404(Job, id=id)
+    held = job.renew(request.POST.get('worker', '') or request.user.username)
+    return HttpResponse(json.dumps({'held': held}), view_utils.MIMETYPE['json'])
+
+@login_required
+def job_queue_finish(request, id):
+    """ Mark job id, held by the worker given by the worker parameter,
+    as done, or as failed if the failed parameter is set, and respond
+    with json {'held': ...} as job_queue_renew does
+
+    If the untimed parameter is set, the job's run time is not
+    recorded for the run time predictions.
+    """
+    if request.method != 'POST':
+        raise Http404
+    job = get_object_or_404(Job, id=id)
+    held = job.finish(request.POST.get('worker', '') or request.user.username,
+                      failed=request.POST.get('failed', '') not in ['', '0', 'False'],
+                      timed=request.POST.get('untimed', '') in ['', '0', 'False'])
+    return HttpResponse(json.dumps({'held': held}), view_utils.MIMETYPE['json'])
+
 class JobRemovalForm(forms.Form):
     id = forms.IntegerField()
     
@@ -1210,18 +1375,24 @@ def job_queue_remove(request):
     if request.method == 'GET':  # no form data is associated with page, yet
         form = JobRemovalForm()
     elif request.method == 'POST':  # If the form has been submitted...
-        form = JobRemovalForm(request.POST)  # A form bound to the POST data
+        if is_json_post(request):
+            try:
+                form = JobRemovalForm(json.loads(request.raw_post_data))
+            except ValueError:
+                return HttpResponseBadRequest('JSON object could not be decoded')
+        else:
+            form = JobRemovalForm(request.POST)  # A form bound to the POST data
 
         if form.is_valid():
-            param = get_object_or_404(DiseaseModelParameter, id=form.cleaned_data['id'])
-            param_val = json.loads(param.json)
-
-            param.key = 'run_status'
-            param_val['run_status'] = '%s started at %s' % (param_val.get('estimate_type', ''), time.strftime('%H:%M on %m/%d/%Y'))
-            param.json = json.dumps(param_val)
-            param.save()
-
-            return HttpResponse(param.json, view_utils.MIMETYPE['json'])
+            # claim the queued job with this param id
+            job = get_object_or_404(Job, param__id=form.cleaned_data['id'], state='queued')
+            job = claim_next_job(request.user.username, job_id=job.id)
+            if job == None:  # another worker claimed it first
+                raise Http404
+
+            return HttpResponse(job.param.json, view_utils.MIMETYPE['json'])
+        elif is_json_post(request):
+            return HttpResponseBadRequest(json.dumps(form.errors), view_utils.MIMETYPE['json'])
     return render_to_response('job_queue_remove.html', {'form': form})
 
 
@@ -1241,6 +1412,10 @@ def job_queue_add(request, id):
     # TODO: add details of region/year/sex to param_val dict
     param_val['estimate_type'] = request.POST.get('estimate_type', '')
     estimate_type = ''
+    try:
+        priority = int(request.POST.get('priority', 0))
+    except ValueError:
+        priority = 0
 
     if param_val['estimate_type'] == 'Fit continuous single parameter model':
         param_val['run_status'] = '%s queued at %s' % (param_val['estimate_type'], time.strftime('%H:%M on %m/%d/%Y'))
@@ -1249,6 +1424,8 @@ def job_queue_add(request, id):
 
         param.save()
         dm.params.add(param)
+        enqueue_job(dm, param, priority)
+        notify_job_queue()
                                 
         return HttpResponseRedirect(reverse('gbd.dismod_data_server.views.dismod_spm_monitor', args=[dm.id]))
 
@@ -1279,7 +1456,7 @@ def job_queue_add(request, id):
                 param_val['regions_to_fit'].append(key)
         if(len(param_val['regions_to_fit']) == 0):
             for key in request.POST:
-                if key != 'estimate_type' and key != 'requested_by':
+                if key not in ['estimate_type', 'requested_by', 'priority']:
                     param_val['regions_to_fit'].append(key)
 
         if request.POST.get('requested_by', '') == 'run_page':
@@ -1304,6 +1481,8 @@ def job_queue_add(request, id):
 
     param.save()
     dm.params.add(param)
+    enqueue_job(dm, param, priority)
+    notify_job_queue()
 
     if request.POST.get('requested_by', '') == 'run_page':
         return HttpResponseRedirect(reverse('gbd.dismod_data_server.views.dismod_show_status', args=[dm.id]) + '?estimate_type=%s' % estimate_type + '&called_by=auto')
@@ -1317,80 +1496,133 @@ def dismod_run(request, id):
     error = ''
     return render_to_response('dismod_run.html', {'dm': dm, 'error': error})
 
+def read_tail(fname, n=STATUS_TAIL_BYTES):
+    """ Return the last n bytes of the file fname, 'none' if it is
+    empty, or 'unavailable' if it does not exist
+
+    The status page polls this while the fits append to their output,
+    so the tail is cached with the size the file had when it was
+    read, and the next call reads only what was appended since.
+    """
+    if not os.path.exists(fname):
+        return 'unavailable'
+    key = 'read_tail_%s' % hashlib.md5(fname).hexdigest()
+    f = open(fname, 'r')
+    stat = os.fstat(f.fileno())
+    size = stat.st_size
+    offset, s = 0, ''
+    cached = cache.get(key)
+    if cached and cached['ino'] == stat.st_ino and cached['size'] <= size:
+        offset, s = cached['size'], cached['tail']
+    if size - offset > n:
+        offset, s = size - n, ''
+    f.seek(offset)
+    s = (s + f.read(size - offset))[-n:]
+    f.close()
+    cache.set(key, {'ino': stat.st_ino, 'size': size, 'tail': s})
+    if s == '':
+        return 'none'
+    if size > n:
+        # the partial first line is not shown either
+        cut = s.find('\n') + 1
+        s = '[first %d bytes not shown]\n%s' % (size - n + cut, s[cut:])
+    return s
+
+def job_status(id, estimate_type):
+    """ Return the status log of the fits of model id, after marking
+    the fits that have failed
+
+    A fit has failed if its event log says so (see
+    dismod3/event_log.py), or if it wrote anything to stderr.
+    """
+    dir_working = '%s/%s' % (JOB_WORKING_DIR % int(id), estimate_type)
+    filename = '%s/%s/status' % (JOB_LOG_DIR % int(id), estimate_type)
+    if not os.path.exists(filename):
+        return 'unavailable'
+
+    f = open(filename, 'a+')
+    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    f.seek(0)
+    status = f.read()
+    f.seek(0, 2)
+
+    failed = {}
+    summaries = event_log.read_summaries('%s/events' % dir_working)
+    for task, summary in summaries.items():
+        if summary.get('state') == 'failed':
+            failed[task] = summary.get('updated', time.time())
+    if os.path.exists('%s/stderr' % dir_working):
+        for x in os.listdir('%s/stderr' % dir_working):
+            st = os.stat('%s/stderr/%s' % (dir_working, x))
+            if st.st_size > 0 and not failed.has_key(x):
+                failed[x] = st.st_atime
+    for x, t in failed.items():
+        if status.find('%s::Failed' % x) == -1:
+            line = '%s::Failed::%s\n' % (x, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t)))
+            f.write(line)
+            status += line
+    f.close()
+
+    if status == '':
+        status = 'none'
+    return status
+
 # TODO: clean up this view
 @login_required
 def dismod_show_status(request, id):
-    dir_log = JOB_LOG_DIR % int(id)
     dir_working = JOB_WORKING_DIR % int(id)
     if request.method == 'GET':
         dm = get_object_or_404(DiseaseModel, id=id)
         estimate_type = request.GET.get('estimate_type', 1)
         called_by = request.GET.get('called_by', 2)
-        filename = '%s/%s/status' % (dir_log, estimate_type)
-        status = 'unavailable'
-        if os.path.exists(filename):
-            files = os.listdir('%s/%s/stderr' % (dir_working, estimate_type))
-            for x in files:
-                p = '%s/%s/stderr/%s' % (dir_working, estimate_type, x)
-                if os.path.getsize(p) > 0:
-                    f = open(filename, 'a+')
-                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
-                    if f.read().find('%s::Failed' % x) == -1:
-                        f.write('%s::Failed::%s\n' % (x, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(os.stat(p).st_atime))))
-                    f.close()
-            f = open(filename, 'r')
-            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
-            status = f.read()
-            f.close()
-            if status == '':
-                status = 'none'
+        status = job_status(id, estimate_type)
         # FIXME: putting the session id in the html like this is probably insecure
         return render_to_response('dismod_show_status.html', {'dm': dm, 'estimate_type': estimate_type, 'status': status, 'called_by': called_by, 'sessionid': request.COOKIES['sessionid']})
     elif request.method == 'POST':
         estimate_type = request.POST['estimate_type']
-        filename = '%s/%s/status' % (dir_log, estimate_type)
-        status = 'unavailable'
-        if os.path.exists(filename):
-            files = os.listdir('%s/%s/stderr' % (dir_working, estimate_type))
-            for x in files:
-                p = '%s/%s/stderr/%s' % (dir_working, estimate_type, x)
-                if os.path.getsize(p) > 0:
-                    f = open(filename, 'a+')
-                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
-                    if f.read().find('%s::Failed' % x) == -1:
-                        f.write('%s::Failed::%s\n' % (x, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(os.stat(p).st_atime))))
-                    f.close()
-            f = open(filename, 'r')
-            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
-            status = f.read()
-            f.close()
-            if status == '':
-                status = 'none'
+        status = job_status(id, estimate_type)
         task = request.POST['TASK']
         if task == '':
             stdout = 'Fitting task not selected'
             stderr = 'Fitting task not selected'
         else:
-            filename = '%s/%s/stdout/%s' % (dir_working, estimate_type, task)
-            stdout = 'unavailable'
-            if os.path.exists(filename):
-                f = open(filename, 'r')
-                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
-                stdout = f.read()
-                f.close()
-                if stdout == '':
-                    stdout = 'none'
-            filename = '%s/%s/stderr/%s' % (dir_working, estimate_type, task)
-            stderr = 'unavailable'
-            if os.path.exists(filename):
-                f = open(filename, 'r')
-                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
-                stderr = f.read()
-                f.close()
-                if stderr == '':
-                    stderr = 'none'
+            # only the end of the output, since the applet polls
+            # this while the fits are writing to it
+            stdout = read_tail('%s/%s/stdout/%s' % (dir_working, estimate_type, task))
+            stderr = read_tail('%s/%s/stderr/%s' % (dir_working, estimate_type, task))
         return HttpResponse('%s&&&%s&&&%s' % (status, stdout, stderr))
 
+@login_required
+def dismod_show_events(request, id, estimate_type, task):
+    """ Return the events of one fit of model id, from its event log
+    (see dismod3/event_log.py), as json
+
+    The offset parameter is the byte offset to read the log from;
+    the response holds the events after it, the offset to send with
+    the next request, and the summary of the fit from the index of
+    the log, so a client polling the log gets each event only once.
+    """
+    try:
+        offset = int(request.GET.get('offset', 0))
+    except ValueError:
+        return HttpResponseBadRequest('offset must be an integer')
+    if offset < 0:
+        return HttpResponseBadRequest('offset must not be negative')
+
+    fname = event_log.log_fname(id, estimate_type, task)
+    events, offset = event_log.read_events(fname, offset)
+    return HttpResponse(json.dumps({'events': events, 'offset': offset,
+                                    'summary': event_log.read_summary(fname)}),
+                        view_utils.MIMETYPE['json'])
+
+@login_required
+def dismod_show_events_summary(request, id, estimate_type):
+    """ Return the summaries of all the fits of model id of one
+    estimate_type, from the indexes of their event logs, as json
+    keyed by task"""
+    dir = '%s/%s/events' % (JOB_WORKING_DIR % int(id), estimate_type)
+    return HttpResponse(json.dumps(event_log.read_summaries(dir)), view_utils.MIMETYPE['json'])
+
 @login_required
 def dismod_export(request, id):
     dm = get_object_or_404(DiseaseModel, id=id)
@@ -1549,17 +1781,50 @@ def dismod_log_status(request, id, estimate_type, fitting_task, state):
     f.close()
     return HttpResponse('')
 
+def fetch_server_load():
+    """ Return the snapshot of the cluster load from the server_load
+    service, with the time it was fetched"""
+    try:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect((SERVER_LOAD_STATUS_HOST, SERVER_LOAD_STATUS_PORT))
+        data = []
+        while(1):
+            income = s.recv(SERVER_LOAD_STATUS_SIZE)
+            if income == '':
+                break;
+            data.append(income)
+        s.close()
+        snapshot = json.loads(''.join(data))
+    except (socket.error, ValueError), e:
+        snapshot = {'qstat': '', 'local': {}, 'age': 0., 'error': 'server load unavailable: %s' % e}
+    snapshot['fetched'] = time.time()
+    return snapshot
+
 def dismod_server_load(request):
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.connect((SERVER_LOAD_STATUS_HOST, SERVER_LOAD_STATUS_PORT))
-    data = ''
-    while(1):
-        income = s.recv(SERVER_LOAD_STATUS_SIZE)
-        if income == '':
-            break;
-        data = '%s%s' % (data, income.strip())
-    s.close()
-    return HttpResponse(data)
+    """ Show the load on the cluster, from a snapshot that is at most
+    SERVER_LOAD_CACHE_SECS older than the one the server_load service
+    holds, so that any number of viewers cost one request to the
+    service every SERVER_LOAD_CACHE_SECS
+
+    The response is the output of qstat, with the age of the snapshot
+    in seconds in the X-Snapshot-Age header, or with format=json, the
+    whole snapshot (see server_load.py).
+    """
+    snapshot = cache.get('server_load')
+    if snapshot == None:
+        snapshot = fetch_server_load()
+        cache.set('server_load', snapshot, SERVER_LOAD_CACHE_SECS)
+    snapshot = dict(snapshot)
+    snapshot['age'] += time.time() - snapshot.pop('fetched')
+
+    if request.GET.get('format') == 'json':
+        return HttpResponse(json.dumps(snapshot), view_utils.MIMETYPE['json'])
+    if snapshot.get('error'):
+        response = HttpResponse(snapshot['error'], status=503)
+    else:
+        response = HttpResponse(snapshot['qstat'].strip())
+    response['X-Snapshot-Age'] = '%.1f' % snapshot['age']
+    return response
 
 @login_required
 def dismod_experimental(request, id):
@@ -1610,6 +1875,55 @@ def dismod_download_posterior(request, id):
 
     return response
 
+def list_arg(request, name):
+    """ Return the comma separated values of GET parameter name as a
+    list, or None if it is not given"""
+    val = request.GET.get(name, '')
+    if not val:
+        return None
+    return [v.strip() for v in val.split(',')]
+
+@login_required
+def dismod_posterior_slice(request, id):
+    """ Return a selection of the estimates of model id, as json
+
+    The GET parameters type, region, year and sex select the gbd keys
+    (each a comma separated list, all of them if it is not given),
+    stat selects the statistics (mean, lower_ui, upper_ui, map, ...;
+    mean if it is not given), age_start and age_end select a range of
+    the estimate age mesh, and encoding (a dtype, '<f4' or '<f8')
+    returns the estimates base64 encoded (see dismod3/array_encoding.py)
+    instead of as lists.  Only the params holding the selected
+    estimates are read, so a client that needs one curve, or one age
+    group across regions, need not download the model.
+    """
+    dm = get_object_or_404(DiseaseModel, id=id)
+
+    age_range = {'age_start': None, 'age_end': None}
+    for name in age_range:
+        if request.GET.get(name):
+            try:
+                age_range[name] = int(request.GET[name])
+            except ValueError:
+                return HttpResponseBadRequest('ages must be integers')
+    encoding = request.GET.get('encoding') or None
+    if encoding not in [None, '<f4', '<f8']:
+        return HttpResponseBadRequest('encoding must be <f4 or <f8')
+
+    stats = list_arg(request, 'stat') or ['mean']
+    ages, slices = dm.posterior_slice(types=list_arg(request, 'type'), regions=list_arg(request, 'region'),
+                                      years=list_arg(request, 'year'), sexes=list_arg(request, 'sex'),
+                                      stats=stats, age_start=age_range['age_start'], age_end=age_range['age_end'])
+    for stat in slices:
+        for key, val in slices[stat].items():
+            if encoding:
+                slices[stat][key] = array_encoding.encode(val, encoding)
+            else:
+                slices[stat][key] = val.tolist()
+
+    return HttpResponse(json.dumps({'id': dm.id, 'age': ages, 'estimates': slices}),
+                        view_utils.MIMETYPE['json'])
+
 @login_required
 def dismod_input(request):
     #if request.method == 'POST': save dismod_input in a file
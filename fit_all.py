@@ -5,93 +5,155 @@ Example
 -------
 
 $ python fit_all.py 4222    # submit jobs to cluster to estimate empirical priors followed by posteriors for model #4222
+$ python fit_all.py -R 4222 # without SGE, continue an interrupted run of the jobs on this machine
+$ python fit_all.py -w 4222 # without SGE, run the jobs in workers that keep dismod3 loaded
 
 """
 
 import optparse
 import os
-import subprocess
 from shutil import rmtree
 
 import dismod3
 from dismod3.utils import clean, gbd_keys, type_region_year_sex_from_key
 
 
-def fit_all(id):
+def fit_all(id, resume=False, warm=False):
     """ Enqueues all jobs necessary to fit specified model
-    to the cluster
+    to the cluster, or runs them on this machine if not on SGE
+
+    The jobs form a DAG: each posterior fit waits only for the
+    empirical prior fits it uses, and the upload waits for the
+    posterior fits.
 
     Parameters
     ----------
     id : int
       The model id number for the job to fit
+    resume : bool, optional
+      continue an interrupted local run in the existing working dir,
+      without re-running the jobs that finished
+    warm : bool, optional
+      run local jobs in warm workers, which keep dismod3 loaded
+      between jobs
 
     Example
     -------
     >>> import fit_all
     >>> fit_all.fit_all(2552)
     """
+    dir = dismod3.settings.JOB_WORKING_DIR % id  # TODO: refactor into a function
 
-    # TODO: store all disease information in this dir already, so fetching is not necessary
-    # download the disease model json and store it in the working dir
-    print 'downloading disease model'
-    dismod3.disease_json.create_disease_model_dir(id)
+    if not resume:
+        # TODO: store all disease information in this dir already, so fetching is not necessary
+        # download the disease model json and store it in the working dir
+        print 'downloading disease model'
+        dismod3.disease_json.create_disease_model_dir(id)
     dm = dismod3.fetch_disease_model(id)
     
     # get the all-cause mortality data, and merge it into the model
     mort = dismod3.fetch_disease_model('all-cause_mortality')
     dm.data += mort.data
-    dm.save()
 
-    # fit empirical priors (by pooling data from all regions)
-    dir = dismod3.settings.JOB_WORKING_DIR % id  # TODO: refactor into a function
-    emp_names = []
+    # copy in stored empirical prior fits for types whose inputs are unchanged
+    import dismod3.emp_prior_cache as emp_prior_cache
+    emp_types = []
     for t in ['excess-mortality', 'remission', 'incidence', 'prevalence']:
+        if not emp_prior_cache.restore(dm, t, emp_prior_cache.emp_prior_fingerprint(dm, t)):
+            emp_types.append(t)
+    dm.save()
+
+    from dismod3.scheduler import Scheduler, SGEScheduler
+    if dismod3.settings.ON_SGE:
+        scheduler = SGEScheduler()
+    elif warm:
+        from dismod3.worker_pool import WorkerPool
+        scheduler = Scheduler('%s/scheduler.json' % dir, executor=WorkerPool())
+    else:
+        scheduler = Scheduler('%s/scheduler.json' % dir)
+
+    # predict the run time of each fit, from the timings of the jobs
+    # the server has finished, so that the longest start first
+    from dismod3.runtime_model import RuntimePredictor, job_features
+    predictor = RuntimePredictor()
+    if not predictor.train(dismod3.get_job_timings()):
+        print 'too few finished jobs to train the run time predictions, using the defaults'
+
+    # fit empirical priors (by pooling data from all regions); SGE jobs
+    # do not start in this dir, so they are given the full path of the script
+    emp_script = 'fit_emp_prior.py'
+    if dismod3.settings.ON_SGE:
+        emp_script = '/home/OUTPOST/abie/gbd_dev/gbd/fit_emp_prior.py'
+    emp_names = {}
+    for t in emp_types:
         o = '%s/empirical_priors/stdout/%s' % (dir, t)
         e = '%s/empirical_priors/stderr/%s' % (dir, t)
         name_str = '%s-%d' %(t[0], id)
-        emp_names.append(name_str)
-        call_str = 'qsub -cwd -o %s -e %s ' % (o, e) \
-                        + '-N %s ' % name_str \
-                        + 'run_on_cluster.sh /home/OUTPOST/abie/gbd_dev/gbd/fit_emp_prior.py %d -t %s' % (id, t)
-        subprocess.call(call_str, shell=True)
-
-    # directory to save the country level posterior csv files
+        emp_names[t] = name_str
+        data, lower_bound_data = emp_prior_cache.emp_prior_data(dm, t)
+        cost = predictor.predict(job_features('empirical priors', [d['data_type'] for d in data + lower_bound_data],
+                                              emp_prior_types=[t]))
+        scheduler.add(name_str, '%s %d -t %s' % (emp_script, id, t), stdout=o, stderr=e, cost=cost)
+
+    # directory to save the country level posterior csv files (when
+    # resuming, it holds those of the posterior fits that are done,
+    # which are not run again)
     temp_dir = dir + '/posterior/country_level_posterior_dm-' + str(id) + '/'
-    if os.path.exists(temp_dir):
+    if os.path.exists(temp_dir) and not resume:
         rmtree(temp_dir)
-    os.makedirs(temp_dir)
-
-    #fit each region/year/sex individually for this model
-    hold_str = '-hold_jid %s ' % ','.join(emp_names)
+    if not os.path.exists(temp_dir):
+        os.makedirs(temp_dir)
+
+    # if all empirical priors are known already, so are the posterior
+    # fingerprints, and only the changed region/year/sexes need to be fit
+    if len(emp_types) == 0:
+        import dismod3.fingerprint
+        changed = dismod3.fingerprint.changed_posteriors(dm)
+        print 'empirical priors unchanged, fitting %d changed posteriors' % len(changed)
+    else:
+        changed = [(clean(r), y, s) for r in dismod3.gbd_regions for y in dismod3.gbd_years for s in dismod3.gbd_sexes]
+
+    #fit each region/year/sex individually for this model, after the
+    #empirical priors it uses
+    from dismod3.fingerprint import emp_prior_types
+    post_deps = [emp_names[t] for t in emp_prior_types if emp_names.has_key(t)]
     post_names = []
+    region_data_types = {}
+    for d in dm.data:
+        region_data_types.setdefault(clean(d.get('gbd_region', '')), []).append(d['data_type'])
     for ii, r in enumerate(dismod3.gbd_regions):
         for s in dismod3.gbd_sexes:
             for y in dismod3.gbd_years:
+                if not (clean(r), y, s) in changed:
+                    continue
                 k = '%s+%s+%s' % (clean(r), s, y)
                 o = '%s/posterior/stdout/%s' % (dir, k)
                 e = '%s/posterior/stderr/%s' % (dir, k)
                 name_str = '%s%d%s%s%d' % (r[0], ii+1, s[0], str(y)[-1], id)
                 post_names.append(name_str)
-                call_str = 'qsub -cwd -o %s -e %s ' % (o,e) \
-                           + hold_str \
-                           + '-N %s ' % name_str \
-                           + 'run_on_cluster.sh fit_posterior.py %d -r %s -s %s -y %s' % (id, clean(r), s, y)
-                subprocess.call(call_str, shell=True)
+                call_str = 'fit_posterior.py %d -r %s -s %s -y %s' % (id, clean(r), s, y)
+                cost = predictor.predict(job_features('posterior', region_data_types.get(clean(r), []),
+                                                      [clean(r)], years=[y], sexes=[s]))
+                scheduler.add(name_str, call_str, deps=post_deps, stdout=o, stderr=e,
+                              retry_cmd=call_str + ' -R', cost=cost)
 
     # after all posteriors have finished running, upload disease model json
-    hold_str = '-hold_jid %s ' % ','.join(post_names)
     o = '%s/upload.stdout' % dir
     e = '%s/upload.stderr' % dir
-    call_str = 'qsub -cwd -o %s -e %s ' % (o,e) \
-               + hold_str \
-               + '-N upld-%s ' % id \
-               + 'run_on_cluster.sh upload_fits.py %d' % id
-    subprocess.call(call_str, shell=True)
+    scheduler.add('upld-%s' % id, 'upload_fits.py %d' % id, deps=post_names, stdout=o, stderr=e)
+
+    failed = scheduler.run()
+    if failed:
+        print 'jobs that did not finish: %s' % ', '.join(failed)
+    return failed
 
 def main():
     usage = 'usage: %prog [options] disease_model_id'
     parser = optparse.OptionParser(usage)
+    parser.add_option('-R', '--resume', dest='resume', action='store_true',
+                      help='continue an interrupted local run, skipping the jobs that finished')
+    parser.add_option('-w', '--warm', dest='warm', action='store_true',
+                      help='run local jobs in workers that keep dismod3 loaded between jobs')
     (options, args) = parser.parse_args()
 
     if len(args) != 1:
@@ -102,10 +164,7 @@ def main():
     except ValueError:
         parser.error('disease_model_id must be an integer')
 
-    if not dismod3.settings.ON_SGE:
-        parser.error('dismod3.settings.ON_SGE must be true to fit_all automatically')
-
-    fit_all(id)
+    fit_all(id, resume=options.resume, warm=options.warm)
 
 
 if __name__ == '__main__':
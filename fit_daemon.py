@@ -1,5 +1,5 @@
 #!/usr/bin/python2.5
-""" Poll the dismod data server for jobs to run, and call fit_all on them
+""" Wait on the dismod data server for jobs to run, and call fit_all on them
 
 Examples
 --------
@@ -10,22 +10,31 @@ $ python fit_daemon
 import time
 
 import dismod3
+from dismod3.job_lease import LeaseKeeper
 import fit_all
 
 def daemon_loop():
     while True:
+        # the server holds the request until a job is queued, or it times out
         try:
-            job_queue = dismod3.get_job_queue()
+            job_params = dismod3.claim_job()
         except:
-            job_queue = []
-        
-        for param_id in job_queue:
-            print 'processing job %d' % param_id
-            job_params = dismod3.remove_from_job_queue(param_id)
+            job_params = None
+            time.sleep(dismod3.settings.SLEEP_SECS)
+
+        if job_params:
+            print 'processing job %d' % job_params['param_id']
             id = int(job_params['dm_id'])
-            fit_all.fit_all(id)
-            
-        time.sleep(dismod3.settings.SLEEP_SECS)
+
+            # renew the lease on the job while it runs, so that it is
+            # only put back on the queue if this daemon dies
+            lease = LeaseKeeper(job_params['job_id'])
+            lease.start()
+            try:
+                failed = fit_all.fit_all(id)
+            finally:
+                lease.stop()
+            dismod3.finish_job(job_params['job_id'], failed, timed=not dismod3.settings.ON_SGE)
 
 def main():
     try:
@@ -9,8 +9,10 @@ import matplotlib
 matplotlib.use("AGG") 
 
 import dismod3
+import dismod3.timing as timing
+from dismod3.fit_runner import run_fit
 
-def fit_emp_prior(id, param_type):
+def fit_emp_prior(id, param_type, force=False):
     """ Fit empirical prior of specified type for specified model
 
     Parameters
@@ -19,6 +21,8 @@ def fit_emp_prior(id, param_type):
       The model id number for the job to fit
     param_type : str, one of incidence, prevalence, remission, excess-mortality
       The disease parameter to generate empirical priors for
+    force : bool, optional
+      fit even if there are stored results for the same inputs
 
     Example
     -------
@@ -28,14 +32,27 @@ def fit_emp_prior(id, param_type):
     #dismod3.log_job_status(id, 'empirical_priors', param_type, 'Running')
 
     # load disease model
+    timing.phase_start('load')
     dm = dismod3.load_disease_model(id)
+    timing.phase_end('load')
     #dm.data = []  # remove all data to speed up computation, for test
 
+    # use the stored results if this fit has been done before with the same inputs
+    import dismod3.emp_prior_cache as emp_prior_cache
+    fingerprint = emp_prior_cache.emp_prior_fingerprint(dm, param_type)
+    if not force and emp_prior_cache.restore(dm, param_type, fingerprint):
+        emp_prior_cache.save(dm, param_type)
+        return dm
+
     import dismod3.neg_binom_model as model
     dir = dismod3.settings.JOB_WORKING_DIR % id
+    timing.phase_start('fit')
     model.fit_emp_prior(dm, param_type, dbname='%s/empirical_priors/pickle/dm-%d-emp_prior-%s.pickle' % (dir, id, param_type))
+    timing.phase_end('fit')
+    emp_prior_cache.store(dm, param_type, fingerprint)
 
     # generate empirical prior plots
+    timing.phase_start('plot')
     from pylab import subplot
     for sex in dismod3.settings.gbd_sexes:
         for year in dismod3.settings.gbd_years:
@@ -54,9 +71,13 @@ def fit_emp_prior(id, param_type):
     dismod3.plotting.plot_posterior_predicted_checks(dm, k0)
     dm.savefig('dm-%d-emp-prior-check-%s.png' % (dm.id, param_type))
     dm.vars = dm.vars[k0]   # undo hack to make posterior predictions plot
+    timing.phase_end('plot')
     
     # save results (do this last, because it removes things from the disease model that plotting function, etc, might need
-    dm.save('dm-%d-prior-%s.json' % (id, param_type))
+    timing.attach(dm, ['empirical_prior_%s' % param_type])
+    timing.phase_start('save')
+    emp_prior_cache.save(dm, param_type)
+    timing.phase_end('save')
     #dismod3.log_job_status(id, 'empirical_priors', param_type, 'Completed')
     return dm
 
@@ -67,6 +88,14 @@ def main():
     parser = optparse.OptionParser(usage)
     parser.add_option('-t', '--type', default='prevalence',
                       help='only estimate given parameter type (valid settings ``incidence``, ``prevalence``, ``remission``, ``excess-mortality``) (emp prior fit only)')
+    parser.add_option('-f', '--force', action='store_true', dest='force',
+                      help='fit even if there are stored results for the same inputs')
+    parser.add_option('--profile', action='store_true', dest='profile',
+                      help='profile the fit, and time each node of the model (see dismod3/profiling.py)')
+    parser.add_option('--memory', action='store_true', dest='memory',
+                      help='sample the memory used by the fit, and report it by phase and by object (see dismod3/memory.py)')
+    parser.add_option('--memory-budget', type='int', dest='memory_budget',
+                      help='stop the fit with an error if it uses more than this many MB')
 
     (options, args) = parser.parse_args()
 
@@ -78,9 +107,9 @@ def main():
     except ValueError:
         parser.error('disease_model_id must be an integer')
 
-    dm = fit_emp_prior(id, options.type)
-    return dm
-      
+    return run_fit(id, 'empirical_priors', options.type, fit_emp_prior, options,
+                   id, options.type, options.force)
+
 
 if __name__ == '__main__':
     dm = main()
@@ -25,8 +25,10 @@ import matplotlib
 matplotlib.use("AGG") 
 
 import dismod3
+import dismod3.timing as timing
+from dismod3.fit_runner import run_fit
 
-def fit_posterior(id, region, sex, year):
+def fit_posterior(id, region, sex, year, resume=False, force=False):
     """ Fit posterior of specified region/sex/year for specified model
 
     Parameters
@@ -37,6 +39,11 @@ def fit_posterior(id, region, sex, year):
       From dismod3.settings.gbd_regions, but clean()-ed
     sex : str, from dismod3.settings.gbd_sexes
     year : str, from dismod3.settings.gbd_years
+    resume : bool, optional
+      continue sampling from the checkpoint of an interrupted run,
+      if there is one, instead of starting over from MAP
+    force : bool, optional
+      fit even if the inputs are unchanged since the stored fit
 
     Example
     -------
@@ -46,19 +53,40 @@ def fit_posterior(id, region, sex, year):
     #print 'updating job status on server'
     #dismod3.log_job_status(id, 'posterior', '%s--%s--%s' % (region, sex, year), 'Running')
 
+    timing.phase_start('load')
     dm = dismod3.load_disease_model(id)
+    timing.phase_end('load')
     #dm.data = []  # for testing, remove all data
     keys = dismod3.utils.gbd_keys(region_list=[region], year_list=[year], sex_list=[sex])
 
+    # carry forward the stored fit if none of its inputs have changed
+    import dismod3.fingerprint
+    fingerprint = dismod3.fingerprint.posterior_fingerprint(dm, region, year, sex)
+    if not force and dismod3.fingerprint.posterior_is_current(dm, region, year, sex, fingerprint):
+        print 'inputs unchanged since last fit, carrying forward stored posterior'
+        dm.save('dm-%d-posterior-%s-%s-%s.json' % (id, region, sex, year), keys_to_save=keys)
+        return dm
+
     # fit the model
     dir = dismod3.settings.JOB_WORKING_DIR % id
+    dbname = '%s/posterior/pickle/dm-%d-posterior-%s-%s-%s.pickle' % (dir, id, region, sex, year)
     import dismod3.gbd_disease_model as model
-    model.fit(dm, method='map', keys=keys, verbose=1)     ## first generate decent initial conditions
+    import dismod3.checkpoint
+    checkpoint = dismod3.checkpoint.checkpoint_name(dbname)
+    if not resume:
+        dismod3.checkpoint.clear(checkpoint)
+    if not dismod3.checkpoint.load(checkpoint):
+        timing.phase_start('map')
+        model.fit(dm, method='map', keys=keys, verbose=1, warm_start=True)     ## first generate decent initial conditions
+        timing.phase_end('map')
     ## then sample the posterior via MCMC
+    timing.phase_start('mcmc')
     model.fit(dm, method='mcmc', keys=keys, iter=50000, thin=25, burn=25000, verbose=1,
-              dbname='%s/posterior/pickle/dm-%d-posterior-%s-%s-%s.pickle' % (dir, id, region, sex, year))
+              dbname=dbname, checkpoint=checkpoint)
+    timing.phase_end('mcmc')
 
     # generate plots of results
+    timing.phase_start('plot')
     dismod3.tile_plot_disease_model(dm, keys, defaults={})
     dm.savefig('dm-%d-posterior-%s.png' % (id, '+'.join(['all', region, sex, year])))  # TODO: refactor naming into its own function (disease_json.save_image perhaps)
     for param_type in dismod3.settings.output_data_types:
@@ -72,11 +100,16 @@ def fit_posterior(id, region, sex, year):
         if dm.vars[k].get('data'):
             dismod3.plotting.plot_posterior_predicted_checks(dm, k)
             dm.savefig('dm-%d-check-%s.png' % (dm.id, k))
+    timing.phase_end('plot')
 
 
     # save results (do this last, because it removes things from the disease model that plotting function, etc, might need
+    timing.phase_start('save')
     keys = dismod3.utils.gbd_keys(region_list=[region], year_list=[year], sex_list=[sex])
+    dismod3.fingerprint.set_posterior_fingerprint(dm, region, year, sex, fingerprint)
+    timing.attach(dm, keys)
     dm.save('dm-%d-posterior-%s-%s-%s.json' % (id, region, sex, year), keys_to_save=keys)
+    timing.phase_end('save')
 
     # make a rate_type_list
     rate_type_list = ['incidence', 'prevalence', 'remission', 'excess-mortality',
@@ -151,7 +184,7 @@ def save_country_level_posterior(dm, region, year, sex, rate_type_list):
                 # get coeffs from dm.vars
                 alpha=model_vars['region_coeffs']
                 beta=model_vars['study_coeffs']
-                gamma_trace = model_vars['age_coeffs'].trace()
+                gamma_trace = model_vars['age_coeffs'].trace(chain=None)
 
                 # get sample size
                 sample_size = len(gamma_trace)
@@ -189,6 +222,16 @@ def main():
                       help='only estimate given year (valid settings ``1990``, ``2005``)')
     parser.add_option('-r', '--region', default='australasia',
                       help='only estimate given GBD Region')
+    parser.add_option('-R', '--resume', action='store_true', dest='resume',
+                      help='continue from the checkpoint of an interrupted run')
+    parser.add_option('-f', '--force', action='store_true', dest='force',
+                      help='fit even if the inputs are unchanged since the stored fit')
+    parser.add_option('--profile', action='store_true', dest='profile',
+                      help='profile the fit, and time each node of the model (see dismod3/profiling.py)')
+    parser.add_option('--memory', action='store_true', dest='memory',
+                      help='sample the memory used by the fit, and report it by phase and by object (see dismod3/memory.py)')
+    parser.add_option('--memory-budget', type='int', dest='memory_budget',
+                      help='stop the fit with an error if it uses more than this many MB')
 
     (options, args) = parser.parse_args()
 
@@ -203,8 +246,10 @@ def main():
     import time
     import random
     time.sleep(random.random()*30)  # sleep random interval before start to distribute load
-    dm = fit_posterior(id, options.region, options.sex, options.year)
-    return dm
+
+    task = '%s+%s+%s' % (options.region, options.sex, options.year)
+    return run_fit(id, 'posterior', task, fit_posterior, options,
+                   id, options.region, options.sex, options.year, options.resume, options.force)
 
 if __name__ == '__main__':
     dm = main()
@@ -7,7 +7,11 @@ Examples
 --------
 
 $ python gbd_fit --daemon    # launch daemon that will fit models as they become available
+$ python gbd_fit --daemon --warm   # the same, but run local fits in workers that keep dismod3 loaded
 $ python gbd_fit 10   # launch fitting calculation to estimate parameters for model #10
+$ python gbd_fit 10 -r asia_east -s male -y 2005 --resume   # continue an interrupted posterior fit from its checkpoint
+$ python gbd_fit 10 -r asia_east -s male -y 2005 --profile   # profile the fit, and report the time spent in each node of the model
+$ python gbd_fit 10 -r asia_east -s male -y 2005 --memory --memory-budget 4096   # report the memory used by each phase and the largest objects, and stop the fit if it uses more than 4 GB
 $ python gbd_fit 10 --nofit -t incidence -p 'smooth 25'  # set the hyper-prior on incidence to 'smooth 25' and save it, without running the model
 
 """
@@ -20,6 +24,11 @@ import signal
 import dismod3
 from dismod3.utils import clean, gbd_keys, type_region_year_sex_from_key
 from dismod3.plotting import GBDDataHash
+from dismod3.executor import LocalExecutor
+from dismod3.job_lease import LeaseTracker
+import dismod3.event_log as event_log
+import dismod3.timing as timing
+from dismod3.fit_runner import run_fit
 
 import sys
 from os import popen
@@ -68,6 +77,26 @@ def main():
                       action='store_true', dest='log',
                       help='log the job running status')
 
+    parser.add_option('-w', '--warm',
+                      action='store_true', dest='warm',
+                      help='(daemon mode) run local fits in warm workers, which keep dismod3 loaded between fits')
+
+    parser.add_option('-R', '--resume',
+                      action='store_true', dest='resume',
+                      help='continue from the checkpoint of an interrupted posterior fit')
+
+    parser.add_option('--profile',
+                      action='store_true', dest='profile',
+                      help='profile the fit, and time each node of the model (see dismod3/profiling.py)')
+
+    parser.add_option('--memory',
+                      action='store_true', dest='memory',
+                      help='sample the memory used by the fit, and report it by phase and by object (see dismod3/memory.py)')
+
+    parser.add_option('--memory-budget',
+                      type='int', dest='memory_budget',
+                      help='stop the fit with an error if it uses more than this many MB')
+
     (options, args) = parser.parse_args()
 
     if options.daemon:
@@ -82,7 +111,7 @@ def main():
         try:
             #tweet('starting dismod3 daemon...')
             log('starting dismod3 daemon...')
-            daemon_loop()
+            daemon_loop(options.warm)
         finally:
             #tweet('...dismod3 daemon shutting down')
             log('dismod3 daemon shutting down')
@@ -96,21 +125,72 @@ def main():
         except ValueError:
             parser.error('disease_model_id must be an integer')
 
-        fit(id, options)
+        estimate_type, task = fit_task(options)
+        run_fit(id, estimate_type, task, fit, options, id, options, log=bool(log_task(options)[1]))
+
+def fit_task(opts):
+    """ Return the estimate type and the task name of a fit with
+    options opts, which its output files are named by"""
+    if opts.type and not (opts.region and opts.sex and opts.year):
+        return 'empirical_priors', opts.type
+    elif opts.region and opts.sex and opts.year and not opts.type:
+        return 'posterior', '%s+%s+%s' % (opts.region, opts.sex, opts.year)
+    return 'fit', '+'.join([opts.type or 'all', opts.region or 'all', opts.sex or 'all', opts.year or 'all'])
+
+def log_task(opts):
+    """ Return the estimate type and the task name that the status,
+    event log and timing of a fit with options opts are kept under,
+    or None, None if they are not kept"""
+    if opts.log:
+        estimate_type, task = fit_task(opts)
+        if estimate_type != 'fit':
+            return estimate_type, task
+    return None, None
+
+def submit_fit(executor, warm, name, fit_args, id, o, e):
+    """ Queue a local gbd_fit.py run of model id with options fit_args"""
+    if warm:
+        executor.submit_script(name, 'gbd_fit.py %s %d' % (fit_args, id), o, e)
+    else:
+        executor.submit(name, dismod3.settings.GBD_FIT_STR % (fit_args, id, o, e))
 
-def daemon_loop():
+def daemon_loop(warm=False):
     on_sge = dismod3.settings.ON_SGE
+    if warm and not on_sge:
+        from dismod3.worker_pool import WorkerPool
+        executor = WorkerPool()
+    else:
+        executor = LocalExecutor()
+    leases = LeaseTracker(executor)
     while True:
+        # report fits that finished since the last pass, start queued
+        # ones, and keep the leases on the jobs whose fits are running
+        for name, returncode in leases.poll():
+            log('finished %s (return code %d)' % (name, returncode))
+        executor.save_status('%s/gbd_fit.json' % dismod3.settings.LOCAL_EXECUTOR_STATUS_DIR)
+
+        # wait on the server for a job, but only briefly while there
+        # are fits running locally, so that they are reaped promptly
+        if executor.busy():
+            timeout = dismod3.settings.SLEEP_SECS
+        else:
+            timeout = dismod3.settings.JOB_QUEUE_POLL_TIMEOUT
         try:
-            job_queue = dismod3.get_job_queue()
+            job_queue = [dismod3.claim_job(timeout)]
         except:
             job_queue = []
+            time.sleep(dismod3.settings.SLEEP_SECS)
         
-        for param_id in job_queue:
+        for job_params in job_queue:
+            if not job_params:  # no job was queued before the timeout
+                continue
+            param_id = job_params['param_id']
             #tweet('processing job %d' % id)
             log('processing job %d' % param_id)
-            job_params = dismod3.remove_from_job_queue(param_id)
             id = int(job_params['dm_id'])
+            # the job is finished when none of the fits named for this model are left
+            # (at once on SGE, where they are not run by the executor)
+            leases.hold(job_params['job_id'], '%d ' % id, timed=not on_sge)
             dm = dismod3.get_disease_model(id)
 
             # make a working directory for the id
@@ -135,9 +215,10 @@ def daemon_loop():
                     print e
                     call_str = 'qsub -cwd -o %s -e %s ' % (o, e) \
                                + 'run_on_cluster.sh /home/OUTPOST/abie/gbd_dev/gbd/fit_continuous_spm.py %d' % id
+                    subprocess.call(call_str, shell=True)
                 else:
                     call_str = 'python -u /home/abie/gbd/fit_continuous_spm.py %d 2>%s |tee %s' % (id, e, o)
-                subprocess.call(call_str, shell=True)
+                    executor.submit('%d continuous_spm' % id, call_str)
                 continue
             
             if estimate_type.find('posterior') != -1:
@@ -152,10 +233,19 @@ def daemon_loop():
                 os.mkdir('%s/stdout' % d)
                 os.mkdir('%s/stderr' % d)
                 os.mkdir('%s/pickle' % d)
+                os.mkdir('%s/events' % d)
                 dismod3.init_job_log(id, 'posterior', param_id)
+
+                # only re-fit the region/year/sexes whose inputs have changed
+                import dismod3.fingerprint
+                changed = dismod3.fingerprint.changed_posteriors(dm, regions_to_fit)
                 for r in regions_to_fit:
                     for s in dismod3.gbd_sexes:
                         for y in dismod3.gbd_years:
+                            if not (clean(r), y, s) in changed:
+                                log('carrying forward posterior for %s+%s+%s' % (clean(r), s, y))
+                                dismod3.log_job_status(id, 'posterior', '%s--%s--%s' % (clean(r), s, y), 'Completed')
+                                continue
                             # fit only one region, for the time being...
                             # TODO: make region selection a user-settable option from the gui
                             #if clean(r) != 'asia_southeast':
@@ -167,8 +257,7 @@ def daemon_loop():
                                 call_str = dismod3.settings.GBD_FIT_STR % (o, e, '-l -r %s -s %s -y %s' % (clean(r), s, y), id)
                                 subprocess.call(call_str, shell=True)
                             else:
-                                call_str = dismod3.settings.GBD_FIT_STR % ('-l -r %s -s %s -y %s' % (clean(r), s, y), id, o, e)
-                                subprocess.call(call_str, shell=True)
+                                submit_fit(executor, warm, '%d %s' % (id, k), '-l -r %s -s %s -y %s' % (clean(r), s, y), id, o, e)
                             #time.sleep(1.)
 
             elif estimate_type.find('empirical priors') != -1:
@@ -180,6 +269,7 @@ def daemon_loop():
                 os.mkdir('%s/stdout' % d)
                 os.mkdir('%s/stderr' % d)
                 os.mkdir('%s/pickle' % d)
+                os.mkdir('%s/events' % d)
                 dismod3.init_job_log(id, 'empirical_priors', param_id)
                 for t in ['excess-mortality', 'remission', 'incidence', 'prevalence']:
                     o = '%s/stdout/%s' % (d, t)
@@ -187,27 +277,28 @@ def daemon_loop():
                     if on_sge:
                         subprocess.call(dismod3.settings.GBD_FIT_STR % (o, e, '-l -t %s' % t, id), shell=True)
                     else:
-                        subprocess.call(dismod3.settings.GBD_FIT_STR % ('-l -t %s' % t, id, o, e), shell=True)
+                        submit_fit(executor, warm, '%d %s' % (id, t), '-l -t %s' % t, id, o, e)
 
             else:
                 #tweet('unrecognized estimate type: %s' % estimate_type)
                 log('unrecognized estimate type: %s' % estimate_type)
-            
-        time.sleep(dismod3.settings.SLEEP_SECS)
         
 def fit(id, opts):
     fit_str = '(%d) %s %s %s' % (id, opts.region or '', opts.sex or '', opts.year or '')
     #tweet('fitting disease model %s' % fit_str)
     sys.stdout.flush()
     
-    # update job status file
+    # update job status file, and start the event log
     if opts.log:
         if opts.type and not (opts.region and opts.sex and opts.year):
             dismod3.log_job_status(id, 'empirical_priors', opts.type, 'Running')
         elif opts.region and opts.sex and opts.year and not opts.type:
             dismod3.log_job_status(id, 'posterior', '%s--%s--%s' % (opts.region, opts.sex, opts.year), 'Running')
+    estimate_type, task = log_task(opts)
 
+    timing.phase_start('load')
     dm = dismod3.get_disease_model(id)
+    timing.phase_end('load')
     fit_str = '%s %s' % (dm.params['condition'], fit_str)
 
     sex_list = opts.sex and [ opts.sex ] or dismod3.gbd_sexes
@@ -221,13 +312,25 @@ def fit(id, opts):
         #print 'beginning ', fit_str
         import dismod3.neg_binom_model as model
 
-        dir = dismod3.settings.JOB_WORKING_DIR % id
-        model.fit_emp_prior(dm, opts.type, dbname='%s/empirical_priors/pickle/dm-%d-emp_prior-%s.pickle' % (dir, id, opts.type))
+        # use the stored results if this fit has been done before with the same inputs
+        import dismod3.emp_prior_cache as emp_prior_cache
+        fingerprint = emp_prior_cache.emp_prior_fingerprint(dm, opts.type)
+        if not emp_prior_cache.restore(dm, opts.type, fingerprint):
+            dir = dismod3.settings.JOB_WORKING_DIR % id
+            timing.phase_start('fit')
+            model.fit_emp_prior(dm, opts.type, dbname='%s/empirical_priors/pickle/dm-%d-emp_prior-%s.pickle' % (dir, id, opts.type))
+            timing.phase_end('fit')
+            emp_prior_cache.store(dm, opts.type, fingerprint)
 
     # if type is not specified, find consistient fit of all parameters
     else:
         import dismod3.gbd_disease_model as model
 
+        # fingerprint the inputs before fitting, which adds derived values to the data
+        if opts.sex and opts.year and opts.region:
+            import dismod3.fingerprint
+            fingerprint = dismod3.fingerprint.posterior_fingerprint(dm, opts.region, opts.year, opts.sex)
+
         # get the all-cause mortality data, and merge it into the model
         mort = dismod3.get_disease_model('all-cause_mortality')
         dm.data += mort.data
@@ -239,38 +342,36 @@ def fit(id, opts):
         # fit the model
         #print 'beginning ', fit_str
         dir = dismod3.settings.JOB_WORKING_DIR % id
-        model.fit(dm, method='map', keys=keys, verbose=1)
+        dbname = '%s/posterior/pickle/dm-%d-posterior-%s-%s-%s.pickle' % (dir, id, opts.region, opts.sex, opts.year)
+        import dismod3.checkpoint
+        checkpoint = dismod3.checkpoint.checkpoint_name(dbname)
+        if not opts.resume:
+            dismod3.checkpoint.clear(checkpoint)
+        if not dismod3.checkpoint.load(checkpoint):
+            timing.phase_start('map')
+            model.fit(dm, method='map', keys=keys, verbose=1, warm_start=True)
+            timing.phase_end('map')
+        timing.phase_start('mcmc')
         model.fit(dm, method='mcmc', keys=keys, iter=10000, thin=5, burn=5000, verbose=1,
-                  dbname='%s/posterior/pickle/dm-%d-posterior-%s-%s-%s.pickle' % (dir, id, opts.region, opts.sex, opts.year))
+                  dbname=dbname, checkpoint=checkpoint)
+        timing.phase_end('mcmc')
         #model.fit(dm, method='mcmc', keys=keys, iter=1, thin=1, burn=0, verbose=1)
 
-    # remove all keys that have not been changed by running this model
-    for k in dm.params.keys():
-        if type(dm.params[k]) == dict:
-            for j in dm.params[k].keys():
-                if not j in keys:
-                    dm.params[k].pop(j)
-
-    # post results to dismod_data_server
-    # "dumb" error handling, in case post fails (try: except: sleep random time, try again, stop after 4 tries)
-    from twill.errors import TwillAssertionError
-    from urllib2 import URLError
-    import random
+        if opts.sex and opts.year and opts.region:
+            dismod3.fingerprint.set_posterior_fingerprint(dm, opts.region, opts.year, opts.sex, fingerprint)
 
-    PossibleExceptions = [TwillAssertionError, URLError]
-    try:
-        url = dismod3.post_disease_model(dm)
-    except PossibleExceptions:
-        time.sleep(random.random()*30)
-        try:
-            url = dismod3.post_disease_model(dm)
-        except PossibleExceptions:
-            time.sleep(random.random()*30)
-            try:
-                url = dismod3.post_disease_model(dm)
-            except PossibleExceptions:
-                time.sleep(random.random()*30)
-                url = dismod3.post_disease_model(dm)
+    # post the keys changed by running this model to dismod_data_server, as a patch
+    # (the client retries with backoff if the post fails)
+    params_to_save = []
+    if opts.type:
+        # an empirical prior fit only changes the keys of its type
+        keys = gbd_keys(type_list=[opts.type], region_list=region_list, year_list=year_list, sex_list=sex_list)
+        params_to_save = ['empirical_prior_%s' % opts.type]
+    timing.attach(dm, params_to_save or keys)
+    timing.phase_start('upload')
+    url = dismod3.post_disease_model(dm, keys_to_save=keys + params_to_save, params_to_save=params_to_save)
+    event_log.saved(keys + params_to_save, url=url)
+    timing.phase_end('upload')
 
     # form url to view results
     #if opts.sex and opts.year and opts.region:
@@ -288,6 +389,7 @@ def fit(id, opts):
             dismod3.log_job_status(id, 'empirical_priors', opts.type, 'Completed')
         elif opts.region and opts.sex and opts.year and not opts.type:
             dismod3.log_job_status(id, 'posterior', '%s--%s--%s' % (opts.region, opts.sex, opts.year), 'Completed')
+    return dm
 
 if __name__ == '__main__':
     main()
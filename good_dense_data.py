@@ -186,17 +186,15 @@ def generate_disease_data(condition, cov):
     f_file.close()
 
     # upload data file
-    from dismod3.disease_json import dismod_server_login, twc, DISMOD_BASE_URL
-    dismod_server_login()
-    twc.go(DISMOD_BASE_URL + 'dismod/data/upload/')
-    twc.formvalue(1, 'tab_separated_values', open(f_name).read())
+    from dismod3.disease_json import session, DISMOD_BASE_URL
 
     # TODO: find or set the model number for this model, set the
     # expert priors and covariates, merge the covariate data into the
     # model, and add the "ground truth" to the disease json
 
     try:
-        url = twc.submit()
+        session().post_form(DISMOD_BASE_URL + 'dismod/data/upload/',
+                            {'tab_separated_values': open(f_name).read()})
     except Exception, e:
         print e
 
@@ -0,0 +1,48 @@
+#!/usr/bin/python2.5
+""" Measure the time and memory it takes to import dismod3 modules
+
+Each module is imported in a fresh python process, which reports the
+wall clock time of the import and its peak resident set size.
+
+Example
+-------
+
+$ python profile_imports.py    # the default list of modules
+$ python profile_imports.py dismod3 dismod3.gbd_disease_model
+"""
+
+import optparse
+import subprocess
+
+default_modules = ['dismod3.settings', 'dismod3', 'dismod3.disease_json', 'dismod3.plotting',
+                   'dismod3.table', 'dismod3.gbd_disease_model']
+
+# print seconds to import, and peak RSS in kilobytes (as getrusage reports it on linux)
+measure_str = 'import time, resource; t0 = time.time(); import %s; ' \
+              'print time.time() - t0, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss'
+
+def profile_import(module, python='python'):
+    """ Import module in a new process
+
+    Results
+    -------
+    Returns the seconds it took and the peak RSS (in kilobytes) of the process
+    """
+    p = subprocess.Popen([python, '-c', measure_str % module], stdout=subprocess.PIPE)
+    out = p.communicate()[0].split()
+    return float(out[-2]), int(out[-1])
+
+def main():
+    usage = 'usage: %prog [options] [module ...]'
+    parser = optparse.OptionParser(usage)
+    parser.add_option('-n', '--repeat', dest='repeat', type='int', default=3,
+                      help='number of times to import each module (the fastest is reported)')
+    (options, args) = parser.parse_args()
+
+    print '%-30s %10s %12s' % ('module', 'seconds', 'peak RSS kB')
+    for module in args or default_modules:
+        results = [profile_import(module) for i in range(options.repeat)]
+        print '%-30s %10.3f %12d' % (module, min([r[0] for r in results]), min([r[1] for r in results]))
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,20 @@
+""" Serve a snapshot of the load on the cluster and the local fitting daemons
+
+A background thread refreshes the snapshot every
+SERVER_LOAD_REFRESH_SECS: it runs qstat once, and reads the status
+files the local fitting daemons write to LOCAL_EXECUTOR_STATUS_DIR.
+Each connection is answered from the snapshot in memory, as json
+with the fields
+
+  qstat : the output of qstat
+  local : the status of each local daemon's executor, keyed by daemon
+  updated : when the snapshot was taken (seconds since the epoch)
+  age : the seconds since then
+
+so the load on the scheduler does not grow with the number of people
+watching the dashboard.
+"""
+
 import daemon
 import SocketServer
 import subprocess
@@ -5,9 +22,13 @@ import os
 import time
 import sys
 import signal
+import threading
+
+import simplejson as json
+
+from dismod3.settings import SERVER_LOAD_STATUS_HOST, SERVER_LOAD_STATUS_PORT, \
+     SERVER_LOAD_REFRESH_SECS, LOCAL_EXECUTOR_STATUS_DIR
 
-SERVER_LOAD_STATUS_HOST = 'omak.ihme.washington.edu'
-SERVER_LOAD_STATUS_PORT = 1723
 DAEMON_LOG_FILE = '/tmp/daemon_test.log'
 SERVER_LOAD_LOCK_FILE = '/tmp/server_load_test.lock'
 
@@ -19,33 +40,76 @@ def term(self, *args):
     log('server_load daemon received SIGTERM')
     sys.exit()
 
-class RequestHandler(SocketServer.BaseRequestHandler ):
-    def setup(self):
-        #print self.client_address, 'connected!'
-        s = subprocess.Popen(["qstat"], shell=True, stdout=subprocess.PIPE).communicate()[0]
-        self.request.send(s)
-        self.request.close()
+def read_local_status(dir=LOCAL_EXECUTOR_STATUS_DIR):
+    """ Return the status files of the local daemons in dir, keyed by daemon"""
+    local = {}
+    if not os.path.exists(dir):
+        return local
+    for fname in os.listdir(dir):
+        if not fname.endswith('.json'):
+            continue
+        try:
+            f = open('%s/%s' % (dir, fname))
+            local[fname[:-len('.json')]] = json.loads(f.read())
+            f.close()
+        except (IOError, ValueError):
+            pass  # being rewritten, or the daemon is gone
+    return local
 
+class LoadSnapshot(threading.Thread):
+    def __init__(self, refresh_secs=SERVER_LOAD_REFRESH_SECS):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.refresh_secs = refresh_secs
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.refresh()
+
+    def refresh(self):
+        try:
+            qstat = subprocess.Popen(["qstat"], shell=True, stdout=subprocess.PIPE).communicate()[0]
+        except OSError, e:
+            qstat = ''
+            log('could not run qstat: %s' % e)
+        snapshot = {'qstat': qstat, 'local': read_local_status(), 'updated': time.time()}
+
+        self.lock.acquire()
+        self.snapshot = snapshot
+        self.lock.release()
+
+    def run(self):
+        while True:
+            time.sleep(self.refresh_secs)
+            try:
+                self.refresh()
+            except Exception, e:
+                log('could not refresh snapshot: %s' % e)
+
+    def get(self):
+        """ Return the current snapshot, as json, with its age"""
+        self.lock.acquire()
+        snapshot = self.snapshot
+        self.lock.release()
+        return json.dumps(dict(snapshot, age=time.time() - snapshot['updated']))
+
+class RequestHandler(SocketServer.BaseRequestHandler):
     def handle(self):
-        #while 1:
-            #data = self.request.recv(1024)
-            #s = subprocess.Popen(["qstat"], shell=True, stdout=subprocess.PIPE).communicate()[0]
-            #self.request.send(s)
-            #if data.strip() == 'bye':
-                #return
-        self.request.close()
+        self.request.sendall(self.server.snapshot.get())
 
     def finish(self):
-        #print self.client_address, 'disconnected!'
-        #self.request.send('bye ' + str(self.client_address) + '\n')
         self.request.close()
 
-daemon.daemonize('/dev/null', DAEMON_LOG_FILE, DAEMON_LOG_FILE)
-f = open(SERVER_LOAD_LOCK_FILE, 'w')
-f.write(str(os.getpid()))
-f.close()
-signal.signal(signal.SIGTERM, term)
-log('starting server_load daemon...')
-server = SocketServer.ThreadingTCPServer((SERVER_LOAD_STATUS_HOST, SERVER_LOAD_STATUS_PORT), RequestHandler)
-server.serve_forever()
+def main():
+    daemon.daemonize('/dev/null', DAEMON_LOG_FILE, DAEMON_LOG_FILE)
+    f = open(SERVER_LOAD_LOCK_FILE, 'w')
+    f.write(str(os.getpid()))
+    f.close()
+    signal.signal(signal.SIGTERM, term)
+    log('starting server_load daemon...')
+    server = SocketServer.ThreadingTCPServer((SERVER_LOAD_STATUS_HOST, SERVER_LOAD_STATUS_PORT), RequestHandler)
+    server.snapshot = LoadSnapshot()
+    server.snapshot.start()
+    server.serve_forever()
 
+if __name__ == '__main__':
+    main()
@@ -523,6 +523,623 @@ def test_covariates():
 
     print str(ok) + ' errors were found in neg_binom_model.covariates'
 
+def test_checkpoint_resume():
+    """ Test that sampling continues from a checkpoint where it stopped"""
+    import dismod3.checkpoint as checkpoint
+
+    x = mc.Normal('x', 0., 1., value=0.)
+    dbname = '/tmp/test_checkpoint.pickle'
+    fname = checkpoint.checkpoint_name(dbname)
+    checkpoint.clear(fname)
+
+    # sample part of the run, as if the job were killed half way
+    m = mc.MCMC([x], db='pickle', dbname=dbname)
+    checkpoint.sample(m, 200, 100, 1, fname, every=50)
+    state = checkpoint.load(fname)
+    assert state['iters_done'] == 200
+
+    # resume and finish the run
+    state['iters_done'] = 100
+    m = mc.MCMC([x], db=checkpoint.database(dbname, state))
+    checkpoint.restore(m, state)
+    assert x.value == state['values']['x']
+    checkpoint.sample(m, 200, 100, 1, fname, state, every=50)
+    assert checkpoint.load(fname)['iters_done'] == 200
+    assert len(x.trace(chain=None)) >= 100
+
+def test_posterior_fingerprint():
+    """ Test that a posterior fingerprint changes only with relevant inputs"""
+    import dismod3.fingerprint as fingerprint
+    dm = DiseaseJson(file('tests/dismoditis.json').read())
+
+    fp = fingerprint.posterior_fingerprint(dm, 'asia_southeast', '1990', 'male')
+    assert fp == fingerprint.posterior_fingerprint(dm, 'asia_southeast', '1990', 'male')
+
+    # changing data from another region leaves the fingerprint alone
+    for d in dm.data:
+        if dismod3.utils.clean(d['gbd_region']) not in ['asia_southeast', 'all']:
+            d['value'] *= 2.
+            break
+    assert fp == fingerprint.posterior_fingerprint(dm, 'asia_southeast', '1990', 'male')
+
+    # changing the priors changes it
+    dm.set_priors('prevalence+asia_southeast+1990+male', 'smooth 40')
+    assert fp != fingerprint.posterior_fingerprint(dm, 'asia_southeast', '1990', 'male')
+
+    # a fit with a stored matching fingerprint is current
+    fp = fingerprint.posterior_fingerprint(dm, 'asia_southeast', '1990', 'male')
+    dm.set_mcmc('mean', 'prevalence+asia_southeast+1990+male', zeros(101))
+    fingerprint.set_posterior_fingerprint(dm, 'asia_southeast', '1990', 'male', fp)
+    assert fingerprint.posterior_is_current(dm, 'asia_southeast', '1990', 'male')
+    assert not ('asia_southeast', '1990', 'Male') in fingerprint.changed_posteriors(dm)
+
+def test_emp_prior_cache():
+    """ Test that stored empirical prior results are copied into a model with the same inputs"""
+    import dismod3.emp_prior_cache as emp_prior_cache
+    dm = DiseaseJson(file('tests/dismoditis.json').read())
+    fp = emp_prior_cache.emp_prior_fingerprint(dm, 'incidence')
+
+    # store some (fake) results of a fit
+    key = 'incidence+asia_southeast+1990+male'
+    dm.set_empirical_prior('incidence', {'alpha': [0., 1.], 'beta': [0.], 'gamma': [-5.], 'delta': 10.})
+    dm.set_mcmc('emp_prior_mean', key, .01*ones(101))
+    emp_prior_cache.store(dm, 'incidence', fp)
+
+    # a fresh copy of the model has the same fingerprint, and gets the results
+    dm = DiseaseJson(file('tests/dismoditis.json').read())
+    assert emp_prior_cache.emp_prior_fingerprint(dm, 'incidence') == fp
+    assert emp_prior_cache.restore(dm, 'incidence', fp)
+    assert dm.get_empirical_prior('incidence')['delta'] == 10.
+    assert dm.get_mcmc('emp_prior_mean', key)[0] == .01
+
+    # changing the data for the type changes the fingerprint
+    for d in dm.data:
+        if d['data_type'] == 'incidence data':
+            d['value'] *= 2.
+            break
+    assert emp_prior_cache.emp_prior_fingerprint(dm, 'incidence') != fp
+
+def test_local_executor():
+    """ Test that the local executor runs jobs concurrently, up to its slot count"""
+    import time
+    from dismod3.executor import LocalExecutor
+    ex = LocalExecutor(slots=2)
+    for name, cmd in [['a', 'sleep 1'], ['b', 'sleep 1'], ['c', 'exit 3']]:
+        ex.submit(name, cmd)
+    assert [j.name for j in ex.running] == ['a', 'b']
+    assert [j.name for j in ex.pending] == ['c']
+
+    finished = {}
+    while ex.busy():
+        finished.update(dict(ex.poll()))
+        time.sleep(.1)
+    assert finished == {'a': 0, 'b': 0, 'c': 3}
+
+def test_scheduler():
+    """ Test that the scheduler runs tasks after their dependencies, skips
+    the dependents of failed tasks, and does not re-run finished tasks"""
+    import os, tempfile
+    from dismod3.scheduler import Scheduler
+    state_fname = tempfile.mktemp('.json')
+    out_fname = tempfile.mktemp('.txt')
+
+    def add_tasks(s):
+        s.add('a', '-c "open(\'%s\', \'a\').write(\'a\')"' % out_fname)
+        s.add('b', '-c "open(\'%s\', \'a\').write(\'b\')"' % out_fname, deps=['a'])
+        s.add('c', '-c "import sys; sys.exit(1)"', deps=['a'])
+        s.add('d', '-c "pass"', deps=['b', 'c'])
+
+    s = Scheduler(state_fname, retries=1)
+    add_tasks(s)
+    assert s.run(sleep_secs=.1) == ['c', 'd']
+    assert s.tasks['c'].tries == 2
+    assert s.tasks['d'].state == 'skipped'
+    assert open(out_fname).read() == 'ab'
+
+    # resume with the same state file
+    s = Scheduler(state_fname, retries=0)
+    add_tasks(s)
+    assert s.run(sleep_secs=.1) == ['c', 'd']
+    assert open(out_fname).read() == 'ab'
+
+    os.remove(state_fname)
+    os.remove(out_fname)
+
+def test_worker_pool():
+    """ Test that warm workers run scripts with their arguments and
+    output files, and report their return codes"""
+    import os, sys, tempfile, time, StringIO
+    from dismod3.worker_pool import WorkerPool
+    script_fname = tempfile.mktemp('.py')
+    f = open(script_fname, 'w')
+    f.write('import sys\nprint " ".join(sys.argv[1:])\nsys.exit(int(sys.argv[1]))\n')
+    f.close()
+    out_fname = tempfile.mktemp('.txt')
+
+    # the workers write to their files even if sys.stdout is not a
+    # real file, as under nose's output capture
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+        pool = WorkerPool(slots=2)
+        pool.submit_script('a', '%s 0 hello' % script_fname, out_fname)
+        pool.submit_script('b', '%s 3' % script_fname)
+        finished = {}
+        while pool.busy():
+            finished.update(dict(pool.poll()))
+            time.sleep(.1)
+    finally:
+        sys.stdout = stdout
+    assert finished == {'a': 0, 'b': 3}
+    assert open(out_fname).read() == '0 hello\n'
+
+    os.remove(script_fname)
+    os.remove(out_fname)
+
+def test_lazy_import():
+    """ Test that importing dismod3 leaves the heavy submodules and data
+    unloaded until they are used"""
+    import subprocess
+    check_str = 'import sys, dismod3; ' \
+                'print [m for m in ["pylab", "pymc", "twill", "xlwt", "dismod3.plotting"] if m in sys.modules]; ' \
+                'dismod3.get_disease_model; print "dismod3.disease_json" in sys.modules'
+    out = subprocess.Popen(['python', '-c', check_str], stdout=subprocess.PIPE).communicate()[0]
+    assert out.split('\n')[:2] == ['[]', 'True']
+
+    d = dismod3.utils.LazyDict(lambda: {'a': 1})
+    assert dict.__len__(d) == 0
+    assert d['a'] == 1 and d.keys() == ['a']
+
+def test_model_cache():
+    """ Test that a cached copy of a static model is used without asking
+    the server, that a cached copy of any other model is revalidated
+    with its ETag, and that each fetch returns a separate copy"""
+    import cPickle, os, shutil, tempfile
+    import simplejson as json
+    import dismod3.model_cache as model_cache
+    import dismod3.http_client as http_client
+    cache_dir = model_cache.MODEL_CACHE_DIR
+    model_cache.MODEL_CACHE_DIR = tempfile.mkdtemp()
+    saved = http_client._session, http_client._session_pid
+    try:
+        dm = DiseaseJson(file('tests/dismoditis.json').read())
+        model_cache.write_atomically(model_cache.content_fname('"abc"'), cPickle.dumps(dm, cPickle.HIGHEST_PROTOCOL))
+        for id in [-5, 'all-cause_mortality']:
+            model_cache.write_atomically(model_cache.index_fname(id), json.dumps({'etag': '"abc"'}))
+
+        class NotModified:
+            def __init__(self):
+                self.etags = []
+            def get_if_changed(self, url, etag=None):
+                self.etags.append(etag)
+                return etag, None
+        http_client._session, http_client._session_pid = NotModified(), os.getpid()
+        dm1 = model_cache.fetch('all-cause_mortality')
+        assert http_client._session.etags == []
+        dm1 = model_cache.fetch(-5)
+        assert http_client._session.etags == ['"abc"']
+        assert dm1.params == dm.params and len(dm1.data) == len(dm.data)
+        dm1.data = []
+        assert len(model_cache.fetch(-5).data) == len(dm.data)
+        assert http_client._session.etags == ['"abc"', '"abc"']
+    finally:
+        http_client._session, http_client._session_pid = saved
+        shutil.rmtree(model_cache.MODEL_CACHE_DIR)
+        model_cache.MODEL_CACHE_DIR = cache_dir
+
+def test_runtime_predictor():
+    """ Test that the run time predictor learns run times from past
+    fits, and that the scheduler starts the costliest ready tasks first"""
+    from dismod3.runtime_model import RuntimePredictor, fit_features
+    p = RuntimePredictor()
+
+    # before training, bigger fits are predicted to take longer
+    small = fit_features(['prevalence data'] * 10, 1, 1000)
+    big = fit_features(['prevalence data', 'incidence data'] * 1000, 1, 10000)
+    assert p.predict(small) < p.predict(big)
+    assert not p.train([[small, 10.]])
+
+    # run times that grow with the square root of the rows are learned
+    records = []
+    for rows in [10, 30, 100, 300, 1000, 3000]:
+        for iter in [1000, 10000]:
+            f = fit_features(['prevalence data'] * rows, 1, iter)
+            records.append([f, .01 * rows**.5 * iter])
+    assert p.train(records)
+    f = fit_features(['prevalence data'] * 500, 1, 5000)
+    assert abs(p.predict(f) / (.01 * 500**.5 * 5000) - 1.) < .2
+
+    from dismod3.scheduler import Scheduler
+    s = Scheduler()
+    s.add('a', 'a.py', cost=1.)
+    s.add('b', 'b.py', cost=10.)
+    s.add('c', 'c.py', deps=['a'], cost=100.)
+    s.add('d', 'd.py', cost=1.)
+    assert [t.name for t in s.ready()] == ['b', 'a', 'd']
+
+    # the tasks of fit_all and the jobs of the queue count their keys alike
+    from dismod3.runtime_model import job_features, rate_types
+    types = ['prevalence data'] * 10
+    assert job_features('empirical priors', types)['keys'] == len(rate_types)
+    assert job_features('empirical priors', types, emp_prior_types=['prevalence'])['keys'] == 1
+    assert job_features('posterior', types, ['asia_east'], years=[2005], sexes=['male'])['keys'] == 1
+
+def test_event_log():
+    """ Test that the event log is read from an offset, one whole event
+    at a time, and that its index summarizes it"""
+    import os
+    import dismod3.event_log as event_log
+    fname = event_log.log_fname(-5, 'posterior', 'asia_east+male+2005')
+    for f in [fname, event_log.index_fname(fname)]:
+        if os.path.exists(f):
+            os.remove(f)
+
+    event_log.open_log(-5, 'posterior', 'asia_east+male+2005')
+    event_log.phase_start('mcmc')
+    event_log.progress(1000, 2000)
+    events, offset = event_log.read_events(fname)
+    assert [e['event'] for e in events] == ['start', 'phase_start', 'progress']
+
+    event_log.progress(2000, 2000)
+    event_log.phase_end('mcmc')
+    event_log.close_log('done')
+    events, offset = event_log.read_events(fname, offset)
+    assert [e['event'] for e in events] == ['progress', 'phase_end', 'finish']
+    assert event_log.read_events(fname, offset) == ([], offset)
+    size = offset
+
+    # an event longer than max_bytes is read whole, so the offset moves past it
+    f = open(fname, 'a')
+    f.write('{"event": "error", "message": "%s"}\n' % ('x' * 100))
+    f.close()
+    events, offset = event_log.read_events(fname, offset, max_bytes=10)
+    assert [e['event'] for e in events] == ['error'] and offset == os.path.getsize(fname)
+
+    # an event that is still being written is left for next time
+    f = open(fname, 'a')
+    f.write('{"event": "prog')
+    f.close()
+    assert event_log.read_events(fname, offset) == ([], offset)
+
+    summary = event_log.read_summary(fname)
+    assert summary['state'] == 'done'
+    assert summary['progress'] == [2000, 2000]
+    assert summary['counts']['progress'] == 2
+    assert summary['size'] == size
+
+    # nothing is logged when no log is open
+    event_log.progress(3000, 3000)
+    assert event_log.read_summary(fname)['counts']['progress'] == 2
+
+def test_timing():
+    """ Test that the phases of a fit are timed, summarized by phase,
+    attached to the model, and saved"""
+    import os
+    import simplejson as json
+    import dismod3.timing as timing
+    timing.reset()
+    timing.phase_start('setup', 'a')
+    timing.phase_end('setup', 'a')
+    timing.phase_start('setup', 'b')
+    timing.phase_start('mcmc')
+    x = sum(range(100000))
+    timing.phase_end('mcmc')
+    timing.phase_end('setup', 'b')
+
+    s = timing.summary()
+    assert s['phases']['setup']['count'] == 2
+    assert s['phases']['mcmc']['count'] == 1
+    assert s['phases']['mcmc']['wall'] >= 0. and s['phases']['mcmc']['cpu'] >= 0.
+    assert s['peak_rss'] > 0
+    assert timing.phases()[-1]['rss'] > 0 and 'rss_growth' in s['phases']['setup']
+
+    # the summary is stored once, under the first key of the fit
+    dm = DiseaseJson(file('tests/dismoditis.json').read())
+    timing.attach(dm, ['empirical_prior_incidence', 'empirical_prior_prevalence'])
+    assert dm.get_key_by_type('fit_timing', 'empirical_prior_incidence')['phases']['setup']['count'] == 2
+    assert dm.params['fit_timing'].keys() == ['empirical_prior_incidence']
+
+    fname = timing.timing_fname(-5, 'empirical_priors', 'incidence')
+    timing.save(-5, 'empirical_priors', 'incidence')
+    record = json.loads(file(fname).read())
+    assert [r['phase'] for r in record['phases']] == ['setup', 'mcmc', 'setup']
+    assert record['phases'][0]['key'] == 'a'
+    os.remove(fname)
+
+    # nothing is timed outside a fit
+    timing.stop()
+    timing.phase_start('fetch', '4222')
+    timing.phase_end('fetch', '4222')
+    assert timing.phases() == [] and timing.summary() == {}
+
+def test_run_fit():
+    """ Test that a fit run by run_fit is logged and timed, whether it
+    finishes or fails"""
+    import os
+    import optparse
+    import dismod3.event_log as event_log
+    import dismod3.timing as timing
+    from dismod3.fit_runner import run_fit
+    options = optparse.Values({'memory': False, 'memory_budget': None})
+    fname = event_log.log_fname(-5, 'empirical_priors', 'remission')
+    tname = timing.timing_fname(-5, 'empirical_priors', 'remission')
+    for f in [fname, event_log.index_fname(fname)]:
+        if os.path.exists(f):
+            os.remove(f)
+
+    def fit(x):
+        timing.phase_start('fit')
+        timing.phase_end('fit')
+        return x
+    assert run_fit(-5, 'empirical_priors', 'remission', fit, options, 'dm') == 'dm'
+    assert event_log.read_summary(fname)['state'] == 'done'
+    assert os.path.exists(tname)
+    os.remove(tname)
+
+    def fail():
+        raise ValueError, 'bad data'
+    try:
+        run_fit(-5, 'empirical_priors', 'remission', fail, options)
+        assert False, 'the error of the fit should be raised'
+    except ValueError:
+        pass
+    summary = event_log.read_summary(fname)
+    assert summary['state'] == 'failed' and summary['counts']['error'] == 1
+    assert os.path.exists(tname) and timing.phases() == []
+    os.remove(tname)
+
+    # without the log, only the fit is run
+    os.remove(fname)
+    run_fit(-5, 'empirical_priors', 'remission', fit, options, 'dm', log=False)
+    assert not os.path.exists(fname) and not os.path.exists(tname)
+
+def test_profiling():
+    """ Test that every node of a model is timed, labelled with its key
+    and name, and left with its value"""
+    import pymc as mc
+    import dismod3.profiling as profiling
+    x = mc.Normal('x', 0., 1., value=0.)
+    y = mc.Lambda('y', lambda x=x: x**2)
+    z = mc.Normal('z', y, 1., value=1., observed=True)
+    @mc.potential
+    def p(x=x):
+        return -x**2
+    vars = {'incidence+asia_east+2005+male': {'rate_stoch': x, 'expected_rates': y, 'observed_counts': [z]},
+            'm+asia_east+2005+male': p}
+    mcmc = mc.MCMC(vars)
+    mcmc.sample(10)
+
+    val = x.value
+    rows = profiling.profile_nodes(vars, mcmc, steps=5)
+    assert x.value == val
+    assert sorted([(r['name'], r['kind']) for r in rows]) == \
+        [('', 'potential'), ('expected_rates', 'deterministic'), ('observed_counts', 'stochastic'), ('rate_stoch', 'stochastic')]
+    assert [r['calls'] for r in rows] == [5, 5, 5, 5]
+    assert rows[0]['secs'] >= rows[-1]['secs']
+    assert len(profiling.report(rows, n=2).split('\n')) == 3
+
+def test_benchmark_compare():
+    """ Test that a benchmark step is a regression only if it is both
+    relatively and absolutely slower than in the baseline"""
+    import benchmark
+    baseline = {'opi/emp_prior/map': 1., 'opi/emp_prior/logp': .001, 'opi/emp_prior/mcmc': 10.}
+    results = {'opi/emp_prior/map': 2., 'opi/emp_prior/logp': .004, 'opi/emp_prior/mcmc': 11.,
+               'opi/posterior/map': 5.}
+    regressions = benchmark.compare(results, baseline, threshold=1.25, min_secs=.05)
+    assert [r[0] for r in regressions] == ['opi/emp_prior/map']
+    assert regressions[0][3] == 2.
+
+    assert benchmark.compare(results, baseline, threshold=1.05, min_secs=.05)[-1][0] == 'opi/emp_prior/mcmc'
+    assert benchmark.compare(baseline, baseline) == []
+
+def test_memory():
+    """ Test that memory is attributed to the phases it grew in and to
+    the largest params, and that a fit over its budget stops"""
+    import dismod3.memory as memory
+    samples = [(0., 100, 0), (1., 150, 0), (2., 400, 1), (3., 410, 1), (4., 420, 0)]
+    phases = [{'phase': 'setup', 'start': .5, 'wall': 1.}, {'phase': 'mcmc', 'start': 1.5, 'wall': 2.}]
+    rows = memory.by_phase(samples, phases)
+    assert [r['phase'] for r in rows] == ['mcmc', 'setup']
+    assert rows[0]['growth'] == 260 and rows[0]['peak'] == 410 and rows[0]['figures'] == 1
+    assert rows[1]['growth'] == 50
+
+    dm = DiseaseJson(file('tests/dismoditis.json').read())
+    dm.params['big'] = range(100000)  # larger than the covariates of the fixture
+    assert memory.object_sizes(dm)[0][:2] == ('param', 'big')
+
+    sampler = memory.Sampler(budget=1024)
+    try:
+        sampler.check('setup')
+        assert 0, 'should be over a budget of 1 kB'
+    except memory.MemoryBudgetExceeded, e:
+        assert str(e).find('setup') != -1
+    memory.Sampler(budget=None).check()
+
+def test_merge_shards():
+    """ Test that shards parsed in parallel are all merged, posteriors
+    after empirical priors, and that missing and corrupt shards are
+    reported"""
+    import os, tempfile
+    import simplejson as json
+    import dismod3.merge as merge
+    dir = tempfile.mkdtemp()
+    fnames = []
+    for ii in range(6):
+        fname = '%s/dm-1-posterior-%d.json' % (dir, ii)
+        f = open(fname, 'w')
+        f.write(json.dumps({'params': {'mcmc_mean': {'key%d' % ii: [ii] * 100}, 'condition': 'test'}, 'data': []}))
+        f.close()
+        fnames.append(fname)
+    fname = '%s/dm-1-prior-incidence.json' % dir
+    f = open(fname, 'w')
+    f.write(json.dumps({'params': {'mcmc_mean': {'key0': [-1], 'key6': [6]}}, 'data': []}))
+    f.close()
+    fnames.append(fname)
+    f = open('%s/corrupt.json' % dir, 'w')
+    f.write('{"params": {"mcmc_mean": ')
+    f.close()
+
+    dm = DiseaseJson(file('tests/dismoditis.json').read())
+    dm.params['mcmc_mean'] = {'old': [0]}
+    report = merge.merge_shards(dm, fnames + ['%s/corrupt.json' % dir, '%s/missing.json' % dir], workers=3)
+    assert sorted(report['merged']) == fnames
+    assert report['missing'] == ['%s/missing.json' % dir]
+    assert [c[0] for c in report['corrupt']] == ['%s/corrupt.json' % dir]
+    assert sorted(dm.params['mcmc_mean'].keys()) == ['key%d' % ii for ii in range(7)] + ['old']
+    assert dm.params['mcmc_mean']['key5'] == [5] * 100
+    assert dm.params['mcmc_mean']['key0'] == [0] * 100
+
+    # the shard of an empirical prior holds only what its fit sets
+    import dismod3.emp_prior_cache as emp_prior_cache
+    dm = DiseaseJson(file('tests/dismoditis.json').read())
+    dm.id = -5
+    dm.params['mcmc_mean'] = {'prevalence+asia_east+2005+male': [.1], 'incidence+asia_east+2005+male': [.2]}
+    dm.set_empirical_prior('prevalence', {'delta': 1.})
+    dm.set_empirical_prior('incidence', {'delta': 2.})
+    d = '%s/json' % (dismod3.settings.JOB_WORKING_DIR % dm.id)
+    if not os.path.exists(d):
+        os.makedirs(d)
+    emp_prior_cache.save(dm, 'incidence')
+    params = json.loads(file('%s/dm--5-prior-incidence.json' % d).read())['params']
+    assert params['mcmc_mean'].keys() == ['incidence+asia_east+2005+male']
+    assert 'empirical_prior_incidence' in params and not 'empirical_prior_prevalence' in params
+
+def test_write_shard():
+    """ Test that shards are written whole and recorded in the manifest,
+    that unchanged shards are not rewritten, and that a damaged shard
+    is not merged"""
+    import os, tempfile
+    import dismod3.merge as merge
+    dir = tempfile.mkdtemp()
+    fname = '%s/dm-1-posterior-asia_east-male-2005.json' % dir
+    s = '{"params": {"mcmc_mean": {"prevalence+asia_east+2005+male": [0.1]}}, "data": [], "id": 1}'
+    assert merge.write_shard(fname, s, ['prevalence+asia_east+2005+male'])
+    assert merge.read_manifest_entry(fname)['size'] == len(s)
+    assert not merge.write_shard(fname, s)
+    assert sorted(os.listdir(dir)) == [os.path.basename(fname), 'manifest']  # no temporary files left
+
+    f = open(fname, 'w')
+    f.write(s[:-10])  # as if a write was cut short
+    f.close()
+    assert merge.parse_shard(fname)[2].find('checksum') != -1
+    assert merge.write_shard(fname, s)
+    assert merge.parse_shard(fname)[2] == None
+
+    # while a shard is replaced, the manifest accepts the old one and the new one
+    import hashlib
+    s2 = s.replace('0.1', '0.2')
+    merge.write_manifest_entry(fname, hashlib.sha1(s2).hexdigest(), len(s2), previous=hashlib.sha1(s).hexdigest())
+    assert merge.parse_shard(fname)[2] == None
+    assert merge.write_shard(fname, s2)
+    assert merge.parse_shard(fname)[2] == None and not 'previous' in merge.read_manifest_entry(fname)
+
+def test_array_encoding():
+    """ Test that estimates stored in the compact encoding are read
+    back, and that the list format is still read"""
+    import dismod3.array_encoding as array_encoding
+    val = [.1, .2, 1.e-7]
+    assert array_encoding.encode(val) == val
+    assert np.all(array_encoding.decode(array_encoding.encode(val, '<f8')) == val)
+    assert np.allclose(array_encoding.decode(array_encoding.encode(val, '<f4')), val, rtol=1.e-6)
+    assert np.all(array_encoding.decode(val) == val)
+
+    dm = DiseaseJson(file('tests/dismoditis.json').read())
+    dm.set_mcmc('mean', 'prevalence+asia_southeast+1990+male', val)  # stored as a list
+    array_encoding.ARRAY_ENCODING = '<f8'
+    try:
+        dm.set_mcmc('upper_ui', 'prevalence+asia_southeast+1990+male', val)
+        dm.set_empirical_prior('prevalence', {'alpha': [0., 1.], 'delta': 5.})
+    finally:
+        array_encoding.ARRAY_ENCODING = None
+    assert array_encoding.is_encoded(dm.params['mcmc_upper_ui']['prevalence+asia_southeast+1990+male'])
+
+    dm = DiseaseJson(dm.to_json())
+    assert np.all(dm.get_mcmc('mean', 'prevalence+asia_southeast+1990+male') == val)
+    assert np.all(dm.get_mcmc('upper_ui', 'prevalence+asia_southeast+1990+male') == val)
+    assert dm.get_empirical_prior('prevalence') == {'alpha': [0., 1.], 'delta': 5.}
+
+def test_results_store():
+    """ Test that estimates are read from the results store of a model
+    when they are not in its params"""
+    import os, tempfile
+    import dismod3.array_encoding as array_encoding
+    from dismod3.results_store import ResultsStore
+    fname = tempfile.mktemp('.sqlite')
+    k = 'prevalence+asia_southeast+1990+male'
+    try:
+        store = ResultsStore(fname)
+        assert store.get('mcmc_mean', k) == None and store.stamp() == None
+        n = store.update({'mcmc_mean': {k: [.1, .2, .3]},
+                          'map': {k: array_encoding.encode([.4, .5], '<f4')},
+                          'priors': {'prevalence': 'smooth 10'},
+                          'condition': 'dismoditis'})
+        assert n == 2, 'only estimate vectors should be stored'
+        assert np.all(store.get('mcmc_mean', k) == [.1, .2, .3])
+        assert np.allclose(store.get('map', k), [.4, .5])
+        assert store.keys('mcmc_mean') == [k]
+        store.set_stamp('abc')
+        store.close()
+
+        dm = DiseaseJson(file('tests/dismoditis.json').read())
+        dm.clear_fit()
+        assert not dm.has_mcmc(k) and len(dm.get_mcmc('mean', k)) == 0
+        dm.results = ResultsStore(fname)
+        assert dm.results.stamp() == 'abc'
+        assert dm.has_mcmc(k) and dm.has_map(k)
+        assert np.all(dm.get_mcmc('mean', k) == [.1, .2, .3])
+        assert len(dm.get_mcmc('upper_ui', k)) == 0
+
+        dm.set_mcmc('mean', k, [.6])  # params come before the store
+        assert np.all(dm.get_mcmc('mean', k) == [.6])
+        dm.results.close()
+    finally:
+        if os.path.exists(fname):
+            os.remove(fname)
+
+def test_warm_start():
+    """ Test that stored MAP values are restored into a model of the
+    same structure, and not into one they do not fit or that rules
+    them out"""
+    import shutil, tempfile
+    import dismod3.warm_start as warm_start
+    k = 'prevalence+asia_southeast+1990+male'
+    def model(dm, ruled_out=False):
+        alpha = mc.Normal('alpha_%s' % k, 0., 1., value=0.)
+        obs = mc.Normal('obs_%s' % k, alpha, 1., value=.5, observed=True)
+        vars = {'alpha': alpha, 'obs': obs}
+        if ruled_out:
+            @mc.potential(name='positive_%s' % k)
+            def positive(alpha=alpha):
+                if alpha > .25:
+                    return -np.inf
+                return 0.
+            vars['positive'] = positive
+        dm.vars = {k: vars}
+        return alpha
+
+    store_dir = warm_start.WARM_START_DIR
+    warm_start.WARM_START_DIR = tempfile.mkdtemp()
+    try:
+        dm = DiseaseJson(file('tests/dismoditis.json').read())
+        alpha = model(dm)
+        alpha.value = .5
+        warm_start.save(dm, [k])
+
+        alpha = model(dm)
+        assert warm_start.restore(dm, [k]) and alpha.value == .5
+
+        # a potential that rules the stored value out means a cold start
+        alpha = model(dm, ruled_out=True)
+        assert not warm_start.restore(dm, [k]) and alpha.value == 0.
+
+        # so does a model of a different structure
+        dm.params['param_age_mesh'] = [0, 50, 100]
+        alpha = model(dm)
+        assert not warm_start.restore(dm, [k]) and alpha.value == 0.
+    finally:
+        shutil.rmtree(warm_start.WARM_START_DIR)
+        warm_start.WARM_START_DIR = store_dir
+
 if __name__ == '__main__':
     for test in [
         test_opi,
@@ -537,6 +1154,26 @@ if __name__ == '__main__':
         test_single_rate,
         test_save_country_level_posterior,
         test_covariates,
+        test_checkpoint_resume,
+        test_posterior_fingerprint,
+        test_emp_prior_cache,
+        test_local_executor,
+        test_scheduler,
+        test_worker_pool,
+        test_lazy_import,
+        test_model_cache,
+        test_runtime_predictor,
+        test_event_log,
+        test_timing,
+        test_run_fit,
+        test_profiling,
+        test_benchmark_compare,
+        test_memory,
+        test_merge_shards,
+        test_write_shard,
+        test_array_encoding,
+        test_results_store,
+        test_warm_start,
         ]:
         try:
             test()
@@ -6,6 +6,8 @@ Expects the disase model json to be saved already.
 
 import simplejson as json
 import dismod3
+import dismod3.timing as timing
+from dismod3.fit_runner import run_fit
 import zipfile, os
 from shutil import rmtree
 
@@ -25,9 +27,22 @@ def upload_fits(id):
     >>> upload_fits.upload_fits(2552)
     """
     # load disease model
+    timing.phase_start('merge')
     dm = dismod3.load_disease_model(id)  # this merges together results from all fits
-    dismod3.try_posting_disease_model(dm, ntries=5)
+    timing.phase_end('merge')
+    if hasattr(dm, 'merge_report'):
+        import dismod3.merge
+        print dismod3.merge.report_str(dm.merge_report)
+    emp_priors = ['empirical_prior_%s' % t for t in ['incidence', 'prevalence', 'remission', 'excess-mortality']]
+    # the empirical prior names are also the keys of their fit timings
+    timing.phase_start('upload')
+    dismod3.try_posting_disease_model(dm, ntries=5, keys_to_save=dismod3.utils.gbd_keys() + emp_priors,
+                                      params_to_save=emp_priors)
+    timing.phase_end('upload')
+    timing.phase_start('zip')
     zip_country_level_posterior_files(id)
+    timing.phase_end('zip')
+    return dm
 
 def zip_country_level_posterior_files(id):
     """  Zip country level posterior files in the directory of the
@@ -75,6 +90,11 @@ def main():
 
     usage = 'usage: %prog [options] disease_model_id'
     parser = optparse.OptionParser(usage)
+    parser.add_option('--memory', action='store_true', dest='memory',
+                      help='sample the memory used by the merge and upload, and report it by phase and by object '
+                      '(in <JOB_WORKING_DIR>/upload/memory/upload_fits.json)')
+    parser.add_option('--memory-budget', type='int', dest='memory_budget',
+                      help='stop with an error if more than this many MB are used')
     (options, args) = parser.parse_args()
 
     if len(args) != 1:
@@ -85,7 +105,7 @@ def main():
     except ValueError:
         parser.error('disease_model_id must be an integer')
 
-    upload_fits(id)
+    run_fit(id, 'upload', 'upload_fits', upload_fits, options, id, log=False)
       
 
 if __name__ == '__main__':